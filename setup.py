@@ -11,7 +11,7 @@ setup(
     license='Open Source',
     install_requires=requires,
     packages=['tp'],
-    package_data={'tp': ['tp.conf.template']},
+    package_data={'tp': ['tp.conf.template', 'instance_types.json']},
     long_description=open('README.md').read(),
     data_files=[('', ['LICENSE']), ('', ['CHANGELOG.md'])],
     zip_safe=False,
@@ -0,0 +1,85 @@
+""" A control loop whose AWS calls overlap instead of queueing behind each other.
+
+    AsyncTPManager makes the same decisions as TPManager, only the waiting
+    differs: the LB health and the inventory snapshot are fetched at the
+    same time, and the cycle's clean up no longer sleeps through the LB
+    drain. The retired instances are detached right away and a deferred
+    call cancels and terminates them, both at once, when the drain is over.
+    Meanwhile they are draining, which load_state() treats like doomed
+    instances so they are neither counted nor promoted again.
+
+    Deferred calls live on a Timers heap. A single AsyncTPManager runs them
+    from its own wait, a Supervisor shares one heap between every group and
+    runs them on its workers, so one loop serves many groups without a
+    thread sleeping on behalf of each of them.
+"""
+
+import threading
+import time
+
+from parallel import Timers
+from tp import TPManager
+
+
+class AsyncTPManager(TPManager):
+    # tells the Supervisor to hand over its shared Timers
+    deferred = True
+
+    def __init__(self, side_group, timers=None, **kwargs):
+        TPManager.__init__(self, side_group, **kwargs)
+        # an empty heap is falsy, hence no "timers or Timers()"
+        self.timers = timers if timers is not None else Timers()
+        # instance ids detached and waiting for the drain to end
+        self.draining = set()
+        self._draining_lock = threading.Lock()
+
+    def fetch_state(self):
+        """ Reads the LBs and takes the inventory snapshot at the same time. """
+        # the members are not known yet, the snapshot includes last cycle's and looks up the rest after
+        known = [k for k, v in (self.lb_health or {}).items() if v == 'InService']
+        states, _ = self.executor.gather(self.read_lb_health, lambda: self.inventory.refresh(known))
+        self.inventory.lookup([x.instance_id for x in states if x.state == 'InService'])
+        return states
+
+    def leaving(self, instance_id):
+        with self._draining_lock:
+            if instance_id in self.draining:
+                return True
+        return TPManager.leaving(self, instance_id)
+
+    def drain(self, instance_ids, request_ids):
+        """ Takes instance_ids down once drained, from a deferred call instead of sleeping. """
+        with self._draining_lock:
+            self.draining.update(instance_ids)
+        self.timers.later(self.drain_seconds, self.finish_drain, instance_ids, request_ids)
+
+    def finish_drain(self, instance_ids, request_ids):
+        try:
+            self.take_down(instance_ids, request_ids)
+            self.logger.info(">> finish_drain(): %s drained and terminated", ", ".join(instance_ids))
+        finally:
+            # if anything failed the next load_state() finds them again and demotes them anew
+            with self._draining_lock:
+                self.draining.difference_update(instance_ids)
+
+    def tick(self):
+        self.timers.run_due()
+        return TPManager.tick(self)
+
+    def running(self):
+        with self._draining_lock:
+            draining = len(self.draining)
+        return TPManager.running(self) or draining > 0
+
+    def wait(self, delay):
+        """ Sleeps until the next cycle is due, running the deferred calls that come due meanwhile. """
+        deadline = time.time() + delay
+        while True:
+            self.timers.run_due()
+            now = time.time()
+            if now >= deadline:
+                return False
+            next_at = self.timers.next_at()
+            timeout = deadline - now if next_at is None else max(0, min(deadline, next_at) - now)
+            if self.reconciler.wait(timeout):
+                return True
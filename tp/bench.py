@@ -0,0 +1,577 @@
+""" Replays scenarios against the simulator and reports how save_money() behaves.
+
+    Every scenario runs a real TPManager on top of sim.Cloud with a virtual
+    clock, so hours of operation take seconds. For each scenario we report
+    loop latency (virtual seconds spent inside one tick, API latency and
+    sleeps included), API calls per tick and how long it took for the live
+    capacity to converge to the target after the last disturbance.
+
+    The groups scenario runs growing numbers of groups under one Supervisor
+    and as many standalone TPManagers instead, and reports the API calls
+    and the objects held per group for both.
+
+    Usage: python bench.py [-s scenario[,scenario]] [-j] [-v]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import simplejson as json
+
+import aio
+import cache
+import client
+import config
+import events
+import forecast
+import interruptions
+import inventory
+import journal
+import lease
+import market
+import metrics
+import parallel
+import planner
+import sim
+import supervisor
+import tp as tp_module
+import tracing
+
+GROUP = "bench"
+
+# modules whose time and datetime are pointed at the simulator's virtual clock
+CLOCKED = (tp_module, aio, cache, client, events, forecast, interruptions, inventory, journal, lease, market, metrics,
+           parallel, planner, supervisor, tracing)
+
+DEFAULT_CONF = {
+    "max_price": {"c1.xlarge": "0.70", "m2.4xlarge": "0.66"},
+    "spot_type": "c1.xlarge",
+    "emergency_type": "c1.xlarge",
+    "max_candidates": 6,
+    "instance_name": "bench",
+    "region": "us-east-1",
+    "placement": "us-east-1a",
+    "cool_down_threshold": 360,
+    "bid_threshold": 300,
+}
+
+
+class Scenario(object):
+    """ A group, a configuration and things that happen to them at given ticks. """
+
+    def __init__(self, name, description, ticks=120, capacity=4, conf=None, cloud=None, events=None,
+                 restarts=(), manager=None, failover=None, groups=None):
+        self.name = name
+        self.description = description
+        self.ticks = ticks
+        self.capacity = capacity
+        self.conf = dict(DEFAULT_CONF)
+        self.conf.update(conf or {})
+        self.cloud = cloud or {}
+        self.events = events or {}
+        # ticks before which tiopatinhas is restarted, recovering from its journal
+        self.restarts = restarts
+        self.manager = manager or tp_module.TPManager
+        # tick at which the leader dies, a standby replica then takes over
+        self.failover = failover
+        # numbers of groups run side by side, see run_groups()
+        self.groups = groups
+
+
+def scale_up():
+    return Scenario("scale-up", "ASG grows from 2 to 6 instances",
+                    ticks=240, capacity=2,
+                    events={10: lambda cloud: cloud.set_capacity(GROUP, 6)})
+
+
+def throttled():
+    return Scenario("throttled", "scale-up while AWS throttles 20% of the calls and allows 4 calls per second",
+                    ticks=240, capacity=2, cloud={"throttle_probability": 0.2, "max_calls_per_second": 4},
+                    events={10: lambda cloud: cloud.set_capacity(GROUP, 6)})
+
+
+def scale_down(billing="hourly"):
+    return Scenario("scale-down-%s" % billing, "ASG shrinks from 8 to 2 instances, %s billing" % billing,
+                    ticks=480, capacity=8, conf={"cool_down_threshold": 60, "billing": billing, "max_candidates": 8},
+                    events={60: lambda cloud: cloud.set_capacity(GROUP, 2)})
+
+
+def scale_down_per_second():
+    return scale_down("per-second")
+
+
+def scale_down_async():
+    scenario = scale_down()
+    scenario.name = "scale-down-async"
+    scenario.description += ", AsyncTPManager"
+    scenario.manager = aio.AsyncTPManager
+    return scenario
+
+
+def ramp(forecast=False):
+    def grow(cloud):
+        group = cloud.groups[GROUP]
+        cloud.set_capacity(GROUP, group.desired_capacity + 1)
+
+    name = "ramp-forecast" if forecast else "ramp"
+    return Scenario(name, "ASG grows one instance at a time from 2 to 8%s" % (", forecasting" if forecast else ""),
+                    ticks=180, capacity=2,
+                    conf={"forecast": forecast, "forecast_hold": 600, "max_candidates": 10, "billing": "per-second",
+                          "cool_down_threshold": 60},
+                    events=dict([(20 + 15 * i, grow) for i in range(6)]))
+
+
+def ramp_forecast():
+    return ramp(True)
+
+
+def interruption():
+    def interrupt(cloud):
+        cloud.interrupt(0.5)
+
+    return Scenario("interruption", "half of the spot instances get a two minutes interruption notice",
+                    ticks=180, capacity=6, conf={"cool_down_threshold": 60},
+                    events={60: interrupt})
+
+
+def rebalance():
+    def recommend(cloud):
+        cloud.recommend_rebalance(0.5)
+
+    return Scenario("rebalance", "half of the spot instances get a rebalance recommendation",
+                    ticks=180, capacity=6, conf={"cool_down_threshold": 60},
+                    events={60: recommend})
+
+
+def market_crash():
+    def crash(cloud):
+        cloud.crash()
+
+    def recover(cloud):
+        cloud.set_price(0.1)
+
+    return Scenario("market-crash", "every spot instance is interrupted, market recovers 20 minutes later",
+                    ticks=540, capacity=6, conf={"cool_down_threshold": 60},
+                    events={60: crash, 120: recover})
+
+
+def partial_crash():
+    def crash(cloud):
+        cloud.set_price(10.0)
+        cloud.interrupt(0.7)
+
+    def recover(cloud):
+        cloud.set_price(0.1)
+
+    return Scenario("partial-crash", "70% of the spot instances are interrupted, market recovers 20 minutes later",
+                    ticks=540, capacity=10, conf={"cool_down_threshold": 60, "max_candidates": 10},
+                    events={60: crash, 120: recover})
+
+
+def lb_flapping():
+    def flap(cloud):
+        lb = cloud.load_balancers[GROUP + "-lb"]
+        members = sorted(lb.instances)
+        cloud.flapping = set(cloud.random.sample(members, len(members) // 2))
+
+    def settle(cloud):
+        cloud.flapping = set()
+
+    return Scenario("lb-flapping", "half of the LB members flap between InService and OutOfService",
+                    ticks=180, capacity=6, conf={"cool_down_threshold": 60},
+                    events={60: flap, 120: settle})
+
+
+def fleet(size=1000):
+    # a negative cool down promotes everything that is ready on each tick, virtual time
+    # doesn't move between two promotions so 0 would still hold them back
+    return Scenario("fleet-%s" % size, "a %s instances group starting from zero spot instances" % size,
+                    ticks=60, capacity=size,
+                    conf={"max_candidates": size, "cool_down_threshold": -1, "bid_threshold": 60})
+
+
+def mixed_fleet():
+    # an m2.4xlarge is weighted as 4 c1.xlarge, 2 of them cover the group
+    return Scenario("mixed-fleet", "ASG of 8 c1.xlarge served by m2.4xlarge spot instances weighted 4",
+                    ticks=120, capacity=2,
+                    conf={"spot_type": "m2.4xlarge", "max_candidates": 8, "instance_weights": {"m2.4xlarge": 4}},
+                    events={10: lambda cloud: cloud.set_capacity(GROUP, 8)})
+
+
+def pool_crash():
+    def prices(cloud):
+        for zone, price in (("us-east-1a", 0.2), ("us-east-1b", 0.25), ("us-east-1c", 0.3)):
+            cloud.set_price(price, "c1.xlarge", zone)
+            cloud.set_price(price * 2, "m2.4xlarge", zone)
+
+    def crash(cloud):
+        cloud.crash(instance_type="c1.xlarge", availability_zone="us-east-1a")
+
+    return Scenario("pool-crash", "bids spread over 3 zones, the cheapest pool crashes",
+                    ticks=180, capacity=6,
+                    conf={"cool_down_threshold": 60, "bid_placement": True,
+                          "availability_zones": ["us-east-1a", "us-east-1b", "us-east-1c"],
+                          "max_pool_share": 0.5, "price_history_max_age": 60},
+                    events={0: prices, 60: crash})
+
+
+def restart():
+    def crash(cloud):
+        cloud.crash()
+
+    def recover(cloud):
+        cloud.set_price(0.1)
+
+    return Scenario("restart",
+                    "market-crash, with tiopatinhas restarted halfway through the ramp up and right at the crash",
+                    ticks=540, capacity=6, conf={"cool_down_threshold": 60},
+                    events={60: crash, 120: recover},
+                    restarts=(20, 60))
+
+
+def failover():
+    # the leader dies without releasing its lease, the standby takes over once it runs out
+    return Scenario("failover", "the leader dies during a scale-up from 2 to 6 instances, a warm standby takes over",
+                    ticks=240, capacity=2, conf={"lease_ttl": 20},
+                    events={10: lambda cloud: cloud.set_capacity(GROUP, 6)}, failover=12)
+
+
+def groups():
+    def grow(cloud):
+        for name in cloud.groups:
+            cloud.set_capacity(name, 6)
+
+    return Scenario("groups", "1 to 16 groups growing from 2 to 6 instances, in one supervisor or standalone",
+                    ticks=60, capacity=2, events={10: grow}, groups=(1, 2, 4, 8, 16))
+
+
+SCENARIOS = [scale_up, throttled, scale_down, scale_down_per_second, scale_down_async, ramp, ramp_forecast,
+             interruption, rebalance, market_crash, partial_crash, lb_flapping, fleet, mixed_fleet, pool_crash,
+             restart, failover, groups]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(scenario, verbose=False):
+    if scenario.groups:
+        return run_groups(scenario, verbose)
+
+    cloud = sim.Cloud(**scenario.cloud)
+    cloud.add_group(GROUP, scenario.capacity)
+    clock = cloud.clock
+
+    conf = dict(scenario.conf)
+    journal_file = None
+    if scenario.restarts:
+        journal_fd, journal_file = tempfile.mkstemp(suffix=".journal")
+        os.close(journal_fd)
+        conf["journal_file"] = journal_file
+
+    lease_file = None
+    if scenario.failover is not None:
+        lease_fd, lease_file = tempfile.mkstemp(suffix=".lease")
+        os.close(lease_fd)
+
+    conf_fd, conf_file = tempfile.mkstemp(suffix=".conf")
+    with os.fdopen(conf_fd, 'w') as f:
+        f.write(json.dumps(conf))
+
+    def new_manager(replica, metrics=None):
+        extra = {}
+        if lease_file:
+            extra["coordinator"] = lease.Coordinator(lease.SQLiteLeaseStore(lease_file), replica,
+                                                     conf.get("lease_ttl", 20))
+        return scenario.manager(GROUP, conf_file=conf_file, connections=cloud.connections(), metrics=metrics,
+                                **extra)
+
+    if not verbose:
+        logging.disable(logging.INFO)
+
+    samples = []
+    recoveries = []
+    disturbed_at = clock.now
+    failed_over_at = None
+    try:
+        with sim.patched_clock(clock, *CLOCKED):
+            manager = new_manager("primary")
+            manager.start()
+            standby = None
+            if lease_file:
+                standby = new_manager("standby", manager.metrics)
+                standby.start()
+            # interruption notices reach whichever manager is running, like an event queue would
+            cloud.subscribers.append(lambda notice: manager.reconciler.notify("notice", notice))
+
+            for tick in range(scenario.ticks):
+                if tick in scenario.restarts:
+                    manager.executor.close()
+                    calls = cloud.total_calls()
+                    manager = new_manager("primary", manager.metrics)
+                    manager.start()
+                    recoveries.append(cloud.total_calls() - calls)
+
+                if tick == scenario.failover:
+                    # dies without releasing its lease
+                    manager.executor.close()
+                    manager, standby = standby, None
+                    failed_over_at = clock.now
+
+                # what the coordinator threads do meanwhile, the leader first
+                for replica in (manager, standby):
+                    if replica is not None and replica.coordinator is not None:
+                        replica.coordinator.sync()
+
+                if tick in scenario.events:
+                    scenario.events[tick](cloud)
+                    disturbed_at = clock.now
+
+                cloud.step()
+                calls = cloud.total_calls()
+                if standby is not None:
+                    standby.tick()
+                    standby.next_delay()
+                started = clock.now
+                succeeded = manager.tick()
+
+                samples.append({"tick": tick,
+                                "time": started,
+                                "latency": clock.now - started,
+                                "calls": cloud.total_calls() - calls,
+                                "failed": not succeeded,
+                                "target": manager.target,
+                                "desired": manager.tapping_group.desired_capacity,
+                                "dead_in_lb": cloud.dead_in_lb(),
+                                "live": manager.units(manager.live.counts('kind')) +
+                                        manager.units(manager.emergency.counts('kind')),
+                                "managed": manager.managed_instances(),
+                                "leading": manager.leading()})
+                delay = manager.next_delay(succeeded)
+                if not manager.leading():
+                    # its coordinator would take the lease over and wake it up before that
+                    delay = min(delay, manager.coordinator.interval)
+                clock.advance(delay)
+            for replica in (manager, standby):
+                if replica is not None:
+                    replica.executor.close()
+    finally:
+        logging.disable(logging.NOTSET)
+        os.remove(conf_file)
+        if journal_file:
+            os.remove(journal_file)
+        if lease_file:
+            os.remove(lease_file)
+
+    result = summarize(scenario, cloud, samples, disturbed_at, manager.metrics)
+    result["recovery_calls"] = recoveries
+    result["takeover"] = takeover(samples, failed_over_at)
+    return result
+
+
+def run_groups(scenario, verbose=False):
+    """ API calls and objects held per group, for each number of groups, supervised and standalone. """
+    rows = []
+    if not verbose:
+        logging.disable(logging.INFO)
+    try:
+        for count in scenario.groups:
+            row = {"groups": count}
+            for supervised in (True, False):
+                calls, held = run_group_count(scenario, count, supervised)
+                row["supervised" if supervised else "standalone"] = {"calls": calls, "objects": held}
+            rows.append(row)
+    finally:
+        logging.disable(logging.NOTSET)
+    return {"scenario": scenario.name, "description": scenario.description, "ticks": scenario.ticks,
+            "groups": rows}
+
+
+def run_group_count(scenario, count, supervised):
+    """ Ticks count groups once per min_interval, returns the API calls per group and tick and the objects
+        (inventory snapshot entries and cached descriptors) held per group at the end.
+    """
+    cloud = sim.Cloud(**scenario.cloud)
+    names = ["%s-%s" % (GROUP, i) for i in range(count)]
+    for name in names:
+        cloud.add_group(name, scenario.capacity)
+
+    conf_fd, conf_file = tempfile.mkstemp(suffix=".conf")
+    with os.fdopen(conf_fd, 'w') as f:
+        f.write(json.dumps(scenario.conf))
+    try:
+        with sim.patched_clock(cloud.clock, *CLOCKED):
+            if supervised:
+                runner = supervisor.Supervisor(names, scenario.manager, conf=config.load(conf_file),
+                                               conf_file=conf_file, connections=cloud.connections())
+                managers = [x.manager for x in runner.groups]
+            else:
+                managers = [scenario.manager(x, conf_file=conf_file, connections=cloud.connections())
+                            for x in names]
+            for manager in managers:
+                manager.start()
+
+            for tick in range(scenario.ticks):
+                if tick in scenario.events:
+                    scenario.events[tick](cloud)
+                cloud.step()
+                for manager in managers:
+                    manager.tick()
+                cloud.clock.advance(managers[0].reconciler.min_interval)
+
+            if supervised:
+                runner.executor.close()
+                held = len(runner.cache) + sum([len(x.instances) for x in runner.inventories.values()])
+            else:
+                for manager in managers:
+                    manager.executor.close()
+                held = sum([len(x.cache) + len(x.inventory.instances) for x in managers])
+    finally:
+        os.remove(conf_file)
+    return float(cloud.total_calls()) / (count * scenario.ticks), float(held) / count
+
+
+def takeover(samples, since):
+    """ Seconds from since until the first tick of the new leader, and the API calls of that tick. """
+    if since is None:
+        return None
+    for sample in samples:
+        if sample["time"] >= since and sample["leading"]:
+            return sample["time"] - since, sample["calls"]
+    return None
+
+
+def convergence(samples, since):
+    """ Seconds from since until live capacity matched the target for good. """
+    converged_at = None
+    for sample in samples:
+        if sample["time"] < since:
+            continue
+        if sample["live"] == sample["target"]:
+            if converged_at is None:
+                converged_at = sample["time"]
+        else:
+            converged_at = None
+    return converged_at - since if converged_at is not None else None
+
+
+def shortfall(samples):
+    """ Unit-seconds during which live capacity was below the ASG's desired capacity. """
+    total = 0
+    for sample, following in zip(samples, samples[1:]):
+        total += max(0, sample["desired"] - sample["live"]) * (following["time"] - sample["time"])
+    return total
+
+
+def dead_time(samples):
+    """ Instance-seconds during which LBs kept members that were no longer running. """
+    total = 0
+    for sample, following in zip(samples, samples[1:]):
+        total += sample["dead_in_lb"] * (following["time"] - sample["time"])
+    return total
+
+
+def phases(registry):
+    """ Mean virtual seconds spent per tick in each save_money() phase. """
+    result = {}
+    for key, histogram in registry.histograms.get("tp_phase_seconds", {}).items():
+        result[dict(key)["phase"]] = histogram.sum / max(1, histogram.count)
+    return result
+
+
+def summarize(scenario, cloud, samples, disturbed_at, registry):
+    latencies = [x["latency"] for x in samples]
+    calls = [x["calls"] for x in samples]
+    top_calls = sorted(cloud.calls.items(), key=lambda x: -x[1])
+
+    return {"scenario": scenario.name,
+            "description": scenario.description,
+            "ticks": len(samples),
+            "failed_ticks": len([x for x in samples if x["failed"]]),
+            "latency_mean": sum(latencies) / len(latencies),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_max": max(latencies),
+            "calls_per_tick": float(sum(calls)) / len(calls),
+            "calls_per_tick_max": max(calls),
+            "calls_by_api": dict((k, float(v) / len(samples)) for k, v in top_calls),
+            "throttled": sum(cloud.throttled.values()),
+            "phases": phases(registry),
+            "convergence": convergence(samples, disturbed_at),
+            "shortfall": shortfall(samples),
+            "dead_time": dead_time(samples),
+            "on_demand": len(cloud.on_demand()),
+            "final_target": samples[-1]["target"],
+            "final_live": samples[-1]["live"]}
+
+
+def report_groups(result):
+    print "%(scenario)s: %(description)s" % result
+    print "  groups   api calls per group and tick   objects held per group"
+    print "           supervised   standalone          supervised   standalone"
+    for row in result["groups"]:
+        print "  %6d   %10.1f   %10.1f          %10.1f   %10.1f" % (
+            row["groups"], row["supervised"]["calls"], row["standalone"]["calls"],
+            row["supervised"]["objects"], row["standalone"]["objects"])
+
+
+def report(result):
+    if "groups" in result:
+        return report_groups(result)
+    convergence_time = result["convergence"]
+    print "%(scenario)s: %(description)s" % result
+    print "  ticks: %(ticks)s (%(failed_ticks)s failed)" % result
+    print "  loop latency: mean %.1fs p50 %.1fs p95 %.1fs max %.1fs" % (
+        result["latency_mean"], result["latency_p50"], result["latency_p95"], result["latency_max"])
+    print "  api calls per tick: mean %.1f max %s, throttled %s" % (
+        result["calls_per_tick"], result["calls_per_tick_max"], result["throttled"])
+    print "  convergence to target: %s (target %s, live %s)" % (
+        "%ss" % int(convergence_time) if convergence_time is not None else "never",
+        result["final_target"], result["final_live"])
+    print "  capacity short of the ASG: %d unit-seconds" % result["shortfall"]
+    print "  dead instances kept in a LB: %d instance-seconds" % result["dead_time"]
+    print "  on-demand instances launched: %d" % result["on_demand"]
+    if result.get("recovery_calls"):
+        print "  api calls to recover from the journal: %s" % ", ".join(map(str, result["recovery_calls"]))
+    if result.get("takeover"):
+        print "  takeover by the standby: %ds after the leader died, %s api calls on its first tick" % (
+            result["takeover"])
+    print "  phases: " + ", ".join(["%s %.2fs" % x for x in sorted(result["phases"].items(), key=lambda x: -x[1])])
+    for api, count in sorted(result["calls_by_api"].items(), key=lambda x: -x[1])[:5]:
+        print "    %-40s %.2f/tick" % (api, count)
+
+
+if __name__ == '__main__':
+    import getopt
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:jv", ["scenario=", "json", "verbose"])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(2)
+
+    names = None
+    as_json = False
+    verbose = False
+    for o, a in opts:
+        if o in ("-s", "--scenario"):
+            names = a.split(",")
+        elif o in ("-j", "--json"):
+            as_json = True
+        elif o in ("-v", "--verbose"):
+            verbose = True
+
+    for factory in SCENARIOS:
+        scenario = factory()
+        if names and scenario.name not in names:
+            continue
+        result = run(scenario, verbose)
+        if as_json:
+            print json.dumps(result)
+        else:
+            report(result)
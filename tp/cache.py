@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    """ Small thread safe key/value cache with per entry expiration.
+
+        Values are produced by a loader callable on a miss, so callers never
+        have to check for presence first. Keys are usually tuples that embed
+        whatever identifies the cached object (region, names, ids), which
+        makes a changed identity an automatic miss.
+    """
+
+    def __init__(self, default_ttl=300, clock=None):
+        self.default_ttl = default_ttl
+        self.clock = clock or time.time
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, loader, ttl=None):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+
+        value = loader()
+        if ttl is None:
+            ttl = self.default_ttl
+
+        with self._lock:
+            self._entries[key] = (value, now + ttl)
+        return value
+
+    def invalidate(self, key=None):
+        """ Drops one key, or everything when no key is given. """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,112 @@
+""" How much capacity an instance type provides, relative to another type.
+
+    Sizes follow the EC2 normalization factors (a large is twice a medium,
+    an xlarge twice a large and so on), which is what AWS itself uses to
+    compare reserved instances inside a family. They say nothing about two
+    families, an m2.4xlarge and a c1.xlarge are simply one instance each.
+
+    A CapacityModel measures every instance in capacity units, one unit
+    being an instance of the AutoScaling group's type. Weights come from
+    instance_weights when configured, otherwise from the normalization
+    factors within a family or from the vCPUs and memory of each type in
+    instance_types.json (see capacity_basis).
+"""
+
+import math
+import os
+import simplejson as json
+
+BASES = ("size", "vcpu", "memory", "balanced")
+TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance_types.json")
+
+SIZE_UNITS = {
+    "nano": 0.25,
+    "micro": 0.5,
+    "small": 1,
+    "medium": 2,
+    "large": 4,
+    "xlarge": 8,
+}
+
+
+def size_units(instance_type):
+    """ Normalized units of an instance type, e.g. 8 for m3.xlarge and 32 for c4.4xlarge. """
+    if not instance_type or "." not in instance_type:
+        return None
+
+    size = instance_type.split(".", 1)[1]
+    if size in SIZE_UNITS:
+        return SIZE_UNITS[size]
+
+    # 2xlarge, 4xlarge, 10xlarge...
+    if size.endswith("xlarge"):
+        try:
+            return int(size[:-len("xlarge")]) * SIZE_UNITS["xlarge"]
+        except ValueError:
+            return None
+    return None
+
+
+def family(instance_type):
+    return instance_type.split(".", 1)[0] if instance_type else None
+
+
+def relative_weight(instance_type, reference_type):
+    """ Capacity of instance_type measured in reference_type instances, 1 across families or when unknown. """
+    if not reference_type or instance_type == reference_type:
+        return 1.0
+    if family(instance_type) != family(reference_type):
+        return 1.0
+    units = size_units(instance_type)
+    reference = size_units(reference_type)
+    if not units or not reference:
+        return 1.0
+    return float(units) / reference
+
+
+def load_table(path=TABLE_FILE):
+    """ {instance type: (vCPUs, memory in GiB)} from the table shipped with tiopatinhas. """
+    with open(path) as f:
+        table = json.loads(f.read())
+    return dict([(k, tuple(v)) for k, v in table.items() if not k.startswith("_")])
+
+
+class CapacityModel(object):
+    """ Capacity units of instance types, in instances of a reference type.
+
+        basis is how types are compared when instance_weights doesn't say:
+        "size" uses the normalization factors within a family and counts
+        an instance of another family as one unit, "vcpu" and "memory" the
+        table, "balanced" the scarcer of vCPUs and memory. Types missing
+        from the table fall back to the normalization factors.
+    """
+
+    def __init__(self, weights=None, basis="size", table=None):
+        self.weights = weights or {}
+        self.basis = basis
+        self.table = table if table is not None or basis == "size" else load_table()
+        self._cache = {}
+
+    def weight(self, instance_type, reference_type):
+        key = (instance_type, reference_type)
+        if key not in self._cache:
+            self._cache[key] = self._weight(instance_type, reference_type)
+        return self._cache[key]
+
+    def _weight(self, instance_type, reference_type):
+        if instance_type in self.weights:
+            return float(self.weights[instance_type])
+        if self.basis != "size" and instance_type in self.table and reference_type in self.table:
+            vcpus, memory = self.table[instance_type]
+            reference_vcpus, reference_memory = self.table[reference_type]
+            ratios = {"vcpu": float(vcpus) / reference_vcpus, "memory": float(memory) / reference_memory}
+            if self.basis == "balanced":
+                return min(ratios.values())
+            return ratios[self.basis]
+        return relative_weight(instance_type, reference_type)
+
+    def instances(self, units, instance_type, reference_type):
+        """ How many instances of instance_type make up units of capacity, rounded up. """
+        if units <= 0:
+            return 0
+        return int(math.ceil(round(units / self.weight(instance_type, reference_type), 6)))
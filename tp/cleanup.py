@@ -0,0 +1,48 @@
+""" Taking down what a cycle retires, all at once at the end of the cycle.
+
+    Demoted spot instances, unhealthy instances past their grace period and
+    emergency instances past their billing boundary are collected in a
+    Cleanup while save_money() runs instead of being taken down one after
+    the other. clean_up(), the last phase of the cycle, then deregisters
+    all of them from every LB in one call per LB, waits for the LBs to
+    drain them once (if any of them was still serving) and cancels their
+    spot requests and terminates them with one call each, at the same time.
+"""
+
+
+class Cleanup(object):
+    def __init__(self):
+        self.instance_ids = []
+        self.request_ids = []
+        # whether any of the instances was serving and must be drained from the LBs first
+        self.drain = False
+        self._seen = set()
+
+    def add(self, instance_ids=(), request_ids=(), drain=False):
+        for instance_id in instance_ids:
+            if instance_id not in self._seen:
+                self._seen.add(instance_id)
+                self.instance_ids.append(instance_id)
+        for request_id in request_ids:
+            if request_id not in self._seen:
+                self._seen.add(request_id)
+                self.request_ids.append(request_id)
+        self.drain = self.drain or (drain and len(instance_ids) > 0)
+
+    def take(self):
+        """ What was collected so far, as (instance ids, request ids, drain), leaving the cleanup empty. """
+        batch = (self.instance_ids, self.request_ids, self.drain)
+        self.clear()
+        return batch
+
+    def clear(self):
+        self.instance_ids = []
+        self.request_ids = []
+        self.drain = False
+        self._seen = set()
+
+    def __len__(self):
+        return len(self.instance_ids) + len(self.request_ids)
+
+    def __repr__(self):
+        return "<Cleanup instances:%s requests:%s drain:%s>" % (self.instance_ids, self.request_ids, self.drain)
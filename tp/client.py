@@ -0,0 +1,226 @@
+""" Rate limited, retrying and coalescing access to the AWS APIs.
+
+    Connections are wrapped with throttled() so every call first takes a
+    token from the bucket of its API family (EC2 describe calls, EC2
+    mutating calls, ELB, AutoScaling...), one bucket per region shared by
+    every group of the process. Throttling errors are retried with capped
+    exponential backoff and full jitter, and they halve the refill rate of
+    the bucket, which then creeps back up with every successful call.
+    Identical describe calls in flight at the same time, or made again
+    within coalesce_window seconds, share a single request.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from metrics import THROTTLING_CODES
+from metrics import rebind
+
+logger = logging.getLogger("client")
+
+DESCRIBE = "describe"
+MUTATE = "mutate"
+
+# (calls per second, burst) per (service, family), close to what AWS grants an account by default
+DEFAULT_RATES = {
+    ("ec2", DESCRIBE): (20, 100),
+    ("ec2", MUTATE): (5, 50),
+    ("elb", DESCRIBE): (10, 40),
+    ("elb", MUTATE): (5, 20),
+    ("autoscale", DESCRIBE): (10, 40),
+    ("autoscale", MUTATE): (5, 20),
+}
+
+
+def family_of(name):
+    if name.startswith(("get_", "describe_")):
+        return DESCRIBE
+    return MUTATE
+
+
+def freeze(value):
+    """ Hashable, order independent version of call arguments. """
+    if isinstance(value, dict):
+        return tuple(sorted([(k, freeze(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple, set)):
+        return tuple([freeze(x) for x in value])
+    return value
+
+
+class TokenBucket(object):
+    """ Refills rate tokens per second up to burst, acquire() waits for one. """
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """ Takes a token, waiting for it if the bucket is empty. Returns the wait.
+
+            Tokens can be borrowed, callers queue up by waiting for the debt
+            they leave behind to be refilled.
+        """
+        with self._lock:
+            self._refill(time.time())
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.rate)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.max_rate / 20, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class RateLimiter(object):
+    """ Token buckets and retry policy shared by every throttled connection of a process. """
+
+    def __init__(self, rates=None, retries=5, backoff_base=0.5, backoff_cap=20, coalesce_window=1.0):
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.coalesce_window = coalesce_window
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, region, service, family):
+        key = (region, service, family)
+        with self._lock:
+            if key not in self.buckets:
+                rate, burst = self.rates.get((service, family), (10, 20))
+                self.buckets[key] = TokenBucket(rate, burst)
+            return self.buckets[key]
+
+    def backoff(self, attempt):
+        """ Full jitter: anything up to the capped exponential delay. """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+
+def rate_limiter(conf):
+    """ Builds a RateLimiter from api_rates, api_retries, api_backoff_base, api_backoff_cap and coalesce_window. """
+    rates = {}
+    for key, (rate, burst) in conf.api_rates.items():
+        service, family = key.split(".", 1)
+        rates[(service, family)] = (rate, burst)
+    return RateLimiter(rates, conf.api_retries, conf.api_backoff_base, conf.api_backoff_cap, conf.coalesce_window)
+
+
+class InFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished_at = None
+        self.value = None
+        self.error = None
+
+
+class ThrottledConnection(object):
+    """ Proxy around a boto connection applying a RateLimiter to every call.
+
+        Like InstrumentedConnection, boto objects returned by the connection
+        are re-pointed to the proxy so their own calls are throttled too.
+    """
+
+    def __init__(self, connection, limiter, service, region):
+        self._connection = connection
+        self._limiter = limiter
+        self._service = service
+        self._region = region
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        family = family_of(name)
+
+        def call(*args, **kwargs):
+            if family == DESCRIBE:
+                return self._coalesced(name, attribute, args, kwargs)
+            # whatever was described before a change is stale after it
+            with self._lock:
+                self._calls.clear()
+            return self._call(name, family, attribute, args, kwargs)
+
+        return call
+
+    def _coalesced(self, name, attribute, args, kwargs):
+        key = (name, freeze(args), freeze(kwargs))
+        with self._lock:
+            entry = self._calls.get(key)
+            fresh = entry is not None and (not entry.done.is_set() or
+                                           time.time() - entry.finished_at < self._limiter.coalesce_window)
+            owner = not fresh
+            if owner:
+                self._prune()
+                entry = self._calls[key] = InFlight()
+
+        if owner:
+            try:
+                entry.value = self._call(name, DESCRIBE, attribute, args, kwargs)
+            except Exception, e:
+                entry.error = e
+                with self._lock:
+                    # failures are not shared with later callers
+                    if self._calls.get(key) is entry:
+                        del self._calls[key]
+            entry.finished_at = time.time()
+            entry.done.set()
+        else:
+            entry.done.wait()
+
+        if entry.error is not None:
+            raise entry.error
+        return entry.value
+
+    def _prune(self):
+        now = time.time()
+        for key, entry in self._calls.items():
+            if entry.done.is_set() and now - entry.finished_at >= self._limiter.coalesce_window:
+                del self._calls[key]
+
+    def _call(self, name, family, attribute, args, kwargs):
+        bucket = self._limiter.bucket(self._region, self._service, family)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception, e:
+                code = getattr(e, 'error_code', None)
+                if code not in THROTTLING_CODES or attempt >= self._limiter.retries:
+                    raise
+                bucket.throttled()
+                delay = self._limiter.backoff(attempt)
+                logger.debug("%s.%s throttled (%s), retrying in %.2fs", self._service, name, code, delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            bucket.succeeded()
+            return rebind(result, self._connection, self)
+
+
+def throttled(connection, limiter, service, region):
+    if limiter is None or isinstance(connection, ThrottledConnection):
+        return connection
+    return ThrottledConnection(connection, limiter, service, region)
@@ -0,0 +1,356 @@
+""" tp.conf, checked once and compiled.
+
+    Every property tiopatinhas understands is described in SCHEMA with its
+    type, its default and what values make sense. read_conf() checks a
+    whole file against it up front, reporting every problem at once (a
+    misspelled property included) instead of failing on the first cycle
+    that happens to read the wrong value, and compiles it into a Config:
+    a read-only mapping with the defaults filled in whose properties are
+    attributes, so the loop doesn't look them up by name and default.
+
+    Keys starting with "_" are left alone and can be used as comments.
+
+    Usage: python config.py [tp.conf ...]
+"""
+
+import copy
+import difflib
+import sys
+import simplejson as json
+from collections import Mapping
+
+
+class ConfigError(ValueError):
+    """ Everything wrong with a configuration, one problem per item of problems. """
+
+    def __init__(self, problems, path=None):
+        ValueError.__init__(self, "%s: %s" % (path or "configuration", "; ".join(problems)))
+        self.problems = problems
+        self.path = path
+
+
+def _number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _price(value):
+    # prices are usually quoted, as in the template
+    if isinstance(value, basestring):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return _number(value)
+
+
+def _port(value):
+    # read with int(), so "8125" has always worked as well
+    if isinstance(value, basestring):
+        return value.isdigit() and 0 < int(value) < 65536
+    return _integer(value) and 0 < value < 65536
+
+
+def _group(value):
+    return isinstance(value, basestring) or (isinstance(value, dict) and isinstance(value.get("name"), basestring))
+
+
+def _rate(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2 and all(_number(x) for x in value)
+
+
+KINDS = {
+    "number": _number,
+    "integer": _integer,
+    "string": lambda x: isinstance(x, basestring),
+    "boolean": lambda x: isinstance(x, bool),
+    "map": lambda x: isinstance(x, dict),
+    "list": lambda x: isinstance(x, (list, tuple)),
+    "port": _port,
+}
+
+
+def positive(value):
+    if value <= 0:
+        return "must be greater than 0"
+
+
+def not_negative(value):
+    if value < 0:
+        return "can't be negative"
+
+
+def fraction(value):
+    if not 0 <= value <= 1:
+        return "must be between 0 and 1"
+
+
+def one_of(*choices):
+    def check(value):
+        if value not in choices:
+            return "must be one of %s" % ", ".join(map(repr, choices))
+    return check
+
+
+def each(test, description, values=False):
+    """ Checks every item of a list, or every value of a map. """
+    def check(value):
+        items = value.values() if values else value
+        wrong = [x for x in items if not test(x)]
+        if wrong:
+            return "%r is not %s" % (wrong[0], description)
+    return check
+
+
+class Option(object):
+    __slots__ = ("name", "kind", "default", "check", "required")
+
+    def __init__(self, name, kind, default=None, check=None, required=False):
+        self.name = name
+        self.kind = kind
+        self.default = default
+        self.check = check
+        self.required = required
+
+    def validate(self, value):
+        """ What is wrong with value, None if nothing is. """
+        if value is None:
+            return None if self.default is None and not self.required else "can't be null"
+        if not KINDS[self.kind](value):
+            return "must be a %s, not %r" % (self.kind, value)
+        if self.check is not None:
+            return self.check(value)
+
+
+SCHEMA = [
+    # mandatory
+    Option("max_price", "map", {"c1.xlarge": "0.750"}, each(_price, "a price", values=True), required=True),
+    Option("max_candidates", "integer", 6, positive, required=True),
+    Option("instance_name", "string", "instance", required=True),
+    Option("region", "string", "us-east-1", required=True),
+    Option("placement", "string", "us-east-1c", required=True),
+    # instances and bids
+    Option("spot_type", "string", "c1.xlarge"),
+    Option("emergency_type", "string", "c1.xlarge"),
+    Option("subnet_id", "string"),
+    Option("instance_profile_name", "string"),
+    Option("monitoring_enabled", "boolean", False),
+    Option("tags", "map", {}),
+    Option("user_data_file", "string"),
+    # negative thresholds turn the cool downs off
+    Option("cool_down_threshold", "number", 360),
+    Option("bid_threshold", "number", 300),
+    Option("billing", "string", "hourly", one_of("hourly", "per-second")),
+    Option("pending_timeout", "number", 900, positive),
+    # cycles and caches
+    Option("min_interval", "number", 10, positive),
+    Option("max_interval", "number", 60, positive),
+    Option("backoff", "number", 2.0, positive),
+    Option("capacity_cache_ttl", "number", 15, not_negative),
+    Option("descriptor_cache_ttl", "number", 3600, not_negative),
+    Option("lb_workers", "integer", 8, positive),
+    Option("lb_timeout", "number", 10, positive),
+    # bid placement
+    Option("bid_placement", "boolean", False),
+    Option("availability_zones", "list", None, each(lambda x: isinstance(x, basestring), "a zone")),
+    Option("subnets", "map", {}),
+    Option("max_pool_share", "number", 0.5, fraction),
+    Option("price_history_hours", "number", 24, positive),
+    Option("price_history_max_age", "number", 300, not_negative),
+    Option("price_history_file", "string"),
+    Option("product_description", "string", "Linux/UNIX"),
+    # capacity units
+    Option("instance_weights", "map", {}, each(lambda x: _number(x) and x > 0, "a positive weight", values=True)),
+    Option("capacity_basis", "string", "size", one_of("size", "vcpu", "memory", "balanced")),
+    # journal
+    Option("journal_file", "string"),
+    Option("journal_snapshot_every", "integer", 500, positive),
+    # interruptions and market crashes
+    Option("interruption_replacement", "string", "spot", one_of("spot", "on-demand", "none")),
+    Option("notice_file", "string"),
+    Option("notice_port", "port"),
+    Option("notice_url", "string"),
+    Option("notice_poll_interval", "number", 5, positive),
+    Option("crash_window", "number", 300, positive),
+    Option("crash_threshold", "number", 0.3, fraction),
+    Option("crash_spot_grace", "number", 120, not_negative),
+    Option("emergency_batch_size", "integer", 10, positive),
+    # forecast
+    Option("forecast", "boolean", False),
+    Option("forecast_horizon", "number", 600, not_negative),
+    Option("forecast_resolution", "number", 60, positive),
+    Option("forecast_seasons", "list", [86400, 604800], each(lambda x: _number(x) and x > 0, "a season")),
+    Option("forecast_slope_window", "number", 900, positive),
+    Option("forecast_hold", "number", 900, not_negative),
+    Option("forecast_file", "string"),
+    # metrics
+    Option("metrics_port", "port"),
+    Option("metrics_host", "string", "127.0.0.1"),
+    Option("statsd_host", "string"),
+    Option("statsd_port", "port", 8125),
+    Option("statsd_prefix", "string", "tp"),
+    # AWS API
+    Option("api_rates", "map", {}, each(_rate, "a [rate, burst] pair", values=True)),
+    Option("api_retries", "integer", 5, not_negative),
+    Option("api_backoff_base", "number", 0.5, positive),
+    Option("api_backoff_cap", "number", 20, positive),
+    Option("coalesce_window", "number", 1.0, not_negative),
+    # supervisor
+    Option("groups", "list", [], each(_group, "a group name or a map with a name")),
+    Option("workers", "integer", 4, positive),
+    Option("tick_jitter", "number", 0.2, fraction),
+    Option("inventory_max_age", "number", 10, not_negative),
+    Option("weight_factor", "number", 1.0, positive),
+    # async and dry runs
+    Option("drain_seconds", "number", 5, not_negative),
+    Option("plan_file", "string"),
+    # tracing and profiling
+    Option("trace_file", "string"),
+    Option("trace_max_bytes", "integer", 10485760, not_negative),
+    Option("trace_backups", "integer", 5, not_negative),
+    Option("profile_file", "string"),
+    # replicas
+    Option("coordination", "string", "none", one_of("none", "leader", "shard")),
+    Option("coordination_backend", "string", "sqlite", one_of("sqlite", "file")),
+    Option("coordination_path", "string", "tp.lease"),
+    Option("lease_ttl", "number", 20, positive),
+    Option("replica_id", "string"),
+]
+
+OPTIONS = dict([(x.name, x) for x in SCHEMA])
+
+# what a map in "groups" can hold, the rest of the group comes from the top level properties
+GROUP_OPTIONS = dict([(x.name, x) for x in [
+    Option("name", "string"),
+    Option("region", "string"),
+    Option("interval", "number", check=positive),
+    OPTIONS["weight_factor"],
+]])
+
+
+class Config(Mapping):
+    """ A checked configuration: read-only, defaults filled in, properties as attributes. """
+    __slots__ = ("_values", "path")
+
+    def __init__(self, values, path=None):
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "path", path)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("configuration is read-only, can't set %s" % name)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "<Config %s>" % (self.path or "")
+
+
+def problems(raw):
+    """ Everything wrong with a parsed configuration, as messages naming the property. """
+    if not isinstance(raw, dict):
+        return ["must be a JSON object, not %s" % type(raw).__name__]
+
+    found = []
+    for key in sorted(raw):
+        if key.startswith("_"):
+            continue
+        option = OPTIONS.get(key)
+        if option is None:
+            close = difflib.get_close_matches(key, OPTIONS, 1)
+            found.append("unknown property %s%s" % (key, " (did you mean %s?)" % close[0] if close else ""))
+            continue
+        problem = option.validate(raw[key])
+        if problem:
+            found.append("%s %s" % (key, problem))
+
+    for option in SCHEMA:
+        if option.required and option.name not in raw:
+            found.append("%s is mandatory" % option.name)
+
+    if isinstance(raw.get("groups"), list):
+        for group in raw["groups"]:
+            if isinstance(group, dict):
+                found.extend(group_problems(group))
+
+    if _number(raw.get("min_interval")) and _number(raw.get("max_interval")) and \
+            raw["min_interval"] > raw["max_interval"]:
+        found.append("min_interval can't be greater than max_interval")
+    return found
+
+
+def group_problems(group):
+    """ What's wrong with a map of the "groups" list. """
+    found = []
+    label = "groups item %s" % group.get("name")
+    for key in sorted(group):
+        option = GROUP_OPTIONS.get(key)
+        if option is None:
+            close = difflib.get_close_matches(key, GROUP_OPTIONS, 1)
+            found.append("%s: unknown property %s%s" % (label, key, " (did you mean %s?)" % close[0] if close else ""))
+            continue
+        problem = option.validate(group[key])
+        if problem:
+            found.append("%s: %s %s" % (label, key, problem))
+    return found
+
+
+def compile_conf(raw, path=None):
+    """ Checks a parsed configuration and compiles it into a Config, raises ConfigError. """
+    found = problems(raw)
+    if found:
+        raise ConfigError(found, path)
+    values = dict([(x.name, copy.deepcopy(x.default)) for x in SCHEMA])
+    values.update(copy.deepcopy(raw))
+    return Config(values, path)
+
+
+def load(path):
+    """ Reads, checks and compiles a configuration file, raises IOError or ConfigError. """
+    with open(path, 'r') as f:
+        text = f.read()
+    try:
+        raw = json.loads(text)
+    except ValueError, e:
+        raise ConfigError(["is not valid JSON: %s" % e], path)
+    return compile_conf(raw, path)
+
+
+def check(path):
+    """ The problems of a configuration file, an empty list if there are none. """
+    try:
+        load(path)
+    except IOError, e:
+        return ["can't be read: %s" % e.strerror]
+    except ConfigError, e:
+        return e.problems
+    return []
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or ["tp.conf"]
+    failed = False
+    for path in paths:
+        found = check(path)
+        for problem in found:
+            print "%s: %s" % (path, problem)
+        if not found:
+            print "%s: OK" % path
+        failed = failed or bool(found)
+    sys.exit(1 if failed else 0)
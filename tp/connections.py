@@ -0,0 +1,83 @@
+import threading
+
+from metrics import rebind
+
+
+def connect_ec2(region):
+    import boto.ec2
+    return boto.ec2.connect_to_region(region)
+
+
+def connect_elb(region):
+    import boto.ec2.elb
+    return boto.ec2.elb.connect_to_region(region)
+
+
+def connect_autoscale(region):
+    import boto.ec2.autoscale
+    return boto.ec2.autoscale.connect_to_region(region)
+
+
+class LazyConnection(object):
+    """ Stands for a boto connection that is only made on its first call.
+
+        boto itself is imported then too, so starting up (or checking the
+        configuration) costs neither the import nor a connection. Like the
+        other proxies, boto objects returned by a call are re-pointed to it.
+    """
+
+    def __init__(self, connect, region):
+        self._connect = connect
+        self._region = region
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._connect(self._region)
+            return self._connection
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        connection = self.connection()
+        attribute = getattr(connection, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return rebind(attribute(*args, **kwargs), connection, self)
+
+        return call
+
+    def __repr__(self):
+        return "<LazyConnection %s %s>" % (self._connect.__name__, self._region)
+
+
+class Connections(object):
+    """ Per region boto connections, created on first use and shared.
+
+        A single instance can be handed to every TPManager of a process so
+        that dozens of groups in the same region reuse the same connections.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def _get(self, service, region, connect):
+        key = (service, region)
+        with self._lock:
+            if key not in self._connections:
+                self._connections[key] = LazyConnection(connect, region)
+            return self._connections[key]
+
+    def ec2(self, region):
+        return self._get('ec2', region, connect_ec2)
+
+    def elb(self, region):
+        return self._get('elb', region, connect_elb)
+
+    def autoscale(self, region):
+        return self._get('autoscale', region, connect_autoscale)
@@ -0,0 +1,59 @@
+""" Graduated response to spot market crashes.
+
+    The capacity serving traffic (live spot, emergency and launching
+    on-demand instances) is sampled every cycle. A crash is when it fell,
+    within window seconds, short of the target by at least threshold of the
+    target: a ramp up never looks like one, since nothing was lost, and
+    neither does a scale down, since the target moved first.
+
+    During a crash the lost capacity is bid for again right away in the
+    pools that were spared. Whatever spot didn't bring back after grace
+    seconds is bought on-demand, and nothing serving at all is bought
+    on-demand at once. The crash is over once the target is met again.
+"""
+
+import logging
+from collections import deque
+
+logger = logging.getLogger("crash")
+
+
+class CrashDetector(object):
+    def __init__(self, window=300, threshold=0.3, grace=120):
+        self.window = window
+        self.threshold = threshold
+        self.grace = grace
+        self.samples = deque()
+        self.since = None
+        self.peak = 0
+        # (instance type, zone) pools capacity was lost in during the crash
+        self.pools = set()
+
+    def lost(self, pools):
+        self.pools.update(pools)
+
+    def update(self, now, serving, target):
+        """ Records what serves now, returns whether a crash is going on. """
+        self.samples.append((now, serving))
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        peak = max([x[1] for x in self.samples])
+
+        if self.since is None:
+            lost = min(target, peak) - serving
+            if target and lost >= max(1, self.threshold * target):
+                logger.warn("crash: serving %s of %s, %s lost in the last %ss", serving, target, lost, self.window)
+                self.since = now
+                self.peak = peak
+        elif serving >= min(target, self.peak):
+            logger.info("crash: over after %ss, serving %s of %s", int(now - self.since), serving, target)
+            self.since = None
+
+        if self.since is None:
+            # pools only matter while a crash goes on
+            self.pools = set()
+        return self.since is not None
+
+    def escalate(self, now, serving):
+        """ Whether the rest of the gap should be bought on-demand. """
+        return self.since is not None and (serving == 0 or now - self.since >= self.grace)
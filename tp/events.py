@@ -0,0 +1,219 @@
+import logging
+import os
+import socket
+import threading
+import time
+import urllib2
+import simplejson as json
+
+logger = logging.getLogger("events")
+
+# events coming from outside a cycle, the only ones that bring the next cycle forward
+WAKING = ("notice", "lease")
+
+
+class Reconciler(object):
+    """ Decides when the next save_money() cycle should run.
+
+        Anything relevant that happens (desired capacity changes, spot
+        request status changes, LB health transitions, actions taken by
+        TP itself or notices coming from an event source) is reported with
+        notify(). A busy or eventful cycle is followed by another one after
+        min_interval seconds; quiet cycles back off up to max_interval.
+        Events reported while waiting cut the wait short, and so do notices
+        and lease changes reported while a cycle runs: the next cycle is due
+        right away instead of being missed until the scheduled one.
+    """
+
+    def __init__(self, min_interval=10, max_interval=60, backoff=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        self.listeners = []
+        self.notices = []
+
+        self._events = []
+        # how many WAKING events were reported, and how many of them the current cycle has seen
+        self._sequence = 0
+        self._seen = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def notify(self, kind, detail=None):
+        with self._lock:
+            self._events.append((time.time(), kind, detail))
+            if kind == "notice":
+                self.notices.append(detail)
+            if kind in WAKING:
+                self._sequence += 1
+        self._wakeup.set()
+        for listener in self.listeners:
+            listener(kind, detail)
+
+    def pending_events(self):
+        with self._lock:
+            return list(self._events)
+
+    def take_notices(self):
+        with self._lock:
+            notices, self.notices = self.notices, []
+            self._seen = self._sequence
+        return notices
+
+    def settle(self, busy=False):
+        """ Closes a cycle and returns how long to wait before the next one. """
+        with self._lock:
+            events, self._events = self._events, []
+            # what came in after the cycle took its notices is left for the next one, which is due now
+            missed = self._sequence != self._seen
+            self._seen = self._sequence
+            if not missed:
+                self._wakeup.clear()
+
+        if busy or events:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+
+        if events:
+            logger.debug("cycle events: %s", ", ".join(sorted(set([x[1] for x in events]))))
+        if missed:
+            return 0
+        return self.interval
+
+    def wait(self, timeout):
+        """ Sleeps up to timeout seconds, returns True if woken up by an event. """
+        woken = self._wakeup.wait(timeout)
+        return bool(woken)
+
+
+class NoticeSource(threading.Thread):
+    """ Base class for threads feeding external notices to reconcilers. """
+
+    def __init__(self, reconcilers=None):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self.reconcilers = list(reconcilers or [])
+        self.stopped = threading.Event()
+
+    def attach(self, reconciler):
+        self.reconcilers.append(reconciler)
+
+    def publish(self, raw):
+        raw = raw.strip()
+        if not raw:
+            return
+        try:
+            notice = json.loads(raw)
+        except ValueError:
+            # a bare instance id is a notice too
+            notice = {"instance_id": raw}
+        if not isinstance(notice, dict):
+            notice = {"instance_id": str(notice)}
+
+        logger.info("notice received: %s", notice)
+        for reconciler in self.reconcilers:
+            reconciler.notify("notice", notice)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FileNoticeSource(NoticeSource):
+    """ Follows a local file, every appended line is a notice (JSON or an instance id). """
+
+    def __init__(self, path, reconcilers=None, poll_interval=1):
+        NoticeSource.__init__(self, reconcilers)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                size = os.path.getsize(self.path)
+                if size < self.offset:
+                    # truncated or rotated
+                    self.offset = 0
+                if size > self.offset:
+                    with open(self.path, 'r') as f:
+                        f.seek(self.offset)
+                        data = f.read()
+                    # only consume complete lines
+                    consumed = data.rfind("\n") + 1
+                    self.offset += consumed
+                    for line in data[:consumed].splitlines():
+                        self.publish(line)
+            except OSError:
+                pass
+            self.stopped.wait(self.poll_interval)
+
+
+class SocketNoticeSource(NoticeSource):
+    """ Listens on a local UDP port, every datagram is a notice (JSON or an instance id). """
+
+    def __init__(self, port, host="127.0.0.1", reconcilers=None):
+        NoticeSource.__init__(self, reconcilers)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(1)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            for line in data.splitlines():
+                self.publish(line)
+        self.sock.close()
+
+
+class HttpNoticeSource(NoticeSource):
+    """ Polls a URL serving a JSON notice or a list of them, e.g. a stand-in for the instance metadata.
+
+        The same notice is only published once, however many times it is served.
+    """
+
+    def __init__(self, url, reconcilers=None, poll_interval=5, timeout=2):
+        NoticeSource.__init__(self, reconcilers)
+        self.url = url
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.seen = set()
+
+    def poll(self):
+        try:
+            data = json.loads(urllib2.urlopen(self.url, timeout=self.timeout).read() or "[]")
+        except (urllib2.URLError, IOError, ValueError), e:
+            logger.debug("could not poll %s: %s", self.url, e)
+            return
+        if not isinstance(data, list):
+            data = [data]
+
+        served = set()
+        for notice in data:
+            raw = json.dumps(notice, sort_keys=True)
+            served.add(raw)
+            if raw not in self.seen:
+                self.publish(raw)
+        # what is no longer served can be published again if it comes back
+        self.seen = served
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.poll_interval)
+
+
+def notice_sources(conf, reconcilers=None):
+    """ Builds the sources configured by notice_file, notice_port and notice_url. """
+    sources = []
+    if conf.notice_file:
+        sources.append(FileNoticeSource(conf.notice_file, reconcilers))
+    if conf.notice_port:
+        sources.append(SocketNoticeSource(int(conf.notice_port), reconcilers=reconcilers))
+    if conf.notice_url:
+        sources.append(HttpNoticeSource(conf.notice_url, reconcilers, conf.notice_poll_interval))
+    return sources
@@ -0,0 +1,94 @@
+""" Id keyed maps of the fleet with secondary indexes.
+
+    TPManager keeps its spot requests, live spot instances and emergency
+    instances in Registry maps. Besides the usual id lookups each registry
+    groups its members by the value of some functions of them (e.g. the
+    state of a spot request, or (state, instance type)), so questions like
+    "which bids are open" or "how much capacity of each type is live" are
+    answered from the groups instead of a scan of the fleet, and adding,
+    replacing or removing a member is O(1).
+
+    Members are expected to be replaced, not changed in place: an index
+    is only updated when a member is set again.
+"""
+
+from collections import defaultdict
+
+
+class Registry(dict):
+    __slots__ = ("keys_of", "groups", "_indexed")
+
+    def __init__(self, **indexes):
+        dict.__init__(self)
+        # index name -> function of a member
+        self.keys_of = indexes
+        # index name -> index key -> {id: member}
+        self.groups = dict([(x, defaultdict(dict)) for x in indexes])
+        # id -> {index name: index key} the member was filed under
+        self._indexed = {}
+
+    def _file(self, key, value):
+        filed = {}
+        for name, key_of in self.keys_of.items():
+            index_key = key_of(value)
+            self.groups[name][index_key][key] = value
+            filed[name] = index_key
+        self._indexed[key] = filed
+
+    def _unfile(self, key):
+        for name, index_key in self._indexed.pop(key, {}).items():
+            group = self.groups[name][index_key]
+            group.pop(key, None)
+            if not group:
+                del self.groups[name][index_key]
+
+    def where(self, name, *index_keys):
+        """ Members filed under any of index_keys in the name index. """
+        groups = self.groups[name]
+        if len(index_keys) == 1:
+            return groups.get(index_keys[0], {}).values()
+        return [x for k in index_keys for x in groups.get(k, {}).values()]
+
+    def count(self, name, index_key):
+        return len(self.groups[name].get(index_key, ()))
+
+    def counts(self, name):
+        """ {index key: how many members are filed under it} for the name index. """
+        return dict([(k, len(v)) for k, v in self.groups[name].items()])
+
+    def __setitem__(self, key, value):
+        self._unfile(key)
+        dict.__setitem__(self, key, value)
+        self._file(key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._unfile(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._unfile(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._unfile(key)
+        return key, value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._indexed.clear()
+        for groups in self.groups.values():
+            groups.clear()
+
+    def __repr__(self):
+        return "<Registry %s %s>" % (len(self), dict((x, self.counts(x)) for x in self.keys_of))
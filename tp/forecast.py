@@ -0,0 +1,271 @@
+""" Forecast of the AutoScaling group's desired capacity, so bids go out ahead of demand.
+
+    Desired capacity samples are kept in a fixed size ring buffer (one slot
+    per resolution seconds, long enough to hold the longest season). The
+    forecast for now + horizon is the highest of:
+
+        - the current capacity, we never plan for less than what is asked
+        - a short term linear trend over the last slope_window seconds
+        - each season (e.g. a day, a week): what the capacity did in the
+          same horizon back then, shifted to today's level
+
+    A higher forecast is followed right away, a lower one only once it has
+    stayed lower for hold seconds, so the target doesn't flap.
+
+    Recorded capacity traces can be replayed offline:
+
+        python forecast.py [-H horizon] [-r resolution] [-s season[,season]] trace
+"""
+
+import logging
+import os
+import sys
+import time
+import simplejson as json
+from array import array
+
+logger = logging.getLogger("forecast")
+
+DAY = 86400
+WEEK = 7 * DAY
+
+
+class RingBuffer(object):
+    """ Last size slots of resolution seconds, each holding the latest value seen in it. """
+
+    def __init__(self, size, resolution=60):
+        self.size = size
+        self.resolution = resolution
+        self.slots = array('l', [-1] * size)
+        self.values = array('d', [0.0] * size)
+
+    def slot(self, when):
+        return int(when // self.resolution)
+
+    def record(self, when, value):
+        slot = self.slot(when)
+        self.slots[slot % self.size] = slot
+        self.values[slot % self.size] = float(value)
+
+    def at(self, when):
+        slot = self.slot(when)
+        if self.slots[slot % self.size] != slot:
+            return None
+        return self.values[slot % self.size]
+
+    def window(self, start, end):
+        """ (time, value) of the recorded slots between start and end. """
+        samples = []
+        for slot in range(self.slot(start), self.slot(end) + 1):
+            if self.slots[slot % self.size] == slot:
+                samples.append((slot * self.resolution, self.values[slot % self.size]))
+        return samples
+
+    def dump(self):
+        return {"resolution": self.resolution,
+                "samples": [(s * self.resolution, v) for s, v in sorted(zip(self.slots, self.values)) if s >= 0]}
+
+    def load(self, data):
+        for when, value in data.get("samples", []):
+            self.record(when, value)
+
+
+def slope(samples):
+    """ Least squares slope of (time, value) samples, per second. """
+    if len(samples) < 2:
+        return 0.0
+    n = float(len(samples))
+    mean_t = sum([t for t, v in samples]) / n
+    mean_v = sum([v for t, v in samples]) / n
+    variance = sum([(t - mean_t) ** 2 for t, v in samples])
+    if not variance:
+        return 0.0
+    return sum([(t - mean_t) * (v - mean_v) for t, v in samples]) / variance
+
+
+class Forecaster(object):
+    def __init__(self, horizon=600, resolution=60, seasons=(DAY, WEEK), slope_window=900, hold=900, path=None,
+                 save_every=600):
+        self.horizon = horizon
+        self.seasons = sorted(seasons)
+        self.slope_window = slope_window
+        self.hold = hold
+        self.path = path
+        self.save_every = save_every
+        self.saved_at = None
+
+        longest = max(list(self.seasons) + [slope_window])
+        self.history = RingBuffer(int((longest + horizon) // resolution) + 2, resolution)
+
+        self.planned = None
+        self.lower_since = None
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.history.load(json.loads(f.read()))
+        except (IOError, ValueError), e:
+            logger.warn("Could not read capacity history from %s: %s", self.path, e)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.history.dump()))
+        os.rename(tmp, self.path)
+
+    def record(self, now, capacity):
+        self.history.record(now, capacity)
+        if self.saved_at is None:
+            self.saved_at = now
+        elif now - self.saved_at >= self.save_every:
+            self.save()
+            self.saved_at = now
+
+    def predict(self, now, capacity):
+        """ Expected capacity at now + horizon, never less than capacity. """
+        estimates = [capacity]
+
+        recent = self.history.window(now - self.slope_window, now)
+        # a couple of samples right after a step would extrapolate it way too far
+        covered = recent and recent[-1][0] - recent[0][0] >= self.slope_window / 2
+        trend = slope(recent) if covered else 0.0
+        if trend > 0:
+            estimates.append(capacity + trend * self.horizon)
+
+        for season in self.seasons:
+            then = self.history.at(now - season)
+            ahead = [v for t, v in self.history.window(now - season, now - season + self.horizon)]
+            if then is None or not ahead:
+                continue
+            # what the capacity did over the horizon back then, applied to today's level
+            estimates.append(capacity + max(ahead) - then)
+
+        return max(estimates)
+
+    def target(self, now, capacity):
+        """ Capacity to plan for, with hysteresis on the way down. """
+        self.record(now, capacity)
+        predicted = self.predict(now, capacity)
+
+        if self.planned is None or predicted >= self.planned:
+            self.planned = predicted
+            self.lower_since = None
+        elif self.lower_since is None:
+            self.lower_since = now
+        elif now - self.lower_since >= self.hold:
+            self.planned = predicted
+            self.lower_since = None
+
+        # never less than what is asked right now
+        return max(capacity, self.planned)
+
+
+def forecaster(conf, group):
+    """ Builds a Forecaster from the forecast_* properties, None unless forecast is on.
+
+        The history of each group is kept in forecast_file.<group>.
+    """
+    if not conf.forecast:
+        return None
+    path = conf.forecast_file
+    return Forecaster(conf.forecast_horizon,
+                      conf.forecast_resolution,
+                      conf.forecast_seasons,
+                      conf.forecast_slope_window,
+                      conf.forecast_hold,
+                      "%s.%s" % (path, group) if path else None)
+
+
+def read_trace(path):
+    """ (time, capacity) samples from "time,capacity" lines or a saved forecast_file. """
+    with open(path) as f:
+        data = f.read()
+    if data.lstrip().startswith("{"):
+        return [tuple(x) for x in json.loads(data)["samples"]]
+
+    samples = []
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        when, capacity = line.split(",")[:2]
+        try:
+            samples.append((float(when), float(capacity)))
+        except ValueError:
+            # header
+            continue
+    return sorted(samples)
+
+
+def replay(samples, model, lead=None):
+    """ Replays a capacity trace against a Forecaster.
+
+        The forecast is scored against what the capacity actually was lead
+        seconds later (the horizon by default), the time spent bidding and
+        promoting: under is capacity missing by then, over is capacity
+        planned for nothing, both in unit-seconds. The current capacity
+        alone is the baseline.
+    """
+    lead = lead if lead is not None else model.horizon
+    result = {"samples": len(samples), "under": 0.0, "over": 0.0, "baseline_under": 0.0, "changes": 0}
+    planned = []
+    previous = None
+    for when, capacity in samples:
+        target = model.target(when, capacity)
+        planned.append((when, capacity, target))
+        if previous is not None and target != previous:
+            result["changes"] += 1
+        previous = target
+
+    j = 0
+    for i, (when, capacity, target) in enumerate(planned[:-1]):
+        elapsed = planned[i + 1][0] - when
+        while j < len(planned) - 1 and planned[j + 1][0] <= when + lead:
+            j += 1
+        actual = planned[j][1]
+        result["under"] += max(0, actual - target) * elapsed
+        result["over"] += max(0, target - actual) * elapsed
+        result["baseline_under"] += max(0, actual - capacity) * elapsed
+    return result
+
+
+if __name__ == '__main__':
+    import getopt
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "H:r:s:w:h:", ["horizon=", "resolution=", "seasons=",
+                                                             "slope-window=", "hold="])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(2)
+
+    if len(args) != 1:
+        print __doc__
+        sys.exit(2)
+
+    options = {"horizon": 600, "resolution": 60, "seasons": [DAY, WEEK], "slope_window": 900, "hold": 900}
+    for o, a in opts:
+        if o in ("-H", "--horizon"):
+            options["horizon"] = int(a)
+        elif o in ("-r", "--resolution"):
+            options["resolution"] = int(a)
+        elif o in ("-s", "--seasons"):
+            options["seasons"] = [int(x) for x in a.split(",") if x]
+        elif o in ("-w", "--slope-window"):
+            options["slope_window"] = int(a)
+        elif o in ("-h", "--hold"):
+            options["hold"] = int(a)
+
+    started = time.time()
+    result = replay(read_trace(args[0]), Forecaster(**options))
+    print "samples: %(samples)s, target changes: %(changes)s" % result
+    print "capacity missing: %.0f unit-seconds (%.0f following the current capacity only)" % (
+        result["under"], result["baseline_under"])
+    print "capacity planned ahead for nothing: %.0f unit-seconds" % result["over"]
+    print "replayed in %.2fs" % (time.time() - started)
@@ -0,0 +1,104 @@
+""" Spot interruption notices and rebalance recommendations.
+
+    AWS warns two minutes before taking a spot instance away, and sends a
+    rebalance recommendation when the instance is at an elevated risk of
+    being interrupted. Notices reach TP through the notice sources (a file,
+    a UDP port or a polled HTTP endpoint standing in for the instance
+    metadata or an event queue, see events.py) or show up as the
+    marked-for-termination status of the spot request.
+
+    An interrupted instance is drained from the LBs at once and replaced
+    right away. An instance at risk keeps serving until its replacement is
+    live.
+"""
+
+import time
+from collections import namedtuple
+
+from market import parse_timestamp
+
+TERMINATION = "termination"
+REBALANCE = "rebalance"
+
+# seconds between an interruption notice and the instance being taken away
+NOTICE_SECONDS = 120
+
+# EventBridge detail-type of each kind of notice
+EVENT_KINDS = {
+    "EC2 Spot Instance Interruption Warning": TERMINATION,
+    "EC2 Instance Rebalance Recommendation": REBALANCE,
+}
+
+# at is when the instance is expected to go away
+Interruption = namedtuple('Interruption', ['instance_id', 'kind', 'at'])
+
+
+def parse(notice, now=None):
+    """ The Interruption a notice is about, None if it isn't about an instance.
+
+        Understands EventBridge events ({"detail-type": ..., "detail":
+        {"instance-id": ..., "instance-action": ...}}), the instance metadata
+        instance-action document with an instance_id added, and plain
+        {"instance_id": ..., "kind": "termination" or "rebalance"} notices.
+    """
+    now = now if now is not None else time.time()
+    detail = notice
+    kind = None
+    if "detail-type" in notice:
+        kind = EVENT_KINDS.get(notice["detail-type"])
+        if kind is None:
+            return None
+        detail = notice.get("detail")
+        if not isinstance(detail, dict):
+            return None
+
+    instance_id = detail.get("instance_id") or detail.get("instance-id")
+    if not instance_id:
+        return None
+
+    if kind is None:
+        kind = REBALANCE if detail.get("kind") == REBALANCE else TERMINATION
+
+    at = now + NOTICE_SECONDS
+    if detail.get("time"):
+        try:
+            at = parse_timestamp(detail["time"])
+        except ValueError:
+            pass
+    return Interruption(instance_id, kind, at)
+
+
+class Interruptions(object):
+    """ Instances known to be going away (doomed) or at risk of it.
+
+        Doomed instances are kept for ttl seconds after they were expected
+        to go, so the next cycles neither count nor promote them again.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.doomed = {}
+        self.at_risk = {}
+
+    def add(self, interruption):
+        """ Records interruption, returns False if it was already known. """
+        if interruption.instance_id in self.doomed:
+            return False
+        if interruption.kind == TERMINATION:
+            self.at_risk.pop(interruption.instance_id, None)
+            self.doomed[interruption.instance_id] = interruption
+            return True
+        if interruption.instance_id in self.at_risk:
+            return False
+        self.at_risk[interruption.instance_id] = interruption
+        return True
+
+    def forget(self, instance_id):
+        self.doomed.pop(instance_id, None)
+        self.at_risk.pop(instance_id, None)
+
+    def expire(self, now=None):
+        now = now if now is not None else time.time()
+        for instance_id, interruption in self.doomed.items():
+            if now - interruption.at > self.ttl:
+                del self.doomed[instance_id]
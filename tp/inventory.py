@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+# EC2 rejects filters with too many values, so id lookups are split in batches
+BATCH_SIZE = 200
+PAGE_SIZE = 1000
+
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def describe(ec2, filters, index):
+    """ Runs a paginated, filtered DescribeInstances and indexes the result by id. """
+    found = []
+    next_token = None
+    while True:
+        reservations = ec2.get_all_reservations(filters=filters, max_results=PAGE_SIZE, next_token=next_token)
+        for reservation in reservations:
+            for instance in reservation.instances:
+                index[instance.id] = instance
+                found.append(instance)
+
+        next_token = getattr(reservations, 'next_token', None)
+        if not next_token:
+            return found
+
+
+def lookup(ec2, instance_ids, index):
+    """ Fetches the instances not yet in index, in batches.
+
+        The instance-id filter is used instead of instance_ids= so a single
+        vanished instance doesn't fail the whole batch.
+    """
+    missing = [x for x in set(instance_ids) if x not in index]
+    for batch in batches(missing):
+        describe(ec2, {'instance-id': batch}, index)
+    return [index[x] for x in instance_ids if x in index]
+
+
+class Inventory(object):
+    """ Snapshot of the EC2 resources tiopatinhas cares about for one group.
+
+        Everything is fetched with server side filters in a few paginated
+        bulk calls and indexed by id, so the control loop can answer "is it
+        running?" or "when was it launched?" without extra round trips.
+
+        When a RegionInventory is given the group is served from the region
+        wide snapshot instead, which is shared by every group in the region.
+    """
+
+    def __init__(self, ec2, group_name, side_group, logger=None, shared=None):
+        self.ec2 = ec2
+        self.group_name = group_name
+        self.side_group = side_group
+        self.logger = logger or logging.getLogger(side_group)
+        self.shared = shared
+
+        self.spot_requests = []
+        self.emergency = []
+        self._instances = {}
+
+    @property
+    def instances(self):
+        # the region snapshot is read when asked, whichever group refreshed it last
+        if self.shared is not None:
+            return self.shared.instances
+        return self._instances
+
+    def refresh(self, instance_ids=()):
+        """ Rebuilds the snapshot.
+
+            instance_ids are extra instances (e.g. load balancer members)
+            whose state must be known by the end of the refresh.
+        """
+        if self.shared is not None:
+            self.shared.refresh()
+            self.spot_requests = [x for x in self.shared.spot_requests
+                                  if x.tags.get('tp:tag', None) == self.side_group]
+            self.emergency = [x for x in self.shared.emergency
+                              if x.tags.get('tp:group', None) == self.group_name]
+            self.lookup(instance_ids)
+            return self
+
+        self.spot_requests = list(self.ec2.get_all_spot_instance_requests(
+            filters={'tag:tp:tag': self.side_group}))
+
+        self._instances = {}
+        self.emergency = describe(self.ec2, {'tag:tp:group': self.group_name,
+                                             'instance-state-name': 'running'}, self._instances)
+
+        spot_instance_ids = [x.instance_id for x in self.spot_requests if x.instance_id]
+        self.lookup(chain_ids(spot_instance_ids, instance_ids))
+        return self
+
+    def lookup(self, instance_ids):
+        if self.shared is not None:
+            return self.shared.lookup(instance_ids)
+        return lookup(self.ec2, instance_ids, self._instances)
+
+    def state(self, instance_id):
+        instance = self.instances.get(instance_id)
+        return instance.state if instance else None
+
+    def is_running(self, instance_id):
+        return self.state(instance_id) == "running"
+
+    def __repr__(self):
+        return "<Inventory Group:%s requests:%s instances:%s>" % (self.side_group, len(self.spot_requests),
+                                                                 len(self.instances))
+
+
+class RegionInventory(object):
+    """ Region wide snapshot of everything tagged by any tiopatinhas group.
+
+        The snapshot is fetched at most once every max_age seconds no matter
+        how many groups ask for it, which keeps the number of describe calls
+        flat as groups are added to a supervisor.
+
+        instances is updated in place and keeps the instances the groups
+        looked up since the previous fetch (e.g. LB members), fetched again
+        with it, so a group never finds its lookups gone after another
+        group's refresh.
+    """
+
+    def __init__(self, ec2, max_age=10):
+        self.ec2 = ec2
+        self.max_age = max_age
+        self.fetched_at = 0
+        self._lock = threading.RLock()
+
+        self.spot_requests = []
+        self.emergency = []
+        self.instances = {}
+        # ids the groups looked up since the last fetch
+        self.looked_up = set()
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and time.time() - self.fetched_at < self.max_age:
+                return self
+
+            spot_requests = list(self.ec2.get_all_spot_instance_requests(filters={'tag-key': 'tp:tag'}))
+            instances = {}
+            emergency = describe(self.ec2, {'tag-key': 'tp:group', 'instance-state-name': 'running'}, instances)
+            lookup(self.ec2, chain_ids([x.instance_id for x in spot_requests if x.instance_id],
+                                       self.looked_up), instances)
+
+            self.spot_requests = spot_requests
+            self.emergency = emergency
+            for instance_id in [x for x in self.instances if x not in instances]:
+                del self.instances[instance_id]
+            self.instances.update(instances)
+            self.looked_up = set()
+            self.fetched_at = time.time()
+            return self
+
+    def invalidate(self):
+        with self._lock:
+            self.fetched_at = 0
+
+    def lookup(self, instance_ids):
+        with self._lock:
+            self.looked_up.update(instance_ids)
+            return lookup(self.ec2, instance_ids, self.instances)
+
+    def __repr__(self):
+        return "<RegionInventory requests:%s instances:%s>" % (len(self.spot_requests), len(self.instances))
+
+
+def chain_ids(*groups):
+    seen = set()
+    ids = []
+    for group in groups:
+        for instance_id in group:
+            if instance_id not in seen:
+                seen.add(instance_id)
+                ids.append(instance_id)
+    return ids
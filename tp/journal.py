@@ -0,0 +1,168 @@
+""" Local journal of what each group manages, so a restart picks up where it left.
+
+    Every cycle the manager's state (spot requests, emergency instances, the
+    pending ones and the controller timestamps) is compared with what was
+    last written and only the differences are appended to a SQLite table.
+    Every snapshot_every entries the whole state is written as one snapshot
+    row and the entries it covers are dropped, so the journal stays small.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+import simplejson as json
+
+from inventory import batches
+from inventory import lookup
+
+logger = logging.getLogger("journal")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_name TEXT NOT NULL,
+    time REAL NOT NULL,
+    section TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_group ON entries (group_name, seq);
+CREATE TABLE IF NOT EXISTS snapshots (
+    group_name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    time REAL NOT NULL,
+    state TEXT NOT NULL
+);
+"""
+
+# sections of the state, each one a map of key -> JSON value
+SECTIONS = ("requests", "emergency", "pending_bids", "pending_launches", "clock")
+
+
+def empty_state():
+    return dict([(x, {}) for x in SECTIONS])
+
+
+def capture(manager):
+    """ The part of a TPManager's state worth surviving a restart. """
+    requests = {}
+    for request in manager.bids.values():
+        requests[request.id] = {"instance_id": request.instance_id, "live": False}
+    for instance_id, request in manager.live.items():
+        requests[request.id] = {"instance_id": instance_id, "live": True}
+
+    emergency = {}
+    for instance_id, instance in manager.emergency.items():
+        emergency[instance_id] = {"launch_time": getattr(instance, 'launch_time', None)}
+
+    return {"requests": requests,
+            "emergency": emergency,
+            "pending_bids": dict([(k, list(v)) for k, v in manager.pending_bids.items()]),
+            "pending_launches": dict([(k, list(v)) for k, v in manager.pending_launches.items()]),
+            "clock": {"last_bid": manager.last_bid,
+                      "last_change": manager.last_change,
+                      "previous_managed": manager.previous_managed,
+                      "target": manager.target}}
+
+
+class Journal(object):
+    """ Append-only record of one group's state in a SQLite file.
+
+        Several groups (e.g. under a supervisor) can share the same file,
+        each Journal only reads and writes its own rows.
+    """
+
+    def __init__(self, path, group, snapshot_every=500):
+        self.path = path
+        self.group = group
+        self.snapshot_every = snapshot_every
+        self.state = None
+        self.appended = 0
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def load(self):
+        """ Replays the latest snapshot and the entries appended after it. """
+        with self._lock:
+            state = empty_state()
+            seq = 0
+            row = self.db.execute("SELECT seq, state FROM snapshots WHERE group_name = ?",
+                                  (self.group,)).fetchone()
+            if row:
+                seq = row[0]
+                state.update(json.loads(row[1]))
+
+            entries = self.db.execute("SELECT section, key, value FROM entries"
+                                      " WHERE group_name = ? AND seq > ? ORDER BY seq",
+                                      (self.group, seq)).fetchall()
+            for section, key, value in entries:
+                if value is None:
+                    state[section].pop(key, None)
+                else:
+                    state[section][key] = json.loads(value)
+
+            self.state = state
+            self.appended = len(entries)
+            return state
+
+    def record(self, state):
+        """ Appends whatever changed since the last recorded state. """
+        with self._lock:
+            previous = self.state or empty_state()
+            now = time.time()
+            rows = []
+            for section in SECTIONS:
+                before, after = previous.get(section, {}), state.get(section, {})
+                for key in before:
+                    if key not in after:
+                        rows.append((self.group, now, section, key, None))
+                for key, value in after.items():
+                    if before.get(key) != value:
+                        rows.append((self.group, now, section, key, json.dumps(value)))
+
+            if rows:
+                with self.db:
+                    self.db.executemany("INSERT INTO entries (group_name, time, section, key, value)"
+                                        " VALUES (?, ?, ?, ?, ?)", rows)
+                self.appended += len(rows)
+            # a JSON round trip so later comparisons see what load() would see
+            self.state = json.loads(json.dumps(state))
+
+            if self.appended >= self.snapshot_every:
+                self._snapshot(now)
+            return len(rows)
+
+    def _snapshot(self, now):
+        with self.db:
+            seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM entries WHERE group_name = ?",
+                                  (self.group,)).fetchone()[0]
+            self.db.execute("INSERT OR REPLACE INTO snapshots (group_name, seq, time, state) VALUES (?, ?, ?, ?)",
+                            (self.group, seq, now, json.dumps(self.state)))
+            self.db.execute("DELETE FROM entries WHERE group_name = ? AND seq <= ?", (self.group, seq))
+        self.appended = 0
+        logger.debug("%s: journal compacted at entry %s", self.group, seq)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def verify(ec2, state):
+    """ Checks a replayed state against AWS, looking up only the ids it mentions.
+
+        Returns (requests by id, instances by id) for whatever still exists.
+    """
+    request_ids = set(state["requests"]) | set(state["pending_bids"])
+    requests = {}
+    for batch in batches(request_ids):
+        for request in ec2.get_all_spot_instance_requests(filters={'spot-instance-request-id': batch}):
+            requests[request.id] = request
+
+    instance_ids = set(state["emergency"]) | set(state["pending_launches"])
+    instance_ids.update([x.instance_id for x in requests.values() if x.instance_id])
+    instances = {}
+    lookup(ec2, instance_ids, instances)
+    return requests, instances
@@ -0,0 +1,318 @@
+""" Running several tiopatinhas replicas, only one of them acting on a group.
+
+    Replicas of the same configuration coordinate through leases kept in a
+    LeaseStore shared by all of them. With coordination "leader" they elect
+    one leader that acts on every group while the others stand by; with
+    "shard" every group has a lease of its own, groups are spread over the
+    live replicas by rendezvous hashing and a replica joining or leaving
+    only moves the groups that hash to it.
+
+    A lease is held for lease_ttl seconds and renewed every third of that
+    by a Coordinator thread. A replica that dies or loses the store stops
+    acting once its lease runs out and another replica takes the lease
+    over after that. Standbys keep their state warm (see
+    TPManager.warm()), so the first tick after a takeover is a regular
+    one and not a cold start. lease_ttl must be longer than a tick.
+
+    The stores shipped here, "sqlite" (the default) and "file", only work
+    for replicas sharing a host or a file system. Other stores implement
+    LeaseStore.update() and are added to BACKENDS.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import simplejson as json
+from abc import ABCMeta
+from abc import abstractmethod
+from contextlib import contextmanager
+
+logger = logging.getLogger("lease")
+
+# the lease of every group with coordination "leader"
+LEADER = "leader"
+# replicas with coordination "shard" hold a membership lease named after them
+MEMBER = "member/"
+
+
+class LeaseStore(object):
+    """ Where the leases of the replicas are kept, as {name: (holder, expires)}. """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def update(self, fn):
+        """ Calls fn with every lease, lets it change them and saves them, as one atomic step.
+            Returns what fn returns.
+        """
+
+    def acquire(self, name, holder, ttl):
+        """ Takes or renews the lease name for ttl seconds, False if someone else holds it. """
+        now = time.time()
+
+        def grab(leases):
+            current = leases.get(name)
+            if current is not None and current[0] != holder and current[1] > now:
+                return False
+            leases[name] = (holder, now + ttl)
+            return True
+        return self.update(grab)
+
+    def release(self, name, holder):
+        def drop(leases):
+            if name in leases and leases[name][0] == holder:
+                del leases[name]
+        self.update(drop)
+
+    def leases(self):
+        return self.update(dict)
+
+
+class FileLeaseStore(LeaseStore):
+    """ A JSON file, changed under an exclusive lock of path.lock and replaced as a whole. """
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def locked(self):
+        with open(self.path + ".lock", 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return dict([(k, tuple(v)) for k, v in json.load(f).items()])
+        except IOError:
+            return {}
+        except ValueError:
+            logger.warn("%s is not valid JSON, starting over", self.path)
+            return {}
+
+    def update(self, fn):
+        with self.locked():
+            leases = self.read()
+            before = dict(leases)
+            result = fn(leases)
+            if leases != before:
+                temporary = "%s.%s" % (self.path, os.getpid())
+                with open(temporary, 'w') as f:
+                    json.dump(leases, f)
+                os.rename(temporary, self.path)
+            return result
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """ A table of a SQLite database, changed in immediate transactions. """
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+
+    def update(self, fn):
+        # one connection per call, replicas and threads never share one
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS leases "
+                       "(name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)")
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                leases = dict([(name, (holder, expires))
+                               for name, holder, expires in db.execute("SELECT name, holder, expires FROM leases")])
+                before = dict(leases)
+                result = fn(leases)
+                for name in before:
+                    if name not in leases:
+                        db.execute("DELETE FROM leases WHERE name = ?", (name,))
+                for name, (holder, expires) in leases.items():
+                    if before.get(name) != (holder, expires):
+                        db.execute("INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)",
+                                   (name, holder, expires))
+                db.execute("COMMIT")
+                return result
+            except:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+
+BACKENDS = {"file": FileLeaseStore, "sqlite": SQLiteLeaseStore}
+
+
+def owner(name, members):
+    """ The member a group is assigned to: the same one wherever it's computed, for the same members. """
+    return max(members, key=lambda x: hashlib.md5("%s %s" % (x, name)).hexdigest())
+
+
+class Coordinator(threading.Thread):
+    """ Which of the groups of a process this replica acts on.
+
+        Groups are known by their lease names, see add(). sync() renews
+        the leases held and takes or hands over the ones that should change
+        hands, listeners are called with (name, leading) when this replica
+        starts or stops leading a group. A group being ticked (between
+        begin() and end()) is never handed over, the next sync() does it.
+    """
+
+    def __init__(self, store, replica, ttl=20, shard=False, metrics=None):
+        threading.Thread.__init__(self, name="Coordinator")
+        self.daemon = True
+        self.store = store
+        self.replica = replica
+        self.ttl = ttl
+        self.interval = ttl / 3.0
+        self.shard = shard
+        self.metrics = metrics
+        self.names = []
+        self.listeners = []
+        # lease name -> when it runs out for this replica
+        self.held = {}
+        self.busy = set()
+        self.stopped = threading.Event()
+        self._lock = threading.RLock()
+
+    def add(self, name):
+        with self._lock:
+            if name not in self.names:
+                self.names.append(name)
+
+    def lease_of(self, name):
+        return name if self.shard else LEADER
+
+    def leads(self, name):
+        with self._lock:
+            return self.leads_lease(self.lease_of(name))
+
+    def leads_lease(self, lease):
+        deadline = self.held.get(lease)
+        return deadline is not None and time.time() < deadline
+
+    def begin(self, name):
+        """ Whether this replica leads name, which is then kept until end(name). """
+        with self._lock:
+            if not self.leads(name):
+                return False
+            self.busy.add(name)
+            return True
+
+    def end(self, name):
+        with self._lock:
+            self.busy.discard(name)
+
+    def members(self):
+        """ The replicas alive, this one included. """
+        now = time.time()
+        alive = set([holder for name, (holder, expires) in self.store.leases().items()
+                     if name.startswith(MEMBER) and expires > now])
+        alive.add(self.replica)
+        return sorted(alive)
+
+    def wanted(self):
+        if not self.shard:
+            return [LEADER]
+        self.store.acquire(MEMBER + self.replica, self.replica, self.ttl)
+        members = self.members()
+        with self._lock:
+            return [x for x in self.names if owner(x, members) == self.replica]
+
+    def sync(self):
+        """ One heartbeat, returns the names this replica leads afterwards. """
+        try:
+            wanted = self.wanted()
+            with self._lock:
+                held = list(self.held)
+            for lease in held:
+                if lease not in wanted:
+                    self.hand_over(lease)
+            for lease in wanted:
+                started = time.time()
+                if self.store.acquire(lease, self.replica, self.ttl):
+                    self.took(lease, started + self.ttl)
+                else:
+                    self.lost(lease)
+        except Exception, e:
+            logger.warn("%s could not reach the lease store (%s), leading until the leases run out",
+                        self.replica, e)
+        with self._lock:
+            return [x for x in self.names if self.leads(x)]
+
+    def covered(self, lease):
+        with self._lock:
+            return [x for x in self.names if self.lease_of(x) == lease]
+
+    def took(self, lease, deadline):
+        with self._lock:
+            fresh = not self.leads_lease(lease)
+            self.held[lease] = deadline
+        if fresh:
+            logger.info("%s took the lease %s", self.replica, lease)
+            self.changed(lease, True)
+
+    def lost(self, lease):
+        with self._lock:
+            if self.held.pop(lease, None) is None:
+                return
+        logger.warn("%s lost the lease %s to another replica", self.replica, lease)
+        self.changed(lease, False)
+
+    def hand_over(self, lease):
+        with self._lock:
+            if set(self.covered(lease)) & self.busy:
+                return
+            del self.held[lease]
+            self.store.release(lease, self.replica)
+        logger.info("%s handed the lease %s over", self.replica, lease)
+        self.changed(lease, False)
+
+    def changed(self, lease, leading):
+        if self.metrics is not None:
+            self.metrics.set("tp_lease_held", 1 if leading else 0, lease=lease)
+        for name in self.covered(lease):
+            for listener in self.listeners:
+                listener(name, leading)
+
+    def start(self):
+        # the first ticks know whether they lead
+        self.sync()
+        threading.Thread.start(self)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sync()
+
+    def stop(self):
+        """ Stops renewing and releases every lease, so another replica takes over right away. """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        with self._lock:
+            held, self.held = list(self.held), {}
+        if self.shard:
+            held.append(MEMBER + self.replica)
+        for lease in held:
+            try:
+                self.store.release(lease, self.replica)
+            except Exception, e:
+                logger.warn("%s could not release the lease %s (%s)", self.replica, lease, e)
+
+    def __repr__(self):
+        return "<Coordinator %s %s held:%s>" % (self.replica, "shard" if self.shard else "leader",
+                                                sorted(self.held))
+
+
+def coordinator(conf, metrics=None):
+    """ Builds a Coordinator from the coordination properties, None unless coordination is on. """
+    if conf.coordination == "none":
+        return None
+    store = BACKENDS[conf.coordination_backend](conf.coordination_path)
+    replica = conf.replica_id or "%s:%s" % (socket.gethostname(), os.getpid())
+    return Coordinator(store, replica, conf.lease_ttl, conf.coordination == "shard", metrics)
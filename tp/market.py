@@ -0,0 +1,205 @@
+""" Spot price history and bid placement across instance types and zones. """
+
+import calendar
+import logging
+import math
+import os
+import threading
+import time
+import simplejson as json
+from datetime import datetime
+
+from capacity import relative_weight
+
+logger = logging.getLogger("market")
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if '.' not in value:
+        value = value.replace('Z', '.000Z')
+    return float(calendar.timegm(datetime.strptime(value, TIME_FORMAT).timetuple()))
+
+
+def format_timestamp(epoch):
+    return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class PriceHistory(object):
+    """ Locally cached spot price history, one series per (instance type, zone).
+
+        Each update only asks AWS for what happened since the previous one,
+        and the history can be persisted to a file so a restart doesn't have
+        to download the whole window again.
+    """
+
+    def __init__(self, ec2, path=None, window_hours=24, max_age=300, product_description="Linux/UNIX"):
+        self.ec2 = ec2
+        self.path = path
+        self.window = window_hours * 3600
+        self.max_age = max_age
+        self.product_description = product_description
+        self.series = {}
+        self.fetched_at = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.loads(f.read())
+            self.fetched_at = data.get("fetched_at", {})
+            self.series = dict([(tuple(k.split("|", 1)), [tuple(x) for x in v])
+                                for k, v in data.get("series", {}).items()])
+        except (IOError, ValueError), e:
+            logger.warn("Could not read price history from %s: %s", self.path, e)
+
+    def save(self):
+        if not self.path:
+            return
+        data = {"fetched_at": self.fetched_at,
+                "series": dict([("%s|%s" % k, v) for k, v in self.series.items()])}
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(data))
+        os.rename(tmp, self.path)
+
+    def update(self, instance_types, force=False):
+        """ Fetches the prices published since the last update of each type. """
+        with self._lock:
+            now = time.time()
+            changed = False
+            for instance_type in instance_types:
+                last = self.fetched_at.get(instance_type, 0)
+                if not force and now - last < self.max_age:
+                    continue
+
+                start = max(last, now - self.window)
+                next_token = None
+                while True:
+                    points = self.ec2.get_spot_price_history(start_time=format_timestamp(start),
+                                                             instance_type=instance_type,
+                                                             product_description=self.product_description,
+                                                             next_token=next_token)
+                    for point in points:
+                        self.add(point.instance_type, point.availability_zone,
+                                 parse_timestamp(point.timestamp), float(point.price))
+                    next_token = getattr(points, 'next_token', None)
+                    if not next_token:
+                        break
+
+                self.fetched_at[instance_type] = now
+                changed = True
+
+            if changed:
+                self.trim(now)
+                self.save()
+
+    def add(self, instance_type, zone, timestamp, price):
+        series = self.series.setdefault((instance_type, zone), [])
+        if (timestamp, price) not in series:
+            series.append((timestamp, price))
+            series.sort()
+
+    def trim(self, now):
+        for pool, series in self.series.items():
+            # keep the last point before the window, it is the price at the window start
+            recent = [x for x in series if x[0] >= now - self.window]
+            older = [x for x in series if x[0] < now - self.window]
+            self.series[pool] = older[-1:] + recent
+
+    def current(self, instance_type, zone):
+        series = self.series.get((instance_type, zone))
+        return series[-1][1] if series else None
+
+    def peak(self, instance_type, zone):
+        series = self.series.get((instance_type, zone))
+        return max([x[1] for x in series]) if series else None
+
+    def zones(self, instance_type):
+        return sorted([z for t, z in self.series if t == instance_type])
+
+
+class BidPlacer(object):
+    """ Chooses where to bid: which instance types, in which zones.
+
+        Pools (type, zone) whose current price is under our max price are
+        ranked by price per unit of capacity (relative to reference_type).
+        Capacity is spread so that no pool holds more than max_pool_share of
+        what we manage, so a crash in one pool only takes part of it away.
+    """
+
+    def __init__(self, history, max_price, zones, reference_type, max_pool_share=1.0, weight=None):
+        self.history = history
+        self.max_price = max_price
+        self.zones = zones
+        self.reference_type = reference_type
+        self.max_pool_share = max_pool_share
+        # capacity units of an instance type, see capacity.CapacityModel
+        self._weight = weight
+
+    def weight(self, instance_type):
+        if self._weight is not None:
+            return self._weight(instance_type)
+        return relative_weight(instance_type, self.reference_type)
+
+    def candidates(self, exclude=()):
+        """ Eligible pools, cheapest per unit of capacity first. """
+        pools = []
+        for instance_type, max_price in self.max_price.items():
+            for zone in self.zones:
+                if (instance_type, zone) in exclude:
+                    continue
+                price = self.history.current(instance_type, zone)
+                if price is None or price >= float(max_price):
+                    continue
+                pools.append((price / self.weight(instance_type), instance_type, zone))
+        pools.sort()
+        return [(t, z) for p, t, z in pools]
+
+    def plan(self, units, existing=None, exclude=()):
+        """ Splits units of capacity into [(instance_type, zone, count)].
+
+            existing maps pools to the capacity units we already have there.
+        """
+        existing = existing or {}
+        total = sum(existing.values()) + units
+        limit = max(self.max_pool_share * total, 0)
+
+        plan = []
+        remaining = units
+        candidates = self.candidates(exclude)
+        for instance_type, zone in candidates:
+            if remaining <= 0:
+                break
+            weight = self.weight(instance_type)
+            room = limit - existing.get((instance_type, zone), 0)
+            if room < weight and len(candidates) > 1:
+                continue
+            count = int(math.ceil(min(remaining, max(room, weight)) / weight))
+            plan.append((instance_type, zone, count))
+            remaining -= count * weight
+
+        if remaining > 0 and candidates:
+            # every pool is at its share, put the rest on the cheapest one
+            instance_type, zone = candidates[0]
+            count = int(math.ceil(remaining / self.weight(instance_type)))
+            plan.append((instance_type, zone, count))
+
+        return merge(plan)
+
+
+def merge(plan):
+    counts = {}
+    order = []
+    for instance_type, zone, count in plan:
+        if (instance_type, zone) not in counts:
+            order.append((instance_type, zone))
+            counts[(instance_type, zone)] = 0
+        counts[(instance_type, zone)] += count
+    return [(t, z, counts[(t, z)]) for t, z in order]
@@ -0,0 +1,260 @@
+""" Counters, gauges and latency histograms for the control loop.
+
+    Metrics are recorded in a Metrics registry and can be exposed as
+    Prometheus text over HTTP (metrics_port) and/or pushed as StatsD
+    packets over UDP (statsd_host). Boto connections are wrapped with
+    instrument() so every API call is counted and timed by name.
+"""
+
+import logging
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from contextlib import contextmanager
+
+logger = logging.getLogger("metrics")
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=None):
+    pairs = list(key) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs]) + "}"
+
+
+class Metrics(object):
+    """ Thread safe registry of counters, gauges and histograms keyed by name and labels. """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        for listener in self.listeners:
+            listener.counter(name, value, labels)
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[label_key(labels)] = value
+        for listener in self.listeners:
+            listener.gauge(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = label_key(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+        for listener in self.listeners:
+            listener.timing(name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def value(self, name, **labels):
+        """ Current value of a counter or gauge, mostly for reports. """
+        key = label_key(labels)
+        with self._lock:
+            for kind in (self.counters, self.gauges):
+                if name in kind and key in kind[name]:
+                    return kind[name][key]
+        return None
+
+    def render(self):
+        """ Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            for name in sorted(self.counters):
+                lines.append("# TYPE %s counter" % name)
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append("%s%s %s" % (name, format_labels(key), value))
+            for name in sorted(self.gauges):
+                lines.append("# TYPE %s gauge" % name)
+                for key, value in sorted(self.gauges[name].items()):
+                    lines.append("%s%s %s" % (name, format_labels(key), value))
+            for name in sorted(self.histograms):
+                lines.append("# TYPE %s histogram" % name)
+                for key, histogram in sorted(self.histograms[name].items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append("%s_bucket%s %s" % (name, format_labels(key, [("le", bound)]), count))
+                    lines.append("%s_bucket%s %s" % (name, format_labels(key, [("le", "+Inf")]), histogram.count))
+                    lines.append("%s_sum%s %s" % (name, format_labels(key), histogram.sum))
+                    lines.append("%s_count%s %s" % (name, format_labels(key), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedConnection(object):
+    """ Proxy around a boto connection counting and timing every call.
+
+        Boto objects returned by the connection (instances, spot requests,
+        load balancers, images...) keep a reference to the connection they
+        came from and use it for their own calls (lb.register_instances,
+        request.cancel, image.run), so they are re-pointed to the proxy.
+    """
+
+    def __init__(self, connection, metrics, service, **labels):
+        self._connection = connection
+        self._metrics = metrics
+        self._service = service
+        self._labels = labels
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            labels = dict(self._labels, service=self._service, api=name)
+            started = time.time()
+            try:
+                return rebind(attribute(*args, **kwargs), self._connection, self)
+            except Exception, e:
+                code = getattr(e, 'error_code', None) or e.__class__.__name__
+                self._metrics.inc("tp_api_errors_total", code=code, **labels)
+                if code in THROTTLING_CODES:
+                    self._metrics.inc("tp_api_throttled_total", **labels)
+                raise
+            finally:
+                self._metrics.inc("tp_api_calls_total", **labels)
+                self._metrics.observe("tp_api_seconds", time.time() - started, **labels)
+
+        return call
+
+
+def rebind(result, connection, proxy, depth=0):
+    """ Points boto objects in result (and their instances) from connection to proxy. """
+    if depth > 1 or result is None or isinstance(result, (basestring, bool, int, float)):
+        return result
+    if isinstance(result, list):
+        for item in result:
+            rebind(item, connection, proxy, depth + 1)
+        return result
+    if getattr(result, 'connection', None) is connection:
+        result.connection = proxy
+    for instance in getattr(result, 'instances', None) or []:
+        if getattr(instance, 'connection', None) is connection:
+            instance.connection = proxy
+    return result
+
+
+def instrument(connection, metrics, service, **labels):
+    if metrics is None or isinstance(connection, InstrumentedConnection):
+        return connection
+    return InstrumentedConnection(connection, metrics, service, **labels)
+
+
+class StatsdEmitter(object):
+    """ Pushes every recorded metric to a StatsD daemon, fire and forget. """
+
+    def __init__(self, host, port=8125, prefix="tp"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, name, labels):
+        parts = [self.prefix, name] + [str(labels[k]).replace(".", "_") for k in sorted(labels)]
+        return ".".join([x for x in parts if x])
+
+    def send(self, payload):
+        try:
+            self.sock.sendto(payload, self.address)
+        except socket.error, e:
+            logger.debug("could not send %s to statsd: %s", payload, e)
+
+    def counter(self, name, value, labels):
+        self.send("%s:%s|c" % (self.name(name, labels), value))
+
+    def gauge(self, name, value, labels):
+        self.send("%s:%s|g" % (self.name(name, labels), value))
+
+    def timing(self, name, value, labels):
+        self.send("%s:%d|ms" % (self.name(name, labels), value * 1000))
+
+    def stop(self):
+        self.sock.close()
+
+
+class PrometheusExporter(threading.Thread):
+    """ Serves the registry as Prometheus text on http://host:port/metrics. """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        threading.Thread.__init__(self, name="metrics-http")
+        self.daemon = True
+        registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.server = HTTPServer((host, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_exporters(metrics, conf):
+    """ Starts whatever metrics_port and statsd_host ask for, returns them for stop(). """
+    exporters = []
+    if conf.metrics_port:
+        exporter = PrometheusExporter(metrics, int(conf.metrics_port), conf.metrics_host)
+        exporter.start()
+        exporters.append(exporter)
+        logger.info("Serving metrics on port %s", conf.metrics_port)
+    if conf.statsd_host:
+        emitter = StatsdEmitter(conf.statsd_host, int(conf.statsd_port), conf.statsd_prefix)
+        metrics.listeners.append(emitter)
+        exporters.append(emitter)
+    return exporters
@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger("parallel")
+
+
+class Outcome(object):
+    """ Result of running a function on one item: either a value or an error. """
+
+    def __init__(self, item, value=None, error=None):
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<Outcome %s %s>" % (self.item, "ok" if self.ok else self.error)
+
+
+class Executor(object):
+    """ Bounded thread pool fanning calls out over several items.
+
+        Each item is isolated: an exception or a timeout on one of them is
+        reported in its Outcome and never stops the others. Threads are only
+        created on first use and can be shared by several TPManagers.
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def map(self, fn, items, timeout=None):
+        """ Runs fn(item) for every item, returns Outcomes in the same order. """
+        items = list(items)
+        if self.workers <= 1 or (len(items) <= 1 and not timeout):
+            return [self.call(fn, x) for x in items]
+
+        deadline = time.time() + timeout if timeout else None
+        pending = [(x, self.pool.apply_async(fn, (x,))) for x in items]
+
+        outcomes = []
+        for item, result in pending:
+            try:
+                remaining = max(0, deadline - time.time()) if deadline else None
+                outcomes.append(Outcome(item, value=result.get(remaining)))
+            except TimeoutError:
+                outcomes.append(Outcome(item, error=TimeoutError("timed out after %ss" % timeout)))
+            except Exception, e:
+                outcomes.append(Outcome(item, error=e))
+        return outcomes
+
+    def submit(self, fn, *args):
+        """ Starts fn(*args) in the pool, returns a function waiting for its Outcome. """
+        if self.workers <= 1:
+            outcome = self.call(lambda x: fn(*args), None)
+            return lambda timeout=None: outcome
+
+        result = self.pool.apply_async(fn, args)
+
+        def wait(timeout=None):
+            try:
+                return Outcome(None, value=result.get(timeout))
+            except TimeoutError:
+                return Outcome(None, error=TimeoutError("timed out after %ss" % timeout))
+            except Exception, e:
+                return Outcome(None, error=e)
+        return wait
+
+    def gather(self, *fns):
+        """ Runs every fn concurrently, the first one in the calling thread.
+
+            Returns their values in order, or raises the first error once
+            all of them are done.
+        """
+        waits = [self.submit(x) for x in fns[1:]]
+        outcomes = [self.call(lambda x: fns[0](), None)] + [x() for x in waits]
+        for outcome in outcomes:
+            if not outcome.ok:
+                raise outcome.error
+        return [x.value for x in outcomes]
+
+    def call(self, fn, item):
+        try:
+            return Outcome(item, value=fn(item))
+        except Exception, e:
+            return Outcome(item, error=e)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+
+class Timers(object):
+    """ Calls deferred by a number of seconds instead of sleeping through them.
+
+        Whoever drives the loop runs them once they are due with run_due(),
+        in whatever thread it likes: callbacks must not assume they run in
+        the thread that deferred them. A failing callback is logged and
+        doesn't prevent the others from running.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def later(self, delay, fn, *args):
+        with self._lock:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._sequence), fn, args))
+
+    def next_at(self):
+        """ When the next call is due, None if there is none. """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def run_due(self):
+        """ Runs the calls that are due, returns how many ran. """
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+
+        for at, sequence, fn, args in due:
+            try:
+                fn(*args)
+            except Exception, e:
+                logger.exception("deferred %s failed: %s", getattr(fn, "__name__", fn), e)
+        return len(due)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
@@ -0,0 +1,117 @@
+""" Billing cycle aware demotion planning.
+
+    Launch times are read once from the inventory snapshot and the position
+    of every instance in its billing cycle is computed in a single pass over
+    the fleet. From there the planner ranks what to drop first and tells
+    when each drop becomes worth it, so several instances can be demoted in
+    the same tick and the loop knows when to come back for the others.
+"""
+
+import time
+from collections import namedtuple
+
+from market import parse_timestamp
+
+HOURLY = "hourly"
+PER_SECOND = "per-second"
+
+# seconds before the next billing boundary, (from, to)
+LIVE_WINDOW = (0, 180)
+EMERGENCY_WINDOW = (180, 600)
+REPLACE_WINDOW = (120, 600)
+
+# resource is the spot request or instance, remaining the seconds left in its paid cycle
+Position = namedtuple('Position', ['resource', 'instance_id', 'launched', 'remaining', 'weight'])
+
+# at is when dropping the position's instance becomes worth it (<= now means right away)
+Demotion = namedtuple('Demotion', ['position', 'at'])
+
+
+def remaining_seconds(launched, now, billing=HOURLY, period=3600, minimum=60):
+    """ Seconds left in the paid billing cycle of each launch time, in one pass.
+
+        Hourly billing charges each started hour, so what is left until the
+        next boundary is already paid for. Per second billing only charges a
+        minimum, once it has elapsed stopping an instance never wastes money.
+    """
+    if billing == PER_SECOND:
+        return [max(0.0, minimum - (now - x)) for x in launched]
+    return [period - ((now - x) % period) for x in launched]
+
+
+class DemotionPlanner(object):
+    def __init__(self, billing=HOURLY, period=3600, minimum=60):
+        if billing not in (HOURLY, PER_SECOND):
+            raise ValueError("unknown billing %s, expected %s or %s" % (billing, HOURLY, PER_SECOND))
+        self.billing = billing
+        self.period = period
+        self.minimum = minimum
+
+    def rank(self, resources, launch_times, weights=None, now=None):
+        """ Positions of resources, the ones closest to the end of their paid cycle first.
+
+            launch_times maps instance ids to launch epochs, resources without
+            a known launch time are left out.
+        """
+        now = now if now is not None else time.time()
+        weights = weights or {}
+
+        known = []
+        for resource in resources:
+            instance_id = instance_id_of(resource)
+            if launch_times.get(instance_id) is not None:
+                known.append((resource, instance_id, launch_times[instance_id]))
+
+        remaining = remaining_seconds([x[2] for x in known], now, self.billing, self.period, self.minimum)
+        positions = [Position(resource, known_id, launched, left, weights.get(known_id, 1))
+                     for (resource, known_id, launched), left in zip(known, remaining)]
+
+        # the youngest goes first among equals, older instances have proven to stay healthy
+        positions.sort(key=lambda x: (x.remaining, -x.launched))
+        return positions
+
+    def due(self, position, window):
+        """ Whether position is inside window, (from, to) seconds before its billing boundary. """
+        if self.billing == PER_SECOND:
+            return position.remaining <= 0
+        return window[0] <= position.remaining < window[1]
+
+    def when(self, position, window, now):
+        """ When position enters window. """
+        if self.billing == PER_SECOND:
+            return now + position.remaining
+        if position.remaining < window[0]:
+            # too late for this cycle, wait for the next one
+            return now + position.remaining + self.period - window[1] + 1
+        return now + max(0, position.remaining - window[1] + 1)
+
+    def plan(self, positions, excess, window=LIVE_WINDOW, now=None):
+        """ Which ranked positions to drop, and when, to shed excess units of capacity.
+
+            Positions that would take more than what is left of excess are
+            skipped, so the plan never goes under the target.
+        """
+        now = now if now is not None else time.time()
+        plan = []
+        for position in positions:
+            if excess <= 0:
+                break
+            if position.weight > excess:
+                continue
+            at = now if self.due(position, window) else self.when(position, window, now)
+            plan.append(Demotion(position, at))
+            excess -= position.weight
+        plan.sort(key=lambda x: x.at)
+        return plan
+
+
+def instance_id_of(resource):
+    """ Instance id of a spot request or of an instance. """
+    if hasattr(resource, 'instance_id'):
+        return resource.instance_id
+    return resource.id
+
+
+def launch_epochs(instances):
+    """ Launch times of instances, indexed by id, as UTC epochs. """
+    return dict([(x.id, parse_timestamp(x.launch_time)) for x in instances if getattr(x, 'launch_time', None)])
@@ -0,0 +1,235 @@
+""" Dry runs: what tiopatinhas would do, without doing it.
+
+    ShadowTPManager runs the same save_money() cycles as TPManager against
+    the real inventory, but every call that would change something (bids,
+    purchases, LB registrations, cancellations and terminations) is
+    recorded in the cycle's plan instead of being made. Each plan is one
+    JSON line in plan_file, or on stdout. Nothing is journaled, the
+    forecast history isn't saved and no lease is taken (see lease.py), so
+    a shadow can run next to the tiopatinhas that really manages the group.
+
+    Usage: python shadow.py -g group -c tp.conf [-c other.conf ...] [-n cycles]
+           python shadow.py -d old.plan new.plan
+
+    The first form plans the group with each configuration side by side,
+    from the same inventory snapshot every cycle, into <conf>.plan. The
+    second one compares two plan files cycle by cycle.
+"""
+
+import sys
+import threading
+import time
+import simplejson as json
+from collections import defaultdict
+
+from tp import TPManager
+
+# properties worth comparing plans across, copied into every plan
+TUNING = ("cool_down_threshold", "bid_threshold", "billing", "max_candidates", "max_pool_share", "forecast")
+
+_plan_lock = threading.Lock()
+
+
+def write_plan(path, plan):
+    line = json.dumps(plan, sort_keys=True)
+    with _plan_lock:
+        if path:
+            with open(path, 'a') as f:
+                f.write(line + "\n")
+        else:
+            print line
+            sys.stdout.flush()
+
+
+def read_plans(path):
+    with open(path) as f:
+        return [json.loads(x) for x in f if x.strip()]
+
+
+class ShadowTPManager(TPManager):
+    # a dry run takes no lease away from the replicas doing the real work
+    coordinated = False
+
+    def __init__(self, side_group, plan_file=None, **kwargs):
+        TPManager.__init__(self, side_group, **kwargs)
+        # the journal and the forecast history belong to the tiopatinhas doing the real work
+        self.journal = None
+        if self.forecaster is not None:
+            self.forecaster.path = None
+        self.plan_file = plan_file or self.conf.plan_file
+        self.cycle = 0
+        self.actions = []
+
+    def record(self, action, **detail):
+        self.decided(action, **detail)
+        detail["action"] = action
+        detail["phase"] = self.current_phase
+        self.actions.append(detail)
+        self.logger.info(">> %s(): dry run, not done: %s", action, detail)
+
+    def buy(self, units=1):
+        amount = self.instances_for(units, self.emergency_type)
+        if amount > 0:
+            self.record("buy", count=amount, instance_type=self.emergency_type)
+
+    def request_spot(self, spot_type, zone, subnet_id, count):
+        self.record("bid", count=count, instance_type=spot_type, zone=zone or subnet_id,
+                    price=self.max_price[spot_type])
+        return []
+
+    def attach_instances(self, instance_ids, infix):
+        if instance_ids:
+            self.record("promote" if infix == "TP" else "attach", ids=list(instance_ids))
+
+    def dettach_instances(self, instance_ids):
+        if instance_ids:
+            self.record("detach", ids=list(instance_ids))
+
+    def cancel_bids(self, request_ids):
+        self.record("cancel", ids=list(request_ids))
+
+    def terminate_instances(self, instance_ids):
+        self.record("terminate", ids=list(instance_ids))
+
+    def retire(self, requests):
+        self.record("demote", ids=[x.instance_id for x in requests])
+        for request in requests:
+            del self.live[request.instance_id]
+            self.interruptions.forget(request.instance_id)
+
+    def tick(self):
+        self.actions = []
+        self.current_phase = None
+        succeeded = TPManager.tick(self)
+        write_plan(self.plan_file, self.plan(succeeded))
+        self.cycle += 1
+        return succeeded
+
+    def plan(self, succeeded=True):
+        conf = dict([(x, self.conf[x]) for x in TUNING if x in self.conf])
+        conf["weight_factor"] = self.weight_factor
+        return {"cycle": self.cycle,
+                "time": time.time(),
+                "group": self.side_group,
+                "ok": succeeded,
+                "conf": conf,
+                "target": self.target,
+                "managed": self.managed_instances(),
+                "live": len(self.live),
+                "emergency": len(self.emergency),
+                "bids": len(self.bids),
+                "actions": self.actions}
+
+
+def describe(action):
+    if "ids" in action:
+        return "%s %s" % (action["action"], ",".join(sorted(action["ids"])))
+    if "zone" in action:
+        return "%s %s %s/%s" % (action["action"], action["count"], action["instance_type"], action["zone"])
+    return "%s %s %s" % (action["action"], action["count"], action["instance_type"])
+
+
+def units(actions):
+    """ Instances (or bids) per kind of action. """
+    totals = defaultdict(int)
+    for action in actions:
+        totals[action["action"]] += len(action["ids"]) if "ids" in action else action["count"]
+    return totals
+
+
+def diff(old, new):
+    """ Compares two lists of plans cycle by cycle.
+
+        Returns the action totals of each side and the cycles whose actions
+        differ, as (cycle, old actions, new actions) with actions described
+        as sorted strings.
+    """
+    totals = (units([a for x in old for a in x["actions"]]),
+              units([a for x in new for a in x["actions"]]))
+    changed = []
+    for before, after in zip(old, new):
+        described = (sorted([describe(x) for x in before["actions"]]),
+                     sorted([describe(x) for x in after["actions"]]))
+        if described[0] != described[1]:
+            changed.append((before["cycle"], described[0], described[1]))
+    return totals, changed
+
+
+def side_by_side(group, conf_files, cycles=None):
+    """ Plans group with each configuration, from one inventory snapshot per cycle. """
+    from cache import TTLCache
+    from client import rate_limiter
+    from client import throttled
+    from connections import Connections
+    from inventory import RegionInventory
+    from tp import read_conf
+
+    connections = Connections()
+    cache = TTLCache()
+    limiter = rate_limiter(read_conf(conf_files[0]))
+    shared = {}
+    managers = []
+    for conf_file in conf_files:
+        conf = read_conf(conf_file)
+        region = conf.region
+        if region not in shared:
+            # refreshed once per cycle below, never in between
+            ec2 = throttled(connections.ec2(region), limiter, 'ec2', region)
+            shared[region] = RegionInventory(ec2, max_age=float("inf"))
+        manager = ShadowTPManager(group, plan_file=conf_file + ".plan", conf_file=conf_file, cache=cache,
+                                  connections=connections, shared_inventory=shared[region],
+                                  limiter=limiter)
+        manager.start()
+        managers.append(manager)
+
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        for inventory in shared.values():
+            inventory.invalidate()
+        delays = [x.next_delay(x.tick()) for x in managers]
+        cycle += 1
+        if cycles is None or cycle < cycles:
+            time.sleep(min(delays))
+
+
+if __name__ == '__main__':
+    import getopt
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "g:c:n:d", ["group=", "conf=", "cycles=", "diff"])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__
+        sys.exit(2)
+
+    group = None
+    conf_files = []
+    cycles = None
+    compare = False
+    for o, a in opts:
+        if o in ("-g", "--group"):
+            group = a
+        elif o in ("-c", "--conf"):
+            conf_files.append(a)
+        elif o in ("-n", "--cycles"):
+            cycles = int(a)
+        elif o in ("-d", "--diff"):
+            compare = True
+
+    if compare:
+        if len(args) != 2:
+            print __doc__
+            sys.exit(2)
+        old, new = read_plans(args[0]), read_plans(args[1])
+        (old_totals, new_totals), changed = diff(old, new)
+        print "cycles: %s in %s, %s in %s" % (len(old), args[0], len(new), args[1])
+        for action in sorted(set(old_totals) | set(new_totals)):
+            print "  %-10s %6s -> %s" % (action, old_totals.get(action, 0), new_totals.get(action, 0))
+        print "cycles with different actions: %s" % len(changed)
+        for cycle, before, after in changed:
+            print "  cycle %s: %s | %s" % (cycle, "; ".join(before) or "-", "; ".join(after) or "-")
+    else:
+        if not group or not conf_files:
+            print __doc__
+            sys.exit(2)
+        side_by_side(group, conf_files, cycles)
@@ -0,0 +1,728 @@
+""" In-process stand-in for the EC2, ELB and AutoScaling APIs used by tiopatinhas.
+
+    A Cloud holds every simulated resource and a virtual clock. The fake
+    connections it hands out mimic the boto surfaces TPManager calls, count
+    every call per API name and can inject latency, throttling and spot
+    interruptions, which is enough to replay scenarios offline.
+"""
+
+import random
+import time as _time
+from collections import defaultdict
+from datetime import datetime as _datetime
+
+from boto.exception import BotoServerError
+from boto.exception import EC2ResponseError
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+EC2_ERROR = ('<Response><Errors><Error><Code>%s</Code><Message>%s</Message></Error></Errors>'
+             '<RequestID>sim</RequestID></Response>')
+
+
+def ec2_error(code, message=""):
+    return EC2ResponseError(400, 'Bad Request', EC2_ERROR % (code, message))
+
+
+def service_error(code, message=""):
+    return BotoServerError(400, 'Bad Request', {'Error': {'Code': code, 'Message': message}})
+
+
+class SimClock(object):
+    """ Virtual time, starting at a fixed epoch unless told otherwise. """
+
+    def __init__(self, start=1500000000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.now += max(0, seconds)
+
+    def utcnow(self):
+        return _datetime.utcfromtimestamp(self.now)
+
+
+class FakeTimeModule(object):
+    """ Drop-in for the time module whose clock is a SimClock. """
+
+    def __init__(self, clock):
+        self._clock = clock
+
+    def time(self):
+        return self._clock.time()
+
+    def sleep(self, seconds):
+        self._clock.sleep(seconds)
+
+    def __getattr__(self, name):
+        return getattr(_time, name)
+
+
+def fake_datetime(clock):
+    class FakeDatetime(_datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.utcfromtimestamp(clock.now)
+
+        @classmethod
+        def utcnow(cls):
+            return cls.utcfromtimestamp(clock.now)
+
+    return FakeDatetime
+
+
+class patched_clock(object):
+    """ Context manager pointing the time/datetime names of modules at a SimClock. """
+
+    def __init__(self, clock, *modules):
+        self.clock = clock
+        self.modules = modules
+        self.saved = []
+
+    def __enter__(self):
+        fake_time = FakeTimeModule(self.clock)
+        fake_dt = fake_datetime(self.clock)
+        for module in self.modules:
+            for name, fake in (('time', fake_time), ('datetime', fake_dt)):
+                if hasattr(module, name):
+                    self.saved.append((module, name, getattr(module, name)))
+                    setattr(module, name, fake)
+        return self.clock
+
+    def __exit__(self, *exc):
+        for module, name, original in reversed(self.saved):
+            setattr(module, name, original)
+        self.saved = []
+
+
+class ResultSet(list):
+    next_token = None
+
+
+class Status(object):
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return "<Status %s>" % self.code
+
+
+class LaunchSpecification(object):
+    def __init__(self, instance_type, placement, image_id):
+        self.instance_type = instance_type
+        self.placement = placement
+        self.image_id = image_id
+
+
+class FakeResource(object):
+    """ Like boto objects, fake resources make their own calls through .connection,
+        so proxies wrapped around the connection that returned them see those calls too.
+    """
+
+    service = 'ec2'
+    _connection = None
+
+    @property
+    def connection(self):
+        return self._connection or getattr(self.cloud, self.service + '_connection')()
+
+    @connection.setter
+    def connection(self, value):
+        self._connection = value
+
+
+class FakeInstance(FakeResource):
+    def __init__(self, cloud, instance_id, instance_type, placement, spot_request_id=None):
+        self.cloud = cloud
+        self.id = instance_id
+        self.instance_type = instance_type
+        self.placement = placement
+        self.spot_instance_request_id = spot_request_id
+        self.state = "pending"
+        self.launched_at = cloud.clock.now
+        self.launch_time = _datetime.utcfromtimestamp(cloud.clock.now).strftime(TIME_FORMAT)
+        self.tags = {}
+        self.interrupt_at = None
+
+    @property
+    def state_name(self):
+        return self.state
+
+    def update(self):
+        self.cloud.call('DescribeInstances')
+        return self.state
+
+    def add_tag(self, key, value=''):
+        self.connection.create_tags([self.id], {key: value})
+
+    def __repr__(self):
+        return "Instance:%s" % self.id
+
+
+class Reservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeSpotRequest(FakeResource):
+    def __init__(self, cloud, request_id, price, instance_type, placement, image_id):
+        self.cloud = cloud
+        self.id = request_id
+        self.price = price
+        self.state = "open"
+        self.status = Status("pending-evaluation")
+        self.instance_id = None
+        self.tags = {}
+        self.created_at = cloud.clock.now
+        self.launch_specification = LaunchSpecification(instance_type, placement, image_id)
+        self.launched_availability_zone = None
+
+    @property
+    def instance_type(self):
+        return self.launch_specification.instance_type
+
+    def cancel(self):
+        self.connection.cancel_spot_instance_requests([self.id])
+
+    def add_tag(self, key, value=''):
+        self.connection.create_tags([self.id], {key: value})
+
+    def __repr__(self):
+        return "SpotInstanceRequest:%s" % self.id
+
+
+class InstanceState(object):
+    def __init__(self, instance_id, state):
+        self.instance_id = instance_id
+        self.state = state
+
+    def __repr__(self):
+        return "InstanceState:(%s,%s)" % (self.instance_id, self.state)
+
+
+class PricePoint(object):
+    def __init__(self, timestamp, price, instance_type, availability_zone):
+        self.timestamp = timestamp
+        self.price = price
+        self.instance_type = instance_type
+        self.availability_zone = availability_zone
+
+
+class FakeImage(FakeResource):
+    def __init__(self, cloud, image_id):
+        self.cloud = cloud
+        self.id = image_id
+
+    def run(self, min_count=1, max_count=1, instance_type='m1.small', placement=None, **kwargs):
+        return self.connection.run_instances(self.id, min_count=min_count, max_count=max_count,
+                                             instance_type=instance_type, placement=placement, **kwargs)
+
+
+class FakeLoadBalancer(FakeResource):
+    service = 'elb'
+
+    def __init__(self, cloud, name):
+        self.cloud = cloud
+        self.name = name
+        self.instances = set()
+
+    def get_instance_health(self, instances=None):
+        return self.connection.describe_instance_health(self.name, instances)
+
+    def register_instances(self, instances):
+        return self.connection.register_instances(self.name, instances)
+
+    def deregister_instances(self, instances):
+        return self.connection.deregister_instances(self.name, instances)
+
+    def __repr__(self):
+        return "LoadBalancer:%s" % self.name
+
+
+class FakeGroup(object):
+    def __init__(self, name, launch_config_name, load_balancers, desired_capacity):
+        self.name = name
+        self.launch_config_name = launch_config_name
+        self.load_balancers = load_balancers
+        self.desired_capacity = desired_capacity
+        self.instance_ids = []
+
+
+class FakeLaunchConfiguration(object):
+    def __init__(self, name, instance_type, image_id, security_groups=None, user_data=None):
+        self.name = name
+        self.instance_type = instance_type
+        self.image_id = image_id
+        self.security_groups = security_groups or []
+        self.user_data = user_data
+
+
+def as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def matches(resource, filters):
+    for name, expected in (filters or {}).items():
+        expected = as_list(expected)
+        if name.startswith('tag:'):
+            value = resource.tags.get(name[4:], None)
+        elif name == 'tag-key':
+            if not [x for x in expected if x in resource.tags]:
+                return False
+            continue
+        elif name in ('instance-state-name', 'state'):
+            value = resource.state
+        elif name in ('instance-id', 'spot-instance-request-id'):
+            value = resource.id
+        elif name == 'instance-type':
+            value = resource.instance_type
+        else:
+            raise service_error('InvalidParameterValue', 'Unsupported filter %s' % name)
+
+        if value not in expected:
+            return False
+    return True
+
+
+class Cloud(object):
+    """ Every simulated resource plus the knobs used to misbehave.
+
+        latency:             virtual seconds each API call takes
+        max_calls_per_second: calls per API family per virtual second
+                             before RequestLimitExceeded/Throttling
+        throttle_probability: chance of a call being throttled anyway
+        fulfillment_delay:   seconds for a spot request to be fulfilled
+        boot_delay:          seconds for an instance to be running
+        health_delay:        seconds for a running instance to be InService
+        interruption_notice: seconds between marked-for-termination and
+                             the instance being taken away
+        page_size:           default page size of DescribeInstances
+    """
+
+    def __init__(self, clock=None, seed=0, latency=0.05, max_calls_per_second=None, throttle_probability=0.0,
+                 fulfillment_delay=60, boot_delay=90, health_delay=30, interruption_notice=120, page_size=1000,
+                 region="us-east-1"):
+        self.clock = clock or SimClock()
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.max_calls_per_second = max_calls_per_second
+        self.throttle_probability = throttle_probability
+        self.fulfillment_delay = fulfillment_delay
+        self.boot_delay = boot_delay
+        self.health_delay = health_delay
+        self.interruption_notice = interruption_notice
+        self.page_size = page_size
+        self.region = region
+
+        self.instances = {}
+        self.spot_requests = {}
+        self.groups = {}
+        self.launch_configurations = {}
+        self.load_balancers = {}
+        self.prices = {}
+        self.default_price = 0.1
+        self.flapping = set()
+        # callables receiving the EventBridge events of interruptions and rebalance recommendations
+        self.subscribers = []
+
+        self.calls = defaultdict(int)
+        self.throttled = defaultdict(int)
+        self._window = defaultdict(list)
+        self._ids = 0
+
+        self._ec2 = FakeEC2Connection(self)
+        self._elb = FakeELBConnection(self)
+        self._autoscale = FakeAutoscaleConnection(self)
+
+    # -- plumbing
+
+    def next_id(self, prefix):
+        self._ids += 1
+        return "%s-%08x" % (prefix, self._ids)
+
+    def ec2_connection(self):
+        return self._ec2
+
+    def elb_connection(self):
+        return self._elb
+
+    def autoscale_connection(self):
+        return self._autoscale
+
+    def connections(self):
+        return FakeConnections(self)
+
+    def call(self, api, family='ec2'):
+        """ Accounts for one API call, raising a throttling error if due. """
+        self.clock.advance(self.latency)
+        now = self.clock.now
+
+        throttled = self.random.random() < self.throttle_probability
+        if self.max_calls_per_second:
+            window = [x for x in self._window[family] if now - x < 1]
+            throttled = throttled or len(window) >= self.max_calls_per_second
+            window.append(now)
+            self._window[family] = window
+
+        self.calls[api] += 1
+        if throttled:
+            self.throttled[api] += 1
+            if family == 'ec2':
+                raise ec2_error('RequestLimitExceeded', 'Request limit exceeded.')
+            raise service_error('Throttling', 'Rate exceeded')
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    # -- setup
+
+    def add_group(self, name, desired_capacity=2, instance_type="c1.xlarge", load_balancers=None,
+                  image_id="ami-00000001", placement="us-east-1a"):
+        lb_names = load_balancers if load_balancers is not None else [name + "-lb"]
+        lc_name = name + "-lc"
+        self.launch_configurations[lc_name] = FakeLaunchConfiguration(lc_name, instance_type, image_id)
+        for lb_name in lb_names:
+            self.load_balancers.setdefault(lb_name, FakeLoadBalancer(self, lb_name))
+
+        group = FakeGroup(name, lc_name, lb_names, 0)
+        group.placement = placement
+        self.groups[name] = group
+        self.set_capacity(name, desired_capacity, boot=False)
+        return group
+
+    def set_capacity(self, name, desired_capacity, boot=True):
+        """ Changes the group's desired capacity and launches/kills its own instances accordingly. """
+        group = self.groups[name]
+        group.desired_capacity = desired_capacity
+        lc = self.launch_configurations[group.launch_config_name]
+
+        alive = [x for x in group.instance_ids if self.instances[x].state in ('pending', 'running')]
+        while len(alive) < desired_capacity:
+            instance = self.launch(lc.instance_type, group.placement)
+            instance.tags['aws:autoscaling:groupName'] = name
+            if not boot:
+                instance.state = "running"
+                instance.launched_at -= self.boot_delay + self.health_delay
+            alive.append(instance.id)
+            for lb_name in group.load_balancers:
+                self.load_balancers[lb_name].instances.add(instance.id)
+
+        while len(alive) > desired_capacity:
+            instance_id = alive.pop()
+            for lb_name in group.load_balancers:
+                self.load_balancers[lb_name].instances.discard(instance_id)
+            self.kill(instance_id)
+        group.instance_ids = alive
+
+    def set_price(self, price, instance_type=None, availability_zone=None):
+        for pool in self.pools(instance_type, availability_zone):
+            self.prices[pool] = price
+        if instance_type is None and availability_zone is None:
+            self.default_price = price
+
+    def pools(self, instance_type=None, availability_zone=None):
+        pools = set(self.prices.keys())
+        pools.update((x.instance_type, x.placement) for x in self.instances.values())
+        if instance_type or availability_zone:
+            pools.add((instance_type, availability_zone))
+        return [p for p in pools
+                if (instance_type is None or p[0] == instance_type) and
+                (availability_zone is None or p[1] == availability_zone)]
+
+    def price(self, instance_type, availability_zone):
+        return self.prices.get((instance_type, availability_zone), self.default_price)
+
+    # -- lifecycle
+
+    def launch(self, instance_type, placement, spot_request_id=None):
+        instance = FakeInstance(self, self.next_id("i"), instance_type, placement, spot_request_id)
+        self.instances[instance.id] = instance
+        return instance
+
+    def kill(self, instance_id):
+        instance = self.instances.get(instance_id)
+        if instance is None:
+            return
+        instance.state = "terminated"
+        request = self.spot_requests.get(instance.spot_instance_request_id)
+        if request is not None and request.state == 'active':
+            request.state = "closed"
+            request.status = Status("instance-terminated-by-user")
+
+    def interrupt(self, fraction=1.0, instance_type=None, availability_zone=None, code='instance-terminated-by-price'):
+        """ Sends the interruption notice to a fraction of the active spot instances of a pool. """
+        candidates = [r for r in self.spot_requests.values()
+                      if r.state == 'active' and r.instance_id and
+                      (instance_type is None or r.instance_type == instance_type) and
+                      (availability_zone is None or r.launched_availability_zone == availability_zone)]
+        chosen = self.random.sample(candidates, int(round(len(candidates) * fraction)))
+        for request in chosen:
+            request.status = Status("marked-for-termination")
+            request.interruption_code = code
+            self.instances[request.instance_id].interrupt_at = self.clock.now + self.interruption_notice
+            self.publish("EC2 Spot Instance Interruption Warning",
+                         {"instance-id": request.instance_id, "instance-action": "terminate"})
+        return [x.instance_id for x in chosen]
+
+    def recommend_rebalance(self, fraction=1.0, instance_type=None, availability_zone=None):
+        """ Sends a rebalance recommendation for a fraction of the active spot instances of a pool. """
+        candidates = [r for r in self.spot_requests.values()
+                      if r.state == 'active' and r.instance_id and
+                      (instance_type is None or r.instance_type == instance_type) and
+                      (availability_zone is None or r.launched_availability_zone == availability_zone)]
+        chosen = self.random.sample(candidates, int(round(len(candidates) * fraction)))
+        for request in chosen:
+            self.publish("EC2 Instance Rebalance Recommendation", {"instance-id": request.instance_id})
+        return [x.instance_id for x in chosen]
+
+    def publish(self, detail_type, detail):
+        for subscriber in self.subscribers:
+            subscriber({"detail-type": detail_type, "source": "aws.ec2", "detail": detail})
+
+    def crash(self, price=10.0, instance_type=None, availability_zone=None):
+        """ Raises the market price of a pool over every bid and interrupts the spot instances there. """
+        self.set_price(price, instance_type, availability_zone)
+        return self.interrupt(1.0, instance_type, availability_zone)
+
+    def step(self):
+        """ Moves every resource forward to the current virtual time. """
+        now = self.clock.now
+        for request in self.spot_requests.values():
+            if request.state != 'open' or now - request.created_at < self.fulfillment_delay:
+                continue
+            spec = request.launch_specification
+            if float(request.price) < self.price(spec.instance_type, spec.placement):
+                request.status = Status("price-too-low")
+                continue
+            instance = self.launch(spec.instance_type, spec.placement, request.id)
+            request.state = "active"
+            request.status = Status("fulfilled")
+            request.instance_id = instance.id
+            request.launched_availability_zone = spec.placement
+
+        for instance in self.instances.values():
+            if instance.state == 'pending' and now - instance.launched_at >= self.boot_delay:
+                instance.state = "running"
+            if instance.interrupt_at is not None and now >= instance.interrupt_at and instance.state == 'running':
+                instance.state = "terminated"
+                request = self.spot_requests.get(instance.spot_instance_request_id)
+                if request is not None:
+                    request.state = "closed"
+                    request.status = Status(getattr(request, 'interruption_code', 'instance-terminated-by-price'))
+
+    def health(self, instance_id):
+        instance = self.instances.get(instance_id)
+        if instance is None or instance.state != 'running':
+            return 'OutOfService'
+        if instance_id in self.flapping and self.random.random() < 0.5:
+            return 'OutOfService'
+        if self.clock.now - instance.launched_at < self.boot_delay + self.health_delay:
+            return 'OutOfService'
+        return 'InService'
+
+    # -- reporting
+
+    def dead_in_lb(self):
+        """ LB members whose instance is no longer running, still getting traffic. """
+        return sum([len([x for x in lb.instances if self.instances.get(x) is None or
+                         self.instances[x].state != 'running'])
+                    for lb in self.load_balancers.values()])
+
+    def on_demand(self):
+        """ Instances launched neither by a spot request nor by a group, the emergency ones. """
+        return [x for x in self.instances.values()
+                if x.spot_instance_request_id is None and 'aws:autoscaling:groupName' not in x.tags]
+
+    def tp_spot(self, side_group):
+        return [r for r in self.spot_requests.values() if r.tags.get('tp:tag') == side_group]
+
+    def tp_live(self, side_group, lb_name):
+        lb = self.load_balancers[lb_name]
+        spot = [r.instance_id for r in self.tp_spot(side_group) if r.instance_id in lb.instances]
+        emergency = [x.id for x in self.instances.values()
+                     if x.tags.get('tp:group') == side_group and x.id in lb.instances and x.state == 'running']
+        return spot + emergency
+
+
+class FakeEC2Connection(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_all_reservations(self, instance_ids=None, filters=None, dry_run=False, max_results=None,
+                             next_token=None):
+        self.cloud.call('DescribeInstances')
+        found = self._select(instance_ids, filters)
+        page = max_results or self.cloud.page_size
+        start = int(next_token or 0)
+
+        result = ResultSet([Reservation([x]) for x in found[start:start + page]])
+        if start + page < len(found):
+            result.next_token = str(start + page)
+        return result
+
+    def get_all_instances(self, instance_ids=None, filters=None, dry_run=False, max_results=None):
+        return self.get_all_reservations(instance_ids, filters, dry_run, max_results=max_results or 10 ** 9)
+
+    def get_only_instances(self, instance_ids=None, filters=None, dry_run=False, max_results=None):
+        return list(self.get_all_reservations(instance_ids, filters, dry_run, max_results=10 ** 9))
+
+    def _select(self, instance_ids, filters):
+        instances = self.cloud.instances
+        if instance_ids:
+            missing = [x for x in instance_ids if x not in instances]
+            if missing:
+                raise ec2_error('InvalidInstanceID.NotFound', "The instance IDs '%s' do not exist" % missing)
+            selected = [instances[x] for x in instance_ids]
+        else:
+            selected = sorted(instances.values(), key=lambda x: x.id)
+        return [x for x in selected if matches(x, filters)]
+
+    def get_all_instance_status(self, instance_ids=None, max_results=None, next_token=None, filters=None,
+                                dry_run=False, include_all_instances=False):
+        self.cloud.call('DescribeInstanceStatus')
+        found = self._select(instance_ids, filters)
+        if not include_all_instances:
+            found = [x for x in found if x.state == 'running']
+        return ResultSet(found)
+
+    def get_all_spot_instance_requests(self, request_ids=None, filters=None, dry_run=False):
+        self.cloud.call('DescribeSpotInstanceRequests')
+        requests = self.cloud.spot_requests
+        if request_ids:
+            selected = [requests[x] for x in request_ids if x in requests]
+        else:
+            selected = sorted(requests.values(), key=lambda x: x.id)
+        return ResultSet([x for x in selected if matches(x, filters)])
+
+    def request_spot_instances(self, price, image_id, count=1, type='one-time', placement=None,
+                               instance_type='m1.small', **kwargs):
+        self.cloud.call('RequestSpotInstances')
+        requests = ResultSet()
+        for i in range(count):
+            request = FakeSpotRequest(self.cloud, self.cloud.next_id("sir"), price, instance_type,
+                                      placement or "us-east-1a", image_id)
+            self.cloud.spot_requests[request.id] = request
+            requests.append(request)
+        return requests
+
+    def cancel_spot_instance_requests(self, request_ids, dry_run=False):
+        self.cloud.call('CancelSpotInstanceRequests')
+        cancelled = []
+        for request_id in request_ids:
+            request = self.cloud.spot_requests.get(request_id)
+            if request is None:
+                continue
+            if request.state in ('open', 'active'):
+                request.status = Status("request-canceled-and-instance-running"
+                                        if request.state == 'active' else "canceled-before-fulfillment")
+                request.state = "cancelled"
+            cancelled.append(request)
+        return cancelled
+
+    def terminate_instances(self, instance_ids=None, dry_run=False):
+        self.cloud.call('TerminateInstances')
+        for instance_id in instance_ids or []:
+            self.cloud.kill(instance_id)
+        return [self.cloud.instances[x] for x in instance_ids or [] if x in self.cloud.instances]
+
+    def create_tags(self, resource_ids, tags, dry_run=False):
+        self.cloud.call('CreateTags')
+        for resource_id in resource_ids:
+            resource = self.cloud.instances.get(resource_id) or self.cloud.spot_requests.get(resource_id)
+            if resource is None:
+                raise ec2_error('InvalidID', "The ID '%s' is not valid" % resource_id)
+            resource.tags.update(tags)
+        return True
+
+    def get_image(self, image_id, dry_run=False):
+        self.cloud.call('DescribeImages')
+        return FakeImage(self.cloud, image_id)
+
+    def run_instances(self, image_id, min_count=1, max_count=1, instance_type='m1.small', placement=None,
+                      **kwargs):
+        self.cloud.call('RunInstances')
+        instances = [self.cloud.launch(instance_type, placement or "us-east-1a") for i in range(max_count)]
+        return Reservation(instances)
+
+    def get_spot_price_history(self, start_time=None, end_time=None, instance_type=None,
+                               product_description=None, availability_zone=None, dry_run=False,
+                               max_results=None, next_token=None, filters=None):
+        self.cloud.call('DescribeSpotPriceHistory')
+        timestamp = _datetime.utcfromtimestamp(self.cloud.clock.now).strftime(TIME_FORMAT)
+        points = ResultSet()
+        for pool in sorted(self.cloud.pools(instance_type, availability_zone)):
+            if pool[0] is None or pool[1] is None:
+                continue
+            points.append(PricePoint(timestamp, self.cloud.price(*pool), pool[0], pool[1]))
+        return points
+
+
+class FakeELBConnection(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_all_load_balancers(self, load_balancer_names=None, marker=None):
+        self.cloud.call('DescribeLoadBalancers', 'elb')
+        lbs = self.cloud.load_balancers
+        names = load_balancer_names or sorted(lbs.keys())
+        missing = [x for x in names if x not in lbs]
+        if missing:
+            raise service_error('LoadBalancerNotFound', "Cannot find Load Balancer %s" % missing[0])
+        return ResultSet([lbs[x] for x in names])
+
+    def describe_instance_health(self, load_balancer_name, instances=None):
+        self.cloud.call('DescribeInstanceHealth', 'elb')
+        lb = self.cloud.load_balancers[load_balancer_name]
+        ids = as_list(instances) or sorted(lb.instances)
+        return ResultSet([InstanceState(x, self.cloud.health(x)) for x in ids])
+
+    def register_instances(self, load_balancer_name, instances):
+        self.cloud.call('RegisterInstancesWithLoadBalancer', 'elb')
+        lb = self.cloud.load_balancers[load_balancer_name]
+        lb.instances.update(as_list(instances))
+        return sorted(lb.instances)
+
+    def deregister_instances(self, load_balancer_name, instances):
+        self.cloud.call('DeregisterInstancesFromLoadBalancer', 'elb')
+        lb = self.cloud.load_balancers[load_balancer_name]
+        lb.instances.difference_update(as_list(instances))
+        return sorted(lb.instances)
+
+
+class FakeAutoscaleConnection(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_all_groups(self, names=None, max_records=None, next_token=None):
+        self.cloud.call('DescribeAutoScalingGroups', 'autoscale')
+        groups = self.cloud.groups
+        return ResultSet([groups[x] for x in (names or sorted(groups.keys())) if x in groups])
+
+    def get_all_launch_configurations(self, names=None, max_records=None, next_token=None):
+        self.cloud.call('DescribeLaunchConfigurations', 'autoscale')
+        lcs = self.cloud.launch_configurations
+        return ResultSet([lcs[x] for x in (names or sorted(lcs.keys())) if x in lcs])
+
+
+class FakeConnections(object):
+    """ Same interface as connections.Connections, backed by a Cloud. """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def ec2(self, region):
+        return self.cloud.ec2_connection()
+
+    def elb(self, region):
+        return self.cloud.elb_connection()
+
+    def autoscale(self, region):
+        return self.cloud.autoscale_connection()
@@ -0,0 +1,269 @@
+import heapq
+import logging
+import random
+import threading
+import time
+import Queue
+
+from cache import TTLCache
+from client import rate_limiter
+from client import throttled
+from config import load
+from connections import Connections
+from events import WAKING
+from events import notice_sources
+from inventory import RegionInventory
+from lease import coordinator
+from market import PriceHistory
+from metrics import Metrics
+from metrics import instrument
+from metrics import start_exporters
+from parallel import Executor
+from parallel import Timers
+
+logger = logging.getLogger("supervisor")
+
+
+def parse_group(spec, default_region):
+    """ Accepts "group", "region/group" or a dict from the "groups" conf list. """
+    if isinstance(spec, dict):
+        group = dict(spec)
+        group.setdefault("region", default_region)
+        return group
+
+    if "/" in spec:
+        region, name = spec.split("/", 1)
+    else:
+        region, name = default_region, spec
+    return {"name": name, "region": region}
+
+
+class ManagedGroup(object):
+    def __init__(self, manager, interval):
+        self.manager = manager
+        self.interval = interval
+        self.ticks = 0
+        self.failures = 0
+
+    def __repr__(self):
+        return "<ManagedGroup %s/%s>" % (self.manager.region, self.manager.side_group)
+
+
+class Supervisor(object):
+    """ Runs many TPManagers in one process.
+
+        Managers share boto connections, the descriptor cache, the LB thread
+        pool and one inventory snapshot per region. Their save_money() ticks are
+        scheduled on a bounded pool of worker threads, each group with its
+        own reconciler deciding the next interval plus some jitter so groups
+        don't hit AWS in lockstep. Events reported to a group's reconciler
+        bring its next tick forward. A group is never ticked concurrently
+        with itself.
+
+        Managers that defer calls instead of sleeping (see aio.py) share
+        one Timers heap, whose due calls are run on the same workers.
+
+        With coordination on, one Coordinator decides for every group
+        whether this replica ticks it or keeps it warm (see lease.py).
+    """
+
+    def __init__(self, groups, manager_factory, conf=None, conf_file="tp.conf", debug=False, connections=None):
+        self.conf = conf or load(conf_file)
+        self.workers = self.conf.workers
+        self.jitter = self.conf.tick_jitter
+        default_region = self.conf.region
+
+        self.connections = connections or Connections()
+        self.cache = TTLCache(self.conf.descriptor_cache_ttl)
+        self.inventories = {}
+        self.histories = {}
+        self.executor = Executor(self.conf.lb_workers)
+        self.metrics = Metrics()
+        self.limiter = rate_limiter(self.conf)
+        self.timers = Timers()
+        self.coordinator = None
+        if getattr(manager_factory, "coordinated", True):
+            self.coordinator = coordinator(self.conf, self.metrics)
+
+        extra = {}
+        if getattr(manager_factory, "deferred", False):
+            extra["timers"] = self.timers
+
+        self.groups = []
+        for spec in groups:
+            group = parse_group(spec, default_region)
+            manager = manager_factory(group["name"],
+                                      weight_factor=group.get("weight_factor"),
+                                      debug=debug,
+                                      region=group["region"],
+                                      conf_file=conf_file,
+                                      cache=self.cache,
+                                      connections=self.connections,
+                                      shared_inventory=self.region_inventory(group["region"]),
+                                      executor=self.executor,
+                                      metrics=self.metrics,
+                                      limiter=self.limiter,
+                                      price_history=self.price_history(group["region"]),
+                                      coordinator=self.coordinator,
+                                      **extra)
+            if "interval" in group:
+                reconciler = manager.reconciler
+                reconciler.min_interval = reconciler.interval = group["interval"]
+                reconciler.max_interval = max(reconciler.max_interval, reconciler.min_interval)
+            managed = ManagedGroup(manager, manager.reconciler.min_interval)
+            manager.reconciler.listeners.append(self.waker(managed))
+            self.groups.append(managed)
+
+        # one set of notice sources feeds every group
+        self.sources = notice_sources(self.conf, [x.manager.reconciler for x in self.groups])
+
+        self._queue = Queue.Queue()
+        self._schedule = []
+        self._in_flight = 0
+        self._timers_queued = False
+        self._condition = threading.Condition()
+
+    def region_inventory(self, region):
+        if region not in self.inventories:
+            ec2 = self.connect(region)
+            self.inventories[region] = RegionInventory(ec2, self.conf.inventory_max_age)
+        return self.inventories[region]
+
+    def connect(self, region):
+        """ EC2 connection for the calls made on behalf of every group of a region. """
+        ec2 = instrument(self.connections.ec2(region), self.metrics, 'ec2', group="region:" + region)
+        return throttled(ec2, self.limiter, 'ec2', region)
+
+    def price_history(self, region):
+        """ One spot price history per region, only when bid_placement is on. """
+        if not self.conf.bid_placement:
+            return None
+        if region not in self.histories:
+            ec2 = self.connect(region)
+            path = self.conf.price_history_file
+            if path:
+                path = "%s.%s" % (path, region)
+            self.histories[region] = PriceHistory(ec2, path,
+                                                  self.conf.price_history_hours,
+                                                  self.conf.price_history_max_age,
+                                                  self.conf.product_description)
+        return self.histories[region]
+
+    def next_delay(self, group, succeeded):
+        return group.manager.next_delay(succeeded) * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def waker(self, group):
+        def wake(kind, detail):
+            # only notices and lease changes reschedule, events raised by the tick itself are settled after it
+            if kind in WAKING:
+                self.wake(group)
+        return wake
+
+    def wake(self, group):
+        """ Brings the next tick of a scheduled group forward to now. """
+        with self._condition:
+            for i, entry in enumerate(self._schedule):
+                if entry[2] is group:
+                    self._schedule[i] = (time.time(), entry[1], group)
+                    heapq.heapify(self._schedule)
+                    self._condition.notify()
+                    return
+
+    def schedule(self, group, delay):
+        with self._condition:
+            heapq.heappush(self._schedule, (time.time() + delay, id(group), group))
+            self._condition.notify()
+
+    def active(self):
+        with self._condition:
+            return bool(self._schedule) or self._in_flight > 0 or len(self.timers) > 0
+
+    def work(self):
+        while True:
+            group = self._queue.get()
+            if group is None:
+                return
+            if group is self.timers:
+                with self._condition:
+                    self._timers_queued = False
+                self.timers.run_due()
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify()
+                continue
+
+            try:
+                succeeded = group.manager.tick()
+                running = group.manager.running()
+                delay = self.next_delay(group, succeeded)
+            except Exception, e:
+                # a worker that dies leaves the group in flight for good
+                logger.exception(e)
+                succeeded, running = False, True
+                delay = group.manager.reconciler.max_interval
+            group.ticks += 1
+            if not succeeded:
+                group.failures += 1
+
+            with self._condition:
+                if running:
+                    heapq.heappush(self._schedule, (time.time() + delay, id(group), group))
+                else:
+                    logger.info("%s stopped running", group)
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def stop(self):
+        """ Asks every manager to wind down; run() returns once all of them did. """
+        for group in self.groups:
+            group.manager.stop()
+
+    def run(self):
+        logger.info("Supervising %s groups with %s workers", len(self.groups), self.workers)
+        threads = []
+        for i in range(min(self.workers, max(1, len(self.groups)))):
+            thread = threading.Thread(target=self.work, name="tp-worker-%s" % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for source in self.sources:
+            source.start()
+        exporters = start_exporters(self.metrics, self.conf)
+        if self.coordinator is not None:
+            self.coordinator.start()
+
+        for group in self.groups:
+            group.manager.start()
+            # spread the first ticks over one interval
+            self.schedule(group, random.uniform(0, group.interval))
+
+        while self.active():
+            with self._condition:
+                now = time.time()
+                while self._schedule and self._schedule[0][0] <= now:
+                    group = heapq.heappop(self._schedule)[2]
+                    self._in_flight += 1
+                    self._queue.put(group)
+
+                next_timer = self.timers.next_at()
+                if next_timer is not None and next_timer <= now and not self._timers_queued:
+                    self._timers_queued = True
+                    self._in_flight += 1
+                    self._queue.put(self.timers)
+
+                timeout = self._schedule[0][0] - now if self._schedule else 1
+                if next_timer is not None and not self._timers_queued:
+                    timeout = min(timeout, next_timer - now)
+                self._condition.wait(max(0.01, min(timeout, 1)))
+
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        for source in self.sources + exporters:
+            source.stop()
+        if self.coordinator is not None:
+            self.coordinator.stop()
+        self.executor.close()
+        logger.debug("Stopped supervising.")
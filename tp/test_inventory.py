@@ -0,0 +1,52 @@
+""" Regression tests for the shared region inventory.
+
+    Usage: python -m unittest test_inventory (from tp/)
+"""
+
+import unittest
+
+import sim
+from inventory import Inventory
+from inventory import RegionInventory
+
+
+class SharedInventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.cloud = sim.Cloud(latency=0)
+        self.cloud.add_group("a", 2)
+        self.cloud.add_group("b", 2)
+        self.ec2 = self.cloud.ec2_connection()
+        self.shared = RegionInventory(self.ec2, max_age=10)
+
+    def members(self, name):
+        return list(self.cloud.groups[name].instance_ids)
+
+    def test_lookup_after_another_group_refetched(self):
+        a = Inventory(self.ec2, "a", "a-tp", shared=self.shared)
+        b = Inventory(self.ec2, "b", "b-tp", shared=self.shared)
+        a.refresh()
+        # b finds the snapshot too old and fetches it again while a reads its LB
+        self.cloud.clock.advance(11)
+        b.refresh()
+        members = self.members("a")
+        a.lookup(members)
+        self.assertEqual([a.is_running(x) for x in members], [True, True])
+
+    def test_lookups_survive_the_next_refetch(self):
+        a = Inventory(self.ec2, "a", "a-tp", shared=self.shared)
+        members = self.members("a")
+        a.refresh(members)
+        self.shared.refresh(force=True)
+        self.assertEqual([a.is_running(x) for x in members], [True, True])
+
+    def test_refetch_drops_what_no_group_asks_for(self):
+        a = Inventory(self.ec2, "a", "a-tp", shared=self.shared)
+        members = self.members("a")
+        a.refresh(members)
+        self.shared.refresh(force=True)
+        self.shared.refresh(force=True)
+        self.assertEqual([a.state(x) for x in members], [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+""" Tests of TPManager cycles against the simulator.
+
+    Usage: python -m unittest test_tp (from tp/)
+"""
+
+import logging
+import os
+import tempfile
+import unittest
+import simplejson as json
+
+import bench
+import sim
+from tp import TPManager
+
+
+class ManagerTest(unittest.TestCase):
+    capacity = 2
+    load_balancers = None
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        self.cloud = sim.Cloud(latency=0)
+        self.cloud.add_group(bench.GROUP, self.capacity, load_balancers=self.load_balancers)
+        self.ec2 = self.cloud.ec2_connection()
+        conf_fd, self.conf_file = tempfile.mkstemp(suffix=".conf")
+        with os.fdopen(conf_fd, 'w') as f:
+            f.write(json.dumps(bench.DEFAULT_CONF))
+        self.clock = sim.patched_clock(self.cloud.clock, *bench.CLOCKED)
+        self.clock.__enter__()
+        self.manager = TPManager(bench.GROUP, conf_file=self.conf_file, connections=self.cloud.connections())
+        self.manager.start()
+
+    def tearDown(self):
+        self.manager.executor.close()
+        self.clock.__exit__(None, None, None)
+        os.remove(self.conf_file)
+        logging.disable(logging.NOTSET)
+
+    def tick(self, seconds=10):
+        self.cloud.clock.advance(seconds)
+        self.cloud.step()
+        return self.manager.tick()
+
+
+class PendingTest(ManagerTest):
+    def overdue(self):
+        return self.cloud.clock.now - self.manager.pending_timeout - 1
+
+    def test_bid_given_up_is_cancelled_with_its_instance(self):
+        self.tick()
+        # never tagged, so the inventory doesn't find it, and fulfilled meanwhile
+        request = self.ec2.request_spot_instances("0.70", "ami-00000001", instance_type="c1.xlarge")[0]
+        self.cloud.clock.advance(self.cloud.fulfillment_delay)
+        self.cloud.step()
+        self.manager.pending_bids[request.id] = (self.overdue(), "c1.xlarge")
+        self.assertTrue(self.tick())
+        self.assertNotIn(request.id, self.manager.pending_bids)
+        self.assertIn(request.state, ("cancelled", "closed"))
+        self.assertEqual(self.cloud.instances[request.instance_id].state, "terminated")
+
+    def test_launch_given_up_is_terminated(self):
+        self.tick()
+        instance = self.ec2.run_instances("ami-00000001", instance_type="c1.xlarge").instances[0]
+        self.manager.pending_launches[instance.id] = (self.overdue(), "c1.xlarge")
+        self.assertTrue(self.tick())
+        self.assertNotIn(instance.id, self.manager.pending_launches)
+        self.assertEqual(instance.state, "terminated")
+
+
+class LBHealthTest(ManagerTest):
+    load_balancers = ["a-lb", "b-lb"]
+
+    def fail(self, *names):
+        def failing(instances=None):
+            raise sim.service_error('Throttling', 'Rate exceeded')
+        for name in names:
+            self.cloud.load_balancers[name].get_instance_health = failing
+
+    def members(self, states):
+        return sorted([x.instance_id for x in states])
+
+    def test_failed_lb_uses_its_previous_health(self):
+        before = self.manager.read_lb_health()
+        self.fail("b-lb")
+        self.assertEqual(self.members(self.manager.read_lb_health()), self.members(before))
+
+    def test_failed_lb_never_read_is_left_out(self):
+        self.fail("b-lb")
+        members = sorted(self.cloud.load_balancers["a-lb"].instances)
+        self.assertEqual(self.members(self.manager.read_lb_health()), members)
+
+    def test_every_lb_failed_uses_their_previous_health(self):
+        before = self.manager.read_lb_health()
+        self.fail("a-lb", "b-lb")
+        self.assertEqual(self.members(self.manager.read_lb_health()), self.members(before))
+
+    def test_every_lb_failed_never_read_aborts(self):
+        self.fail("a-lb", "b-lb")
+        self.assertRaises(Exception, self.manager.read_lb_health)
+
+
+class PromotionTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_promotion_launches_no_emergency_instance(self):
+        # a promoted instance isn't InService right away, that's no market crash
+        result = bench.run(bench.scale_up())
+        self.assertEqual(result["on_demand"], 0)
+        self.assertEqual(result["final_live"], result["final_target"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,51 @@
 #!/usr/bin/env python
 
-import boto
 import time
 import os
 import logging
 import sys
-import simplejson as json
 from collections import defaultdict
-from boto import ec2
-from boto.ec2 import autoscale
-from boto.ec2 import elb
-from boto.exception import EC2ResponseError
-from itertools import chain
 from datetime import timedelta
 from datetime import datetime
+from boto.exception import EC2ResponseError
+from cache import TTLCache
+from client import rate_limiter
+from client import throttled
+from config import ConfigError
+from config import load as load_conf
+from connections import Connections
+from crash import CrashDetector
+from events import Reconciler
+from events import notice_sources
+from capacity import CapacityModel
+from cleanup import Cleanup
+from fleet import Registry
+from forecast import forecaster
+from interruptions import Interruption
+from interruptions import Interruptions
+from interruptions import NOTICE_SECONDS
+from interruptions import REBALANCE
+from interruptions import TERMINATION
+from interruptions import parse as parse_notice
+from inventory import Inventory
+from journal import Journal
+from journal import capture
+from journal import verify
+from lease import coordinator as replica_coordinator
+from market import BidPlacer
+from market import PriceHistory
+from metrics import Metrics
+from metrics import instrument
+from metrics import start_exporters
+from parallel import Executor
+from planner import DemotionPlanner
+from planner import EMERGENCY_WINDOW
+from planner import LIVE_WINDOW
+from planner import REPLACE_WINDOW
+from planner import instance_id_of
+from planner import launch_epochs
+from tracing import profiler
+from tracing import tracer
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
 logger = logging.getLogger("main")
@@ -25,23 +57,39 @@ class AutoScaleInfoException(Exception):
 
 
 class AutoScaleInfo:
-    def __init__(self, autoscale_group_name, region):
-        self.autoscale = boto.ec2.autoscale.connect_to_region(region)
-        aslist = []
-        aslist.append(autoscale_group_name)
-        ags = self.autoscale.get_all_groups(names=aslist)
+    # read from the group and its launch configuration, on first use rather than on creation
+    _described = ("ag", "instance_type", "image_id", "security_groups", "user_data", "load_balancers",
+                  "desired_capacity")
+
+    def __init__(self, autoscale_group_name, region, cache=None, capacity_ttl=15, descriptor_ttl=3600,
+                 autoscale=None):
+        self.autoscale = autoscale or Connections().autoscale(region)
         self.name = autoscale_group_name
+        self.region = region
+        self.cache = cache or TTLCache()
+        self.capacity_ttl = capacity_ttl
+        self.descriptor_ttl = descriptor_ttl
+        self.lc = None
+
+    def __getattr__(self, name):
+        if name not in self._described:
+            raise AttributeError(name)
+        self.refresh()
+        return self.__dict__[name]
 
-        try:
-            self.ag = [x for x in ags if x.name == self.name][0]
-        except:
-            raise ValueError("Couldn't retrieve autoscale group info for %s" % autoscale_group_name)
+    def refresh(self):
+        """ Re-reads the group, at most once per capacity_ttl.
 
-        try:
-            lcs = self.autoscale.get_all_launch_configurations(names=[self.ag.launch_config_name])
-            self.lc = lcs[0]
-        except:
-            raise ValueError("Couldn't retrieve LaunchConfiguration for %s" % autoscale_group_name)
+            The launch configuration is only fetched again when the group
+            points to a different one.
+        """
+        self.ag = self.cache.get(('asg', self.region, self.name), self._load_group, self.capacity_ttl)
+
+        if self.lc is None or self.lc.name != self.ag.launch_config_name:
+            if self.lc is not None:
+                self.cache.invalidate(('lc', self.region, self.lc.name))
+            self.lc = self.cache.get(('lc', self.region, self.ag.launch_config_name),
+                                     self._load_launch_configuration, self.descriptor_ttl)
 
         self.instance_type = self.lc.instance_type
         self.image_id = self.lc.image_id
@@ -51,49 +99,105 @@ class AutoScaleInfo:
         self.load_balancers = self.ag.load_balancers
         self.desired_capacity = self.ag.desired_capacity
 
+    def invalidate(self):
+        self.cache.invalidate(('asg', self.region, self.name))
+
+    def _load_group(self):
+        ags = self.autoscale.get_all_groups(names=[self.name])
+
+        try:
+            return [x for x in ags if x.name == self.name][0]
+        except:
+            raise ValueError("Couldn't retrieve autoscale group info for %s" % self.name)
+
+    def _load_launch_configuration(self):
+        try:
+            lcs = self.autoscale.get_all_launch_configurations(names=[self.ag.launch_config_name])
+            return lcs[0]
+        except:
+            raise ValueError("Couldn't retrieve LaunchConfiguration for %s" % self.name)
+
     def __repr__(self):
         return "<AutoScaleInfo Group:%s>" % self.name
 
 
 class TPManager:
-    def __init__(self, side_group, weight_factor=1.0, debug=False,
+    # takes part in the lease election when coordination is on, see lease.py
+    coordinated = True
+
+    def __init__(self, side_group, weight_factor=None, debug=False,
                  region=None, user_data=None, conf_file="tp.conf", az=None,
-                 spot_type=None, grace_period_minutes=10):
+                 spot_type=None, grace_period_minutes=10, cache=None, connections=None,
+                 shared_inventory=None, executor=None, metrics=None, price_history=None, limiter=None,
+                 coordinator=None):
         self.logger = logging.getLogger(side_group)
         if debug:
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
 
-        self.conf = defaultdict(dict)
-        try:
-            with open(conf_file, 'r') as f:
-                self.conf = json.loads(f.read())
-        except IOError:
-            self.logger.error("Configuration file " + conf_file + " not found.")
-            sys.exit(2)
+        self.conf = read_conf(conf_file, self.logger)
 
         self.grace_period_minutes = grace_period_minutes
-        self.max_price = self.conf.get("max_price", {"c1.xlarge": "0.750"})
-        self.spot_type = spot_type or self.conf.get("spot_type", "c1.xlarge")
-        self.emergency_type = self.conf.get("emergency_type", "c1.xlarge")
-        self.weight_factor = weight_factor
-        self.tags = self.conf.get("tags", {})
-        self.instance_profile_name = self.conf.get("instance_profile_name", None)
-        self.region = region or self.conf.get("region", "us-east-1")  # parameter has precedence over config file
-        self.subnet_id = self.conf.get("subnet_id", None)
-        self.monitoring_enabled = self.conf.get("monitoring_enabled", False)
-        self.cool_down_threshold = self.conf.get('cool_down_threshold', 360)
-        self.bid_threshold = self.conf.get('bid_threshold', 300)
+        self.max_price = self.conf.max_price
+        self.spot_type = spot_type or self.conf.spot_type
+        self.emergency_type = self.conf.emergency_type
+        # a "groups" item of the supervisor can override it for its group
+        self.weight_factor = self.conf.weight_factor if weight_factor is None else weight_factor
+        self.tags = self.conf.tags
+        self.instance_profile_name = self.conf.instance_profile_name
+        self.region = region or self.conf.region  # parameter has precedence over config file
+        self.subnet_id = self.conf.subnet_id
+        self.monitoring_enabled = self.conf.monitoring_enabled
+        self.cool_down_threshold = self.conf.cool_down_threshold
+        self.bid_threshold = self.conf.bid_threshold
+        self.pending_timeout = self.conf.pending_timeout
+        self.lb_timeout = self.conf.lb_timeout
+        self.executor = executor or Executor(self.conf.lb_workers)
+        self.capacity_cache_ttl = self.conf.capacity_cache_ttl
+        self.descriptor_cache_ttl = self.conf.descriptor_cache_ttl
+        self.cache = cache or TTLCache(self.descriptor_cache_ttl)
 
         if self.subnet_id is not None:
             self.placement = None
         elif az:
             self.placement = self.region + az
         else:
-            self.placement = self.conf.get("placement", "us-east-1c")
+            self.placement = self.conf.placement
+
+        # bid placement across several types (max_price) and zones, see bid_plan()
+        self.bid_placement = self.conf.bid_placement
+        self.subnets = self.conf.subnets
+        if self.subnets:
+            self.zones = sorted(self.subnets)
+        else:
+            self.zones = self.conf.availability_zones or [self.placement]
+        self.max_pool_share = self.conf.max_pool_share
+        # capacity is counted in units, one unit being an instance of the ASG's type
+        self.capacity = CapacityModel(self.conf.instance_weights, self.conf.capacity_basis)
+        # what replaces an interrupted spot instance: "spot", "on-demand" or "none"
+        self.interruption_replacement = self.conf.interruption_replacement
+        self.interruptions = Interruptions()
+        self.crash = CrashDetector(self.conf.crash_window,
+                                   self.conf.crash_threshold,
+                                   self.conf.crash_spot_grace)
+        self.emergency_batch_size = self.conf.emergency_batch_size
+        self.drain_seconds = self.conf.drain_seconds
+        # what this cycle takes down, see clean_up()
+        self.cleanup = Cleanup()
+        self.planner = DemotionPlanner(self.conf.billing)
+        self.forecaster = forecaster(self.conf, side_group)
+        self.next_demotion = None
         self.side_group = side_group
-        self.tapping_group = AutoScaleInfo(self.side_group, self.region)
+        self.metrics = metrics or Metrics()
+        self.tracer = tracer(self.conf, side_group, self.metrics)
+        self.profiler = profiler(self.conf)
+        self.current_phase = None
+        self.limiter = limiter or rate_limiter(self.conf)
+        self.connections = connections or Connections()
+        self.tapping_group = AutoScaleInfo(self.side_group, self.region, self.cache,
+                                           self.capacity_cache_ttl, self.descriptor_cache_ttl,
+                                           self.connect('autoscale'))
 
         self.started = False
         self.target = None
@@ -102,55 +206,100 @@ class TPManager:
         self.previous_as_count = None
         self.previous_managed = 0
 
-        self.bids = []
-        self.live = []
-        self.emergency = []
+        # spot requests by request id, live spot requests and emergency instances by instance id
+        self.bids = Registry(state=lambda x: x.state, kind=lambda x: (x.state, instance_type(x)))
+        self.live = Registry(kind=instance_type)
+        self.emergency = Registry(kind=instance_type)
         self.unhealthy_ids = set()
+        # id -> (submission time, instance type)
+        self.pending_bids = {}
+        self.pending_launches = {}
+        self.spot_status = None
+        self.lb_health = None
+        self.lb_states = {}
+
+        self.reconciler = Reconciler(self.conf.min_interval,
+                                     self.conf.max_interval,
+                                     self.conf.backoff)
+
+        self.ec2 = self.connect('ec2')
+        self.elb = self.connect('elb')
+        self.price_history = price_history
+        if self.bid_placement and self.price_history is None:
+            self.price_history = PriceHistory(self.ec2,
+                                              self.conf.price_history_file,
+                                              self.conf.price_history_hours,
+                                              self.conf.price_history_max_age,
+                                              self.conf.product_description)
+        self.inventory = Inventory(self.ec2, self.tapping_group.name, self.side_group, self.logger,
+                                   shared_inventory)
+
+        self.journal = None
+        self.recovered = False
+        if self.conf.journal_file:
+            self.journal = Journal(self.conf.journal_file, self.side_group,
+                                   self.conf.journal_snapshot_every)
+
+        # resolved when the first instance is launched, the launch configuration is only read then
+        self._user_data = user_data
+        self._user_data_resolved = False
+
+        # when several replicas run, only the one leading the group acts on it (see lease.py)
+        self.lease_name = "%s/%s" % (self.region, self.side_group)
+        self.coordinator = None
+        if self.coordinated:
+            self.coordinator = coordinator or replica_coordinator(self.conf, self.metrics)
+        if self.coordinator is not None:
+            self.coordinator.add(self.lease_name)
+            self.coordinator.listeners.append(self.lease_changed)
 
-        self.ec2 = boto.ec2.connect_to_region(self.region)
-        self.elb = boto.ec2.elb.connect_to_region(self.region)
+    @property
+    def user_data(self):
+        if not self._user_data_resolved:
+            self._user_data = self.read_user_data(self._user_data)
+            self._user_data_resolved = True
+        return self._user_data
 
-        self.user_data = user_data
-        user_data_file = self.conf.get("user_data_file", None)
+    def read_user_data(self, user_data):
+        """ The given user data, or else user_data_file's, or else the launch configuration's. """
+        user_data_file = self.conf.user_data_file
 
-        if not self.user_data and user_data_file:
+        if not user_data and user_data_file:
             self.logger.info("Trying to get user data from file...")
             try:
                 with open(user_data_file) as f:
-                    self.user_data = f.read()
+                    user_data = f.read()
             except IOError:
                 self.logger.warn("Could not read user data file: %s. Will launch instances without user data.",
                                  user_data_file)
 
-        if not self.user_data:
+        if not user_data:
             self.logger.info("Trying to get user data from launch configuration group...")
-            self.user_data = self.tapping_group.user_data
+            user_data = self.tapping_group.user_data
 
-        if not self.user_data:
+        if not user_data:
             self.logger.warn("Could not read user from launch configuration group: %s."
                              " Will launch instances without user data.", self.tapping_group.lc.name)
 
-        self.logger.info("User data: \n%s", self.user_data)
+        self.logger.info("User data: \n%s", user_data)
+        return user_data
+
+    def connect(self, service):
+        """ The group's connection to service: counted by metrics, then rate limited and retried. """
+        connection = getattr(self.connections, service)(self.region)
+        return throttled(instrument(connection, self.metrics, service, group=self.side_group),
+                         self.limiter, service, self.region)
 
     def refresh(self):
-        self.tapping_group = AutoScaleInfo(self.side_group, self.region)
+        self.tapping_group.refresh()
         self.guess_target()
         if self.previous_as_count != self.managed_by_autoscale():
             self.logger.info(">> refresh(): autoscale instance count changed from %s to %s",
                              self.previous_as_count, self.managed_by_autoscale())
+            if self.previous_as_count is not None:
+                self.reconciler.notify("capacity", (self.previous_as_count, self.managed_by_autoscale()))
             self.previous_as_count = self.managed_by_autoscale()
 
-    def is_ec2_state_running(self, instance_id):
-        try:
-            found_instance = self.ec2.get_all_instance_status(instance_ids=[instance_id])
-            return len(found_instance) > 0 and found_instance[0].state_name == "running"
-        except EC2ResponseError, inst:
-            if inst.error_code == "InvalidInstanceID.NotFound":
-                self.logger.warn("LB with invalid instance: %s", instance_id)
-                return False
-            else:
-                raise inst
-
     def guess_target(self):
         if not self.started:
             self.target = min(self.managed_instances(), self.managed_by_autoscale())  # follow autoscale if stopped :)
@@ -160,11 +309,14 @@ class TPManager:
             self.target = self.managed_instances()
         previous = self.target
 
-        # How many instances we should keep running
-        candidate = round(self.weight_factor * self.tapping_group.desired_capacity)
+        # How many instances we should keep running, ahead of the demand when forecasting
+        desired = self.tapping_group.desired_capacity
+        if self.forecaster is not None:
+            desired = self.forecaster.target(time.time(), desired)
+        candidate = round(self.weight_factor * desired)
 
         # Never less than one
-        candidate = max(1, min(candidate, self.conf.get("max_candidates", 6)))
+        candidate = max(1, min(candidate, self.conf.max_candidates))
 
         if candidate != previous:
             self.logger.debug(">> guess_target(): changed target from %s to %s", previous, candidate)
@@ -176,263 +328,721 @@ class TPManager:
     @property
     def lbs(self):
         lbnames = self.tapping_group.load_balancers
-        lbs = self.elb.get_all_load_balancers(load_balancer_names=lbnames)
-        return lbs
+        if not lbnames:
+            # an empty name list would describe every LB in the region
+            return []
+
+        return self.cache.get(('lbs', self.region, tuple(sorted(lbnames))),
+                              lambda: self.elb.get_all_load_balancers(load_balancer_names=lbnames),
+                              self.descriptor_cache_ttl)
 
     def valid_bids(self):
-        return [x for x in self.bids if x.state in ('active', 'open')]
+        return self.bids.where('state', 'active', 'open')
 
     def managed_instances(self):
-        return len(self.valid_bids()) + len(self.live) + len(self.emergency)
+        """ Capacity units of everything TP manages or waits for. """
+        # instances at risk of interruption don't count, their replacement does
+        return (sum([self.weight_of(k[1]) * n for k, n in self.bids.counts('kind').items()
+                     if k[0] in ('active', 'open')]) +
+                self.units(self.live.counts('kind')) +
+                self.units(self.emergency.counts('kind')) +
+                sum([self.weight_of(x[1]) for x in self.pending_bids.values()]) +
+                sum([self.weight_of(x[1]) for x in self.pending_launches.values()]) -
+                sum([self.weight_of(instance_type(self.live[x])) for x in self.at_risk()]))
+
+    def at_risk(self):
+        """ Live instances with a rebalance recommendation. """
+        return [x for x in self.interruptions.at_risk if x in self.live]
+
+    def weight_of(self, instance_type):
+        """ Capacity units of an instance of instance_type. """
+        return self.capacity.weight(instance_type, self.tapping_group.instance_type)
+
+    def units(self, counts):
+        """ Capacity units of {instance type: how many instances}. """
+        return sum([self.weight_of(k) * n for k, n in counts.items()])
+
+    def instances_for(self, units, instance_type):
+        """ How many instances of instance_type provide units of capacity. """
+        return self.capacity.instances(units, instance_type, self.tapping_group.instance_type)
 
     def live_or_emergency(self):
-        return len(self.live) + len(self.emergency)
+        return (self.units(self.live.counts('kind')) + self.units(self.emergency.counts('kind')) +
+                sum([self.weight_of(x[1]) for x in self.pending_launches.values()]))
+
+    def pending(self):
+        return len(self.pending_bids) + len(self.pending_launches)
 
     def ready_instances(self):
-        return [x for x in self.bids if x.state == 'active']
+        return self.bids.where('state', 'active')
 
-    def buy(self, amount=1):
+    def buy(self, units=1):
+        """ Launches enough on-demand emergency_type instances for units of capacity. """
+        amount = self.instances_for(units, self.emergency_type)
+        if amount <= 0:
+            return
+        self.decided("buy", count=amount, instance_type=self.emergency_type)
         tapping_group = self.tapping_group
 
-        ami = self.ec2.get_image(tapping_group.image_id)
-        for c in range(amount):
-            r = ami.run(security_group_ids=tapping_group.security_groups,
-                        instance_type=self.emergency_type,
-                        instance_profile_name=self.instance_profile_name,
-                        placement=self.placement,
-                        subnet_id=self.subnet_id,
-                        user_data=self.user_data,
-                        monitoring_enabled=self.monitoring_enabled)
-
-            self.logger.info(">> buy(): purchased 1 on-demand instance")
-            time.sleep(3)
-
-            # get instance since count is 1
-            instance = r.instances[0]
-
-            # get the status
-            status = instance.update()
+        ami = self.cache.get(('ami', self.region, tapping_group.image_id),
+                             lambda: self.ec2.get_image(tapping_group.image_id),
+                             self.descriptor_cache_ttl)
+        def launch(count):
+            return ami.run(min_count=count,
+                           max_count=count,
+                           security_group_ids=tapping_group.security_groups,
+                           instance_type=self.emergency_type,
+                           instance_profile_name=self.instance_profile_name,
+                           placement=self.placement,
+                           subnet_id=self.subnet_id,
+                           user_data=self.user_data,
+                           monitoring_enabled=self.monitoring_enabled).instances
+
+        # large purchases go out as several launches at the same time
+        size = max(1, self.emergency_batch_size)
+        outcomes = self.executor.map(launch, [min(size, amount - x) for x in range(0, amount, size)])
+        instances = []
+        for outcome in outcomes:
+            if outcome.ok:
+                instances.extend(outcome.value)
+            else:
+                self.logger.error(">> buy(): launching %s instances failed: %s", outcome.item, outcome.error)
+        if outcomes and not instances:
+            raise outcomes[0].error
 
-            # check for the status while isn't running
-            while status != 'running':
-                time.sleep(5)
-                status = instance.update()
+        # instances are tracked as pending until they show up running in the inventory
+        now = time.time()
+        for instance in instances:
+            self.pending_launches[instance.id] = (now, self.emergency_type)
 
-            # when it's finally running, update the tag
-            self.logger.info("Instance status = " + status)
-            instance.add_tag('tp:group', tapping_group.name)
+        self.logger.info(">> buy(): purchased %s on-demand instances: %s", len(instances),
+                         ", ".join([x.id for x in instances]))
+        self.reconciler.notify("buy", len(instances))
+        self.tag_pending()
 
-    def bid(self, force=False):
+    def bid(self, amount=1, force=False, exclude=()):
         elapsed_time = time.time() - self.last_bid
         if not force and elapsed_time < self.bid_threshold:
             self.logger.info(">> bid(): last bid was too recent, skipping bid! Remaining time to next change %s",
                              self.bid_threshold - elapsed_time)
-            time.sleep(10)
+            self.decided("hold", reason="bid_threshold", count=amount, remaining=self.bid_threshold - elapsed_time)
             return
 
-        tapping_group = self.tapping_group
+        created = 0
+
+        for spot_type, zone, count in self.bid_plan(amount, exclude):
+            subnet_id = self.subnets.get(zone, self.subnet_id)
+            requests = self.request_spot(spot_type, zone, subnet_id, count)
+
+            # requests are tracked as pending until they show up tagged in the inventory,
+            # fulfillment is followed by load_state on the next ticks
+            now = time.time()
+            for request in requests:
+                self.pending_bids[request.id] = (now, spot_type)
 
-        request = self.ec2.request_spot_instances(
-            price=self.max_price[self.spot_type],
+            self.logger.info(">> bid(): created %s bids of %s in %s for %s", len(requests), spot_type,
+                             zone or subnet_id, self.max_price[spot_type])
+            created += len(requests)
+
+        self.last_bid = time.time()
+        self.reconciler.notify("bid", created)
+        self.tag_pending()
+
+    def request_spot(self, spot_type, zone, subnet_id, count):
+        self.decided("bid", count=count, instance_type=spot_type, zone=zone or subnet_id,
+                     price=self.max_price[spot_type])
+        tapping_group = self.tapping_group
+        return self.ec2.request_spot_instances(
+            price=self.max_price[spot_type],
             image_id=tapping_group.image_id,
-            count=1,
+            count=count,
             type="one-time",
-            placement=self.placement,
+            placement=zone if subnet_id is None else None,
             security_group_ids=tapping_group.security_groups,
-            subnet_id=self.subnet_id,
+            subnet_id=subnet_id,
             user_data=self.user_data,
-            instance_type=self.spot_type,
+            instance_type=spot_type,
             instance_profile_name=self.instance_profile_name,
             monitoring_enabled=self.monitoring_enabled)
 
-        # get the first reservation since count is 1
-        reservation = request[0]
+    def cancel_bids(self, request_ids):
+        self.decided("cancel", ids=list(request_ids))
+        self.ec2.cancel_spot_instance_requests(request_ids)
 
-        # get the status
-        status = reservation.status
+    def terminate_instances(self, instance_ids):
+        self.decided("terminate", ids=list(instance_ids))
+        self.ec2.terminate_instances(instance_ids)
 
-        # check for the status while it isn't running
-        while status.code != 'fulfilled':
-            self.logger.info("Reservation status = %s", status.code)
-            time.sleep(5)
-            status = self.ec2.get_all_spot_instance_requests(request_ids=[reservation.id])[0].status
+    def bid_plan(self, amount, exclude=()):
+        """ Where to place amount of capacity: [(instance type, zone, count)].
 
-        # when it's finally fulfilled, update the tag
-        self.logger.info("Reservation status = %s", status.code)
-        reservation.add_tag('tp:tag', self.side_group)
+            Without bid_placement this is always spot_type in placement.
+            Pools in exclude are avoided if there is any other.
+        """
+        default = [(self.spot_type, self.placement, self.instances_for(amount, self.spot_type))]
+        if not self.bid_placement:
+            return default
+
+        # an interruption or a bid under the market means the prices we have are already wrong
+        moved = [x for x in (self.spot_status or {}).values() if x in MARKET_STATUS_CODES]
+        self.price_history.update(self.max_price.keys(), force=bool(moved or exclude))
+        placer = BidPlacer(self.price_history, self.max_price, self.zones, self.tapping_group.instance_type,
+                           self.max_pool_share, self.weight_of)
+
+        existing = defaultdict(float)
+        for request in self.valid_bids() + self.live.values():
+            existing[pool_of(request)] += self.weight_of(instance_type(request))
+
+        plan = placer.plan(amount, existing, exclude)
+        if not plan and exclude:
+            plan = placer.plan(amount, existing)
+        if not plan:
+            self.logger.warn(">> bid(): no pool is under its max price, bidding %s in %s anyway",
+                             self.spot_type, self.placement)
+            return default
+        return plan
+
+    def tag_pending(self):
+        """ Tags pending requests and instances so the inventory can find them.
+
+            Freshly created resources are not always visible to CreateTags
+            yet, so failures are only logged and retried on the next tick.
+        """
+        for ids, tags in ((self.pending_bids.keys(), {'tp:tag': self.side_group}),
+                          (self.pending_launches.keys(), {'tp:group': self.tapping_group.name})):
+            if not ids:
+                continue
+            try:
+                self.ec2.create_tags(ids, tags)
+            except EC2ResponseError, e:
+                self.logger.warn(">> tag_pending(): could not tag %s yet (%s), retrying later",
+                                 ", ".join(ids), e.error_code)
 
-        self.logger.info(">> bid(): created 1 bid of %s for %s", self.spot_type, self.max_price[self.spot_type])
-        self.last_bid = time.time()
-        self.bids.append(request)
+    def advance_pending(self):
+        """ Moves forward the bids and launches submitted on previous ticks.
+
+            What doesn't show up within pending_timeout is given up on and
+            taken down by clean_up(), so nothing untracked is left to be billed.
+        """
+        now = time.time()
+        known_requests = dict([(x.id, x) for x in self.inventory.spot_requests])
+        running_emergency = set([x.id for x in self.inventory.emergency])
+        stale_bids = []
+        stale_launches = []
+
+        for request_id, (submitted, spot_type) in self.pending_bids.items():
+            if request_id in known_requests:
+                self.logger.info(">> advance_pending(): bid %s is now %s (%s)", request_id,
+                                 known_requests[request_id].state, known_requests[request_id].status.code)
+                del self.pending_bids[request_id]
+            elif now - submitted > self.pending_timeout:
+                self.logger.warn(">> advance_pending(): bid %s never showed up, cancelling it", request_id)
+                stale_bids.append(request_id)
+                del self.pending_bids[request_id]
+
+        for instance_id, (launched, emergency_type) in self.pending_launches.items():
+            if instance_id in running_emergency:
+                self.logger.info(">> advance_pending(): on-demand instance %s is running", instance_id)
+                del self.pending_launches[instance_id]
+            elif now - launched > self.pending_timeout:
+                self.logger.warn(">> advance_pending(): on-demand instance %s isn't running after %ss, "
+                                 "terminating it", instance_id, self.pending_timeout)
+                stale_launches.append(instance_id)
+                del self.pending_launches[instance_id]
+
+        self.give_up(stale_bids, stale_launches)
+        self.tag_pending()
+
+    def give_up(self, request_ids, instance_ids):
+        """ Has clean_up() cancel bids and terminate launches that never showed up.
+
+            A bid whose tagging kept failing may have been fulfilled anyway,
+            its instance goes too.
+        """
+        instance_ids = list(instance_ids)
+        if request_ids:
+            try:
+                requests = self.ec2.get_all_spot_instance_requests(request_ids=request_ids)
+                instance_ids.extend([x.instance_id for x in requests if x.instance_id])
+            except EC2ResponseError, e:
+                self.logger.warn(">> give_up(): could not tell whether %s were fulfilled (%s)",
+                                 ", ".join(request_ids), e.error_code)
+        self.cleanup.add(instance_ids, request_ids)
 
     def check_alive(self, instance_id):
-        all_instances = self.ec2.get_all_instances(instance_ids=[instance_id])
-        inst = all_instances.pop().instances[0]
-        return inst.state == "running"
+        instances = self.inventory.lookup([instance_id])
+        return len(instances) > 0 and instances[0].state == "running"
 
     def attach_instance(self, instance_id, infix):
+        self.attach_instances([instance_id], infix)
+
+    def attach_instances(self, instance_ids, infix):
+        if not instance_ids:
+            return
+        self.decided("promote" if infix == "TP" else "attach", ids=list(instance_ids))
         tags = self.tags.copy()
-        tags['Name'] = "%s %s %s" % (self.conf.get("instance_name", "instance"), infix, self.side_group)
-        self.ec2.create_tags([instance_id], tags)
+        tags['Name'] = "%s %s %s" % (self.conf.instance_name, infix, self.side_group)
+        self.ec2.create_tags(instance_ids, tags)
 
-        for lb in self.lbs:
-            lb.register_instances(instance_id)
+        self.on_every_lb("register_instances", instance_ids)
 
     def dettach_instance(self, instance_id):
-        for lb in self.lbs:
-            lb.deregister_instances(instance_id)
+        self.dettach_instances([instance_id])
+
+    def dettach_instances(self, instance_ids):
+        if instance_ids:
+            self.decided("detach", ids=list(instance_ids))
+            self.on_every_lb("deregister_instances", instance_ids)
+
+    def on_every_lb(self, method, instance_ids):
+        """ Calls method with all instance_ids once per LB, every LB in parallel.
 
-    def maybe_terminate(self, instance_id):
+            A failing or slow LB is logged and doesn't prevent the others from
+            being updated.
+        """
+        outcomes = self.executor.map(lambda lb: getattr(lb, method)(instance_ids), self.lbs, self.lb_timeout)
+        for outcome in outcomes:
+            if not outcome.ok:
+                self.logger.error(">> %s(): %s failed for %s: %s", method, outcome.item.name,
+                                  ", ".join(instance_ids), outcome.error)
+        return outcomes
+
+    def read_lb_health(self):
+        """ Reads the health of every LB in parallel.
+
+            A LB that fails or times out is served from its last successful
+            read, or left out if it was never read, so one slow ELB doesn't
+            stall the cycle. Only when every LB fails and none of them was
+            read before the cycle is aborted.
+        """
+        lbs = self.lbs
+        outcomes = self.executor.map(lambda lb: list(lb.get_instance_health()), lbs, self.lb_timeout)
+
+        states = []
+        answered = False
+        for outcome in outcomes:
+            name = outcome.item.name
+            if outcome.ok:
+                self.lb_states[name] = outcome.value
+            elif name in self.lb_states:
+                self.logger.warn(">> read_lb_health(): %s failed (%s), using its previous health",
+                                 name, outcome.error)
+            else:
+                self.logger.warn(">> read_lb_health(): %s failed (%s) and was never read, leaving it out",
+                                 name, outcome.error)
+                continue
+            answered = True
+            states.extend(self.lb_states[name])
+        if outcomes and not answered:
+            raise outcomes[0].error
+        return states
+
+    def maybe_terminate(self, instance_ids):
+        """ Kills the unhealthy spot and emergency instances past their grace period, all at once. """
         # only if it's a spot or emergency machine, otherwise AS will take care of it
-        live_spot_dict = dict([(x.instance_id, x) for x in self.live])
-        live_emergency_ids = [x.id for x in self.emergency]
-
-        if instance_id in live_spot_dict or instance_id in live_emergency_ids:
-            # check grace period
-            grace_period_delta = timedelta(minutes=self.grace_period_minutes)
-
-            instance_info = self.ec2.get_all_instances(instance_ids=[instance_id])[0].instances[0]
-            uptime = datetime.utcnow() - datetime.strptime(instance_info.launch_time, '%Y-%m-%dT%H:%M:%S.%fZ')
-            if uptime > grace_period_delta:
-                self.logger.info(">> maybe_terminate(): %s is unhealthy for longer than %s minutes - killing it!",
-                                 instance_id, self.grace_period_minutes)
-                self.dettach_instance(instance_id)
-                self.ec2.terminate_instances([instance_id])
-
-                if instance_id in live_spot_dict:
-                    instance = live_spot_dict[instance_id]
-                    instance.cancel()  # cancel the spot request
-                    self.live.remove(instance)
+        candidates = [x for x in instance_ids if x in self.live or x in self.emergency]
+        if not candidates:
+            return
+
+        grace_period_delta = timedelta(minutes=self.grace_period_minutes)
+        sick = [x.id for x in self.inventory.lookup(candidates) if age(x) > grace_period_delta]
+        if not sick:
+            return
+
+        self.logger.info(">> maybe_terminate(): %s unhealthy for longer than %s minutes - killing them!",
+                         ", ".join(sick), self.grace_period_minutes)
+        # their spot requests are cancelled too
+        self.cleanup.add(sick, [self.live.pop(x).id for x in sick if x in self.live])
+        self.reconciler.notify("terminate", sick)
+        for instance_id in sick:
+            self.emergency.pop(instance_id, None)
 
     def maybe_promote(self, spot_request):
         elapsed_time = time.time() - self.last_change
         if elapsed_time <= self.cool_down_threshold:
             self.logger.info("Not promoting any instances, waiting for cool down!"
                              " Remaining time to next change %s", self.cool_down_threshold - elapsed_time)
+            self.decided("hold", reason="cool_down", ids=[spot_request.instance_id],
+                         remaining=self.cool_down_threshold - elapsed_time)
         elif self.check_alive(spot_request.instance_id):
             self.logger.info(">> maybe_promote(): %s is alive, promoting", spot_request)
 
             self.attach_instance(spot_request.instance_id, "TP")
-            self.bids.remove(spot_request)
-            self.live.append(spot_request)
+            del self.bids[spot_request.id]
+            self.live[spot_request.instance_id] = spot_request
             self.last_change = time.time()
+            self.reconciler.notify("promote", spot_request.instance_id)
             self.logger.info(">> maybe_promote(): %s promoted, now live", spot_request)
 
-    def maybe_replace(self):
-        for instance in self.emergency:
-            self.logger.debug("proximity(%s): %s", instance.id, str(self.proximity(instance)))
-            if (2 < self.proximity(instance) < 10) and self.managed_instances() <= self.target:
-                self.logger.info(">> maybe_replace(): attempting to replace %s", instance.id)
-                self.bid(force=True)
+    def interrupt(self, interruptions):
+        """ Drains interrupted instances from the LBs right away and starts their replacement.
 
-            self.load_state()
+            Instances with a rebalance recommendation keep serving, only their
+            replacement is started, maybe_demote() retires them once it is live.
+        """
+        fulfilled = dict([(x.instance_id, x) for x in self.bids.values() if x.instance_id])
+        doomed = []
+        risky = []
+        for interruption in interruptions:
+            instance_id = interruption.instance_id
+            if interruption.kind == REBALANCE and instance_id not in self.live:
+                continue
+            if instance_id not in self.live and instance_id not in fulfilled:
+                continue
+            if not self.interruptions.add(interruption):
+                continue
+            if interruption.kind == TERMINATION:
+                doomed.append(instance_id)
+            else:
+                risky.append(instance_id)
+        if not doomed and not risky:
+            return False
 
-    def proximity(self, instance_or_spot):
-        if hasattr(instance_or_spot, 'instance_id'):
-            instance_info = self.ec2.get_all_instances(instance_ids=[instance_or_spot.instance_id])[0]
-            instance = instance_info.instances[0]
+        pools = set()
+        if doomed:
+            self.logger.warn(">> interrupt(): %s interrupted, draining from the LBs", ", ".join(doomed))
+            self.dettach_instances([x for x in doomed if x in self.live])
+            for instance_id in doomed:
+                if instance_id in self.live:
+                    request = self.live.pop(instance_id)
+                else:
+                    request = self.bids.pop(fulfilled[instance_id].id)
+                pools.add(pool_of(request))
+            self.crash.lost(pools)
+            self.metrics.inc("tp_interruptions_total", len(doomed), group=self.side_group, kind=TERMINATION)
+        if risky:
+            self.logger.info(">> interrupt(): %s at risk of interruption, replacing", ", ".join(risky))
+            pools.update([pool_of(self.live[x]) for x in risky])
+            self.metrics.inc("tp_interruptions_total", len(risky), group=self.side_group, kind=REBALANCE)
+        self.reconciler.notify("interruption", doomed + risky)
+
+        shortfall = (self.target or 0) - self.managed_instances()
+        if not self.started or shortfall <= 0 or self.interruption_replacement == "none":
+            return True
+        if self.previous_managed > 0 and self.live_or_emergency() == 0:
+            # every instance is going away, the market crash handling takes over
+            return True
+        if self.interruption_replacement == "on-demand":
+            self.buy(shortfall)
         else:
-            instance = instance_or_spot
+            self.bid(shortfall, force=True, exclude=pools)
+        return True
+
+    def handle_crash(self):
+        """ Fills what a crash took away: spot in the pools it spared first, then on-demand.
 
-        minute = int(instance.launch_time.split(":")[1])
-        minute_now = datetime.now().minute
-        time_remaining = minute - minute_now
-        if time_remaining < -1:
-            time_remaining = (minute + 60) - minute_now
-        return time_remaining
+            Emergency instances bought here are replaced by spot again by
+            maybe_replace() and maybe_demote() once the market is back.
+        """
+        now = time.time()
+        serving = self.live_or_emergency()
+        crashed = self.crash.update(now, serving, self.target or 0)
+        # nothing left at all, e.g. right after a restart in the middle of a crash
+        total = self.previous_managed > 0 and serving == 0
+        if not self.started or not (crashed or total):
+            return
+
+        if total or self.crash.escalate(now, serving):
+            # with nothing left, what served on the previous cycle is bought back
+            # fulfilled bids are on their way, only what the market didn't fill is bought
+            coming = sum([self.weight_of(instance_type(x)) for x in self.ready_instances()])
+            gap = self.previous_managed if total else self.target - serving - coming
+            # bids the market didn't fill in time, maybe_replace() bids for the emergency instances again later
+            stale = [x.id for x in self.bids.where('state', 'open')]
+            if stale and gap > 0:
+                self.logger.info(">> handle_crash(): %s are still open, cancelling", ", ".join(stale))
+                self.cancel_bids(stale)
+                for request_id in stale:
+                    del self.bids[request_id]
+            if gap > 0:
+                self.logger.warn(">> market crashed! launching %s %s instances",
+                                 self.instances_for(gap, self.emergency_type), self.emergency_type)
+                self.buy(gap)
+            return
+
+        missing = self.target - self.managed_instances()
+        if missing > 0:
+            self.logger.warn(">> handle_crash(): %s of %s serving, bidding for %s away from %s", serving,
+                             self.target, missing, ", ".join(["%s/%s" % x for x in sorted(self.crash.pools)]))
+            self.bid(missing, force=True, exclude=self.crash.pools)
+
+    def maybe_replace(self):
+        due = []
+        for position in self.rank(self.emergency.values()):
+            self.logger.debug("proximity(%s): %ss", position.instance_id, int(position.remaining))
+            if self.planner.due(position, REPLACE_WINDOW):
+                due.append(position)
+
+        # bids for the capacity of the emergency instances close to their billing boundary, unless already placed
+        units = sum([x.weight for x in due])
+        missing = self.target + units - self.managed_instances()
+        if due and missing > 0:
+            self.logger.info(">> maybe_replace(): attempting to replace %s", ", ".join([x.instance_id for x in due]))
+            self.bid(min(missing, units), force=True)
+
+    def rank(self, resources):
+        """ Billing positions of instances or spot requests, from one inventory lookup. """
+        resources = list(resources)
+        instances = self.inventory.lookup([instance_id_of(x) for x in resources])
+        weights = dict([(instance_id_of(x), self.weight_of(instance_type(x))) for x in resources])
+        return self.planner.rank(resources, launch_epochs(instances), weights, time.time())
 
     def maybe_demote(self):
         # First remove open, unfulfilled bids
         # Then remove open, but not yet live
         # Finally, remove any
+        self.next_demotion = None
+
+        # Instances at risk of interruption go as soon as their replacement serves
+        risky = self.at_risk()
+        if risky:
+            serving = (sum([self.weight_of(instance_type(v)) for k, v in self.live.items() if k not in risky]) +
+                       sum([self.weight_of(instance_type(x)) for x in self.emergency.values()]))
+            if serving >= self.target or not self.started:
+                self.logger.info(">> maybe_demote(): replacements are live, retiring %s", ", ".join(risky))
+                self.retire([self.live[x] for x in risky])
+                return True
 
         # In case we are in an emergency state:
-        # If we have a server in an emergency state and no bids are open, kill a
-        # server
+        # kill the servers close enough to their billing boundary, as many as
+        # the live spot instances cover for
         if self.emergency:
-            for instance in self.emergency:
-                if (3 < self.proximity(instance) < 10) and not self.valid_bids():
-                    self.logger.info(">> maybe_demote(): removing emergency instance %s", instance.id)
-                    self.dettach_instance(instance.id)
-                    self.ec2.terminate_instances([instance.id])
-                    self.emergency.remove(instance)
-                    return True
-            return False
+            excess = self.live_or_emergency() - self.target
+            if excess <= 0:
+                return False
+            now = time.time()
+            positions = self.rank(self.emergency.values())
+            due = []
+            for position in positions:
+                if self.planner.due(position, EMERGENCY_WINDOW) and position.weight <= excess:
+                    due.append(position.instance_id)
+                    excess -= position.weight
+            if not due:
+                if positions:
+                    self.next_demotion = min([self.planner.when(x, EMERGENCY_WINDOW, now) for x in positions])
+                return False
+            self.logger.info(">> maybe_demote(): removing emergency instances %s", ", ".join(due))
+            self.cleanup.add(due)
+            for instance_id in due:
+                del self.emergency[instance_id]
+            return True
 
         if self.managed_instances() <= self.target:
             return False
 
-        for bid in self.valid_bids():
-            if bid.state == "open":
-                self.logger.info(">> demote(): %s is open, removing", bid)
-                bid.cancel()
-                self.bids.remove(bid)
-                return True
+        excess = self.managed_instances() - self.target
+        cancelled = []
+        for bid in self.bids.where('state', 'open'):
+            weight = self.weight_of(instance_type(bid))
+            if weight <= excess:
+                cancelled.append(bid.id)
+                excess -= weight
+        if cancelled:
+            self.logger.info(">> demote(): %s are open, removing", ", ".join(cancelled))
+            self.cancel_bids(cancelled)
+            for request_id in cancelled:
+                del self.bids[request_id]
+            return True
 
         elapsed_time = time.time() - self.last_change
 
         if elapsed_time <= self.cool_down_threshold:
             self.logger.info("Not removing any instances, waiting for cool down!"
                              " Remaining time to next change %s", self.cool_down_threshold - elapsed_time)
+            self.decided("hold", reason="cool_down", count=excess, remaining=self.cool_down_threshold - elapsed_time)
             return False
 
-        self.live.sort(key=self.proximity)
+        if not self.live:
+            return False
 
-        if self.proximity(self.live[0]) < 3 or not self.started:
-            self.logger.info(">> demote(): %s is live, removing", self.live[0])
-            self.dettach_instance(self.live[0].instance_id)
-            self.last_change = time.time()
-            time.sleep(5)
-            self.live[0].cancel()
-            self.ec2.terminate_instances([self.live[0].instance_id])
-            time.sleep(1)
-            self.live.remove(self.live[0])
-            return True
+        now = time.time()
+        plan = self.planner.plan(self.rank(self.live.values()), excess, LIVE_WINDOW, now)
+        if not self.started:
+            due = plan
+        else:
+            due = [x for x in plan if x.at <= now]
+
+        if not due:
+            if plan:
+                self.next_demotion = plan[0].at
+                self.logger.info(">> demotion too far off, postponing (%s minutes)", int((plan[0].at - now) // 60))
+                self.decided("postpone", count=excess, remaining=plan[0].at - now)
+            return False
+
+        candidates = [x.position.resource for x in due]
+        self.logger.info(">> demote(): %s are live, removing", ", ".join([x.instance_id for x in candidates]))
+        self.last_change = time.time()
+        self.retire(candidates)
+        return True
+
+    def retire(self, requests):
+        """ Takes live spot requests out of the fleet, clean_up() drains them and takes them down. """
+        self.cleanup.add([x.instance_id for x in requests], [x.id for x in requests], drain=True)
+        for request in requests:
+            del self.live[request.instance_id]
+            self.interruptions.forget(request.instance_id)
+
+    def clean_up(self):
+        """ Takes down everything the cycle retired, together.
+
+            They leave every LB in one call per LB, the serving ones are
+            given drain_seconds once for all of them, then the spot requests
+            are cancelled while the instances are terminated.
+        """
+        instance_ids, request_ids, drain = self.cleanup.take()
+        if instance_ids:
+            self.dettach_instances(instance_ids)
+        if drain:
+            self.drain(instance_ids, request_ids)
         else:
-            self.logger.info(">> demotion too far off, postponing (%s minutes)", self.proximity(self.live[0]))
+            self.take_down(instance_ids, request_ids)
+
+    def drain(self, instance_ids, request_ids):
+        """ Waits for the LBs to drain instance_ids, then takes them down. """
+        time.sleep(self.drain_seconds)
+        self.take_down(instance_ids, request_ids)
+
+    def take_down(self, instance_ids, request_ids):
+        calls = []
+        if request_ids:
+            calls.append(lambda: self.cancel_bids(request_ids))
+        if instance_ids:
+            calls.append(lambda: self.terminate_instances(instance_ids))
+        if calls:
+            self.executor.gather(*calls)
+
+    def fetch_state(self):
+        """ Reads the health of every LB member, then the inventory snapshot with the members in it. """
+        states = self.read_lb_health()
+        # one snapshot serves every lookup in load_state() instead of a call per instance
+        self.inventory.refresh([x.instance_id for x in states if x.state == 'InService'])
+        return states
+
+    def warming_up(self, instance_ids):
+        """ The LB members among instance_ids that are running but not InService yet, within their grace period.
+
+            A promoted instance counts as live while the LBs check its health,
+            instead of going back to the bids and leaving the fleet empty.
+        """
+        if not instance_ids:
+            return set()
+        grace_period_delta = timedelta(minutes=self.grace_period_minutes)
+        return set([x.id for x in self.inventory.lookup(instance_ids)
+                    if x.state == "running" and age(x) <= grace_period_delta])
 
-        return False
+    def leaving(self, instance_id):
+        """ Whether instance_id is on its way out and must neither be counted nor promoted again. """
+        return instance_id in self.interruptions.doomed
 
     def load_state(self):
-        running_in_lb = []
+        dead, unattached, marked = self.sort_state(self.fetch_state())
+        self.advance_pending()
+        self.dettach_instances(dead)
+
+        if unattached:
+            self.logger.info(">> load_state: Attaching new emergency instances %s to LB." % ", ".join(unattached))
+            self.attach_instances(unattached, "OD")
+
+        # the spot request status is a notice too, in case no source delivered it
+        if marked:
+            self.interrupt(marked)
+
+    def sort_state(self, states):
+        """ Sorts the LB health and the inventory snapshot into the registries, without acting on them.
+
+            Returns the dead instances still in a LB, the emergency instances
+            to register and the interruptions the spot requests announce.
+        """
+        running_in_lb = set()
+        in_service = []
         self.unhealthy_ids = set()
 
-        for lb in self.lbs:
-            for instance_state in lb.get_instance_health():
-                if instance_state.state != 'InService':
-                    self.unhealthy_ids.add(instance_state.instance_id)
-                # Some times some dead instances get stuck on LB and boto lib doesn't know how to treat it
-                # This make sure that instance is alive and avoid bug on get_all_instances method
-                elif self.is_ec2_state_running(instance_state.instance_id):
-                    running_in_lb.append(instance_state.instance_id)
-                else:
-                    self.dettach_instance(instance_state.instance_id)
+        lb_health = {}
+
+        for instance_state in states:
+            if instance_state.state != 'InService':
+                self.unhealthy_ids.add(instance_state.instance_id)
+                lb_health[instance_state.instance_id] = instance_state.state
+            else:
+                in_service.append(instance_state.instance_id)
+                lb_health.setdefault(instance_state.instance_id, instance_state.state)
 
-        spot_requests = self.ec2.get_all_spot_instance_requests()
-        self.bids = []
-        self.live = []
+        self.lb_health = self.notify_changes("health", self.lb_health, lb_health)
+
+        dead = []
+        for instance_id in in_service:
+            # Some times some dead instances get stuck on LB and boto lib doesn't know how to treat it
+            # This make sure that instance is alive and avoid bug on get_all_instances method
+            if self.inventory.is_running(instance_id):
+                running_in_lb.add(instance_id)
+            else:
+                dead.append(instance_id)
+
+        spot_requests = self.inventory.spot_requests
+        self.spot_status = self.notify_changes("spot", self.spot_status,
+                                               dict([(x.id, x.status.code) for x in spot_requests]))
+        bids = {}
+        live = {}
+        marked = []
+        warming = self.warming_up([x.instance_id for x in spot_requests
+                                   if x.instance_id in lb_health and x.instance_id not in running_in_lb])
 
         for request in spot_requests:
             tp_tag = request.tags.get('tp:tag', None)
             if not tp_tag or tp_tag != self.side_group:
                 continue
+            if self.leaving(request.instance_id):
+                continue
 
-            if request.instance_id not in running_in_lb:
-                self.bids.append(request)
-            elif request.status.code != 'marked-for-termination':
-                self.live.append(request)
+            if request.instance_id not in running_in_lb and request.instance_id not in warming:
+                bids[request.id] = request
+            else:
+                live[request.instance_id] = request
+            if request.status.code == 'marked-for-termination':
+                marked.append(Interruption(request.instance_id, TERMINATION, time.time() + NOTICE_SECONDS))
 
-        self.emergency = []
+        emergency = {}
 
-        # gets a list of instances and flat the items from all element.instances
-        all_instances = [r.instances for r in self.ec2.get_all_instances()]
-        instances = chain.from_iterable(all_instances)
-        for instance in instances:
+        for instance in self.inventory.emergency:
             if instance.tags.get('tp:group', None) == self.tapping_group.name and instance.state == "running":
-                self.emergency.append(instance)
-                if instance.id not in running_in_lb:
-                    self.logger.info(">> load_state: Attaching new emergency instance %s to LB." % instance.id)
-                    self.attach_instance(instance.id, "OD")
+                emergency[instance.id] = instance
+
+        self.apply_delta("bids", self.bids, bids)
+        self.crash.lost([pool_of(v) for k, v in self.live.items() if k not in live])
+        self.apply_delta("live", self.live, live)
+        added = self.apply_delta("emergency", self.emergency, emergency)
+
+        # only emergency instances that are new, or that fell out of every LB, need to be registered
+        unattached = [x for x in self.emergency
+                      if x not in running_in_lb and (x in added or x not in lb_health)]
+
+        self.interruptions.expire()
+        for instance_id in self.interruptions.at_risk.keys():
+            if instance_id not in self.live:
+                self.interruptions.forget(instance_id)
+        return dead, unattached, marked
+
+    def apply_delta(self, name, current, fresh):
+        """ Updates current in place to match fresh, returns the ids that were added. """
+        added = [k for k in fresh if k not in current]
+        removed = [k for k in current if k not in fresh]
+
+        for k in removed:
+            del current[k]
+        current.update(fresh)
+
+        if added or removed:
+            self.logger.debug(">> load_state(): %s +[%s] -[%s]", name, ", ".join(added), ", ".join(removed))
+        return set(added)
+
+    def notify_changes(self, kind, previous, current):
+        """ Reports the ids whose value changed since the previous load_state. """
+        if previous is not None:
+            changed = [k for k in set(previous) | set(current) if previous.get(k) != current.get(k)]
+            if changed:
+                self.logger.debug(">> load_state(): %s changed for %s", kind, ", ".join(sorted(changed)))
+                self.reconciler.notify(kind, changed)
+        return current
 
     def stop(self):
         """ Prepares this TPManager to stop by not launching new machines
@@ -445,65 +1055,318 @@ class TPManager:
 
     def start(self):
         self.started = True
+        self.recover()
+
+    def recover(self):
+        """ Rebuilds the state left by a previous run from the journal.
+
+            Only the ids found in the journal are looked up on AWS, whatever
+            no longer exists is dropped. The first load_state() settles the rest.
+        """
+        if self.journal is None or self.recovered:
+            return
+        self.recovered = True
+
+        state = self.journal.load()
+        clock = state["clock"]
+        self.last_bid = clock.get("last_bid", 0)
+        self.last_change = clock.get("last_change", 0)
+        self.previous_managed = clock.get("previous_managed", 0)
+        self.target = clock.get("target", None)
+
+        requests, instances = verify(self.ec2, state)
+
+        def running(instance_id):
+            return instance_id in instances and instances[instance_id].state == "running"
+
+        for request_id, entry in state["requests"].items():
+            request = requests.get(request_id)
+            if request is None or request.state not in ('open', 'active'):
+                continue
+            if entry["live"] and running(request.instance_id):
+                self.live[request.instance_id] = request
+            else:
+                self.bids[request_id] = request
+
+        for instance_id in state["emergency"]:
+            if running(instance_id):
+                self.emergency[instance_id] = instances[instance_id]
+
+        now = time.time()
+        for pending, recorded in ((self.pending_bids, state["pending_bids"]),
+                                  (self.pending_launches, state["pending_launches"])):
+            for resource_id, (submitted, resource_type) in recorded.items():
+                if now - submitted < self.pending_timeout:
+                    pending[resource_id] = (submitted, resource_type)
+
+        self.logger.info(">> recover(): %s bids, %s live, %s emergency and %s pending from the journal",
+                         len(self.bids), len(self.live), len(self.emergency), self.pending())
 
     def print_state(self):
         self.logger.debug("*** Current state:")
         self.logger.debug("Managed by Autoscale: " + str(self.managed_by_autoscale()))
         self.logger.debug("TP target: " + str(self.target))
         self.logger.debug("Instances managed by TP: " + str(self.managed_instances()))
+        self.logger.debug("Pending bids: " + ", ".join(self.pending_bids))
+        self.logger.debug("Pending launches: " + ", ".join(self.pending_launches))
         self.logger.debug("TP live instances: " + str(len(self.live)) + " [" +
-                          ", ".join([x.instance_id for x in self.live]) + "]")
-        self.logger.debug("Emergency: " + ", ".join([x.id for x in self.emergency]))
+                          ", ".join(self.live) + "]")
+        self.logger.debug("Emergency: " + ", ".join(self.emergency))
         self.logger.debug("LB Unhealthy: " + ", ".join(self.unhealthy_ids))
 
+    def running(self):
+        return self.started or self.managed_instances() > 0
+
+    def leading(self):
+        """ Whether this replica acts on the group, always without coordination. """
+        return self.coordinator is None or self.coordinator.leads(self.lease_name)
+
+    def lease_changed(self, name, leading):
+        if name != self.lease_name:
+            return
+        if leading:
+            self.logger.info("Leading %s", name)
+        else:
+            self.logger.info("Standing by, another replica leads %s", name)
+        # a takeover shouldn't wait for the standby's next tick
+        self.reconciler.notify("lease", leading)
+
+    def tick(self):
+        """ Runs one save_money() cycle, or warm() while another replica leads, returns False if it failed. """
+        if self.coordinator is not None and not self.coordinator.begin(self.lease_name):
+            return self.stand_by()
+        started = time.time()
+        succeeded = False
+        try:
+            if self.profiler is not None:
+                self.profiler.run(self.save_money)
+            else:
+                self.save_money()
+            succeeded = True
+            return True
+        except Exception, e:
+            logger.exception(e)
+            self.metrics.inc("tp_tick_failures_total", group=self.side_group)
+            return False
+        finally:
+            if self.coordinator is not None:
+                self.coordinator.end(self.lease_name)
+            self.metrics.inc("tp_ticks_total", group=self.side_group)
+            self.metrics.observe("tp_tick_seconds", time.time() - started, group=self.side_group)
+            self.wrap_up(succeeded, time.time() - started)
+            flush_output()
+
+    def wrap_up(self, succeeded, seconds):
+        """ Records the gauges, the trace and the journal of a tick, whatever happened to it. """
+        # they read the ASG, which may be what failed the tick: failing again mustn't escape tick()
+        try:
+            self.record_gauges()
+            if self.tracer is not None:
+                self.tracer.record(ok=succeeded, seconds=round(seconds, 4), target=self.target,
+                                   managed=self.managed_instances(), live=len(self.live),
+                                   emergency=len(self.emergency), bids=len(self.bids))
+            if self.journal is not None:
+                self.journal.record(capture(self))
+        except Exception, e:
+            self.logger.warn(">> wrap_up(): could not record the tick: %r", e)
+
+    def stand_by(self):
+        try:
+            self.warm()
+            return True
+        except Exception, e:
+            logger.exception(e)
+            return False
+        finally:
+            flush_output()
+
+    def warm(self):
+        """ Loads the state and refreshes the ASG like a tick does, without acting on any of it.
+
+            A standby keeps its registries, inventory, descriptors and
+            forecast current this way, so the tick that follows a takeover
+            is a regular one and not a cold start.
+        """
+        # notices are the leader's to act upon
+        self.reconciler.take_notices()
+        with self.phase("warm"):
+            self.sort_state(self.fetch_state())
+            self.refresh()
+
+    def phase(self, name):
+        self.current_phase = name
+        return self.metrics.timer("tp_phase_seconds", group=self.side_group, phase=name)
+
+    def decided(self, action, **detail):
+        """ Tells the tracer, if any, what the current phase decided. """
+        if self.tracer is not None:
+            self.tracer.decide(self.current_phase, action, detail)
+
+    def trace_inputs(self):
+        """ What the decisions of a cycle are based on, once its state is loaded. """
+        now = time.time()
+        return {"desired_capacity": self.managed_by_autoscale(),
+                "target": self.target,
+                "managed": self.managed_instances(),
+                "live": len(self.live),
+                "emergency": len(self.emergency),
+                "bids": self.bids.counts('state'),
+                "pending_bids": len(self.pending_bids),
+                "pending_launches": len(self.pending_launches),
+                "unhealthy": len(self.unhealthy_ids),
+                "inventory": {"instances": len(self.inventory.instances),
+                              "spot_requests": len(self.inventory.spot_requests),
+                              "emergency": len(self.inventory.emergency)},
+                "cool_down_left": max(0, self.cool_down_threshold - (now - self.last_change)),
+                "bid_threshold_left": max(0, self.bid_threshold - (now - self.last_bid)),
+                "next_demotion": self.next_demotion}
+
+    def record_gauges(self):
+        self.metrics.set("tp_target", self.target or 0, group=self.side_group)
+        self.metrics.set("tp_managed_instances", self.managed_instances(), group=self.side_group)
+        self.metrics.set("tp_live_or_emergency", self.live_or_emergency(), group=self.side_group)
+        self.metrics.set("tp_emergency_instances", len(self.emergency), group=self.side_group)
+        self.metrics.set("tp_pending", self.pending(), group=self.side_group)
+        self.metrics.set("tp_managed_by_autoscale", self.managed_by_autoscale(), group=self.side_group)
+
+    def busy(self):
+        """ Whether there is work in flight that the next cycle should follow up soon. """
+        return self.pending() > 0 or len(self.valid_bids()) > 0 or self.managed_instances() != self.target
+
+    def next_delay(self, succeeded=True):
+        try:
+            busy = self.busy()
+        except Exception, e:
+            # e.g. the ASG still can't be read, follow up soon
+            self.logger.warn(">> next_delay(): could not tell whether busy: %r", e)
+            busy = True
+        delay = self.reconciler.settle(busy)
+        if not self.leading():
+            # the coordinator wakes a standby up as soon as it takes over
+            return self.reconciler.max_interval
+        if not succeeded:
+            delay += 10
+        elif self.next_demotion is not None:
+            # come back when the next planned demotion is due
+            delay = min(delay, max(self.reconciler.min_interval, self.next_demotion - time.time()))
+        return delay
+
     def run(self):
         self.start()
-        self.previous_managed = 0
         self.logger.info("Starting Tio Patinhas")
-        while self.started or self.managed_instances() > 0:
-            try:
-                self.save_money()
-            except Exception, e:
-                logger.exception(e)
-                time.sleep(10)
 
-            flush_output()
-            time.sleep(20)
+        sources = notice_sources(self.conf, [self.reconciler])
+        for source in sources:
+            source.start()
+        exporters = start_exporters(self.metrics, self.conf)
+        if self.coordinator is not None:
+            self.coordinator.start()
+
+        while self.running():
+            succeeded = self.tick()
+            if self.wait(self.next_delay(succeeded)):
+                self.logger.debug("Woken up early: %s", ", ".join(
+                    sorted(set([x[1] for x in self.reconciler.pending_events()]))))
+
+        for source in sources + exporters:
+            source.stop()
+        if self.coordinator is not None:
+            self.coordinator.stop()
         self.logger.debug("Stopped running.")
 
+    def wait(self, delay):
+        """ Sleeps until the next cycle is due, returns True if woken up early by an event. """
+        return self.reconciler.wait(delay)
+
     def save_money(self):
+        # what a failed cycle left behind is still in the fleet, load_state() finds it again
+        self.cleanup.clear()
+        interruptions = []
+        for notice in self.reconciler.take_notices():
+            self.logger.info(">> save_money(): received notice %s", notice)
+            interruption = parse_notice(notice)
+            if interruption is not None:
+                interruptions.append(interruption)
+
+        # acted upon before anything else, every second counts after a notice
+        with self.phase("interrupt"):
+            if interruptions:
+                self.interrupt(interruptions)
+
         self.logger.debug("Refreshing state...")
-        self.load_state()
-        self.refresh()
+        with self.phase("load_state"):
+            self.load_state()
+        with self.phase("refresh"):
+            self.refresh()
         self.print_state()
+        if self.tracer is not None:
+            self.tracer.observe(self.trace_inputs())
 
         self.logger.debug("Checking if needs to launch emergency instances")
-        if self.started and self.previous_managed > 0 and self.live_or_emergency() == 0:
-            self.logger.warn(">> market crashed! launching %s %s instances", self.previous_managed, self.emergency_type)
-            self.buy(self.previous_managed)
-            self.load_state()
+        with self.phase("emergency"):
+            self.handle_crash()
 
         self.logger.debug("Checking if there's any emergency instance to replace")
-        if self.emergency:
-            self.maybe_replace()
+        with self.phase("replace"):
+            if self.emergency:
+                self.maybe_replace()
 
         self.logger.debug("Checking if it needs to buy spot instances")
-        if self.managed_instances() < self.target:
-            self.bid()
-            self.load_state()
+        with self.phase("bid"):
+            if self.managed_instances() < self.target:
+                self.bid(self.target - self.managed_instances())
 
         self.logger.debug("Checking if there's any instance ready to be attached")
-        for new in self.ready_instances():
-            self.maybe_promote(new)
+        with self.phase("promote"):
+            for new in self.ready_instances():
+                self.maybe_promote(new)
 
         self.logger.debug("Checking if there's any sick machine to terminate")
-        for sick in self.unhealthy_ids:
-            self.maybe_terminate(sick)
+        with self.phase("terminate"):
+            self.maybe_terminate(self.unhealthy_ids)
+
+        with self.phase("demote"):
+            if self.maybe_demote():
+                self.reconciler.notify("demote")
 
-        self.maybe_demote()
+        with self.phase("cleanup"):
+            self.clean_up()
         self.previous_managed = self.live_or_emergency()
 
 
+MARKET_STATUS_CODES = ('marked-for-termination', 'instance-terminated-by-price', 'price-too-low')
+
+
+def instance_type(resource):
+    """ Instance type of an instance or of the instance a spot request asks for. """
+    if hasattr(resource, 'launch_specification'):
+        return resource.launch_specification.instance_type
+    return resource.instance_type
+
+
+def age(instance):
+    """ How long ago instance was launched, as a timedelta. """
+    return datetime.utcnow() - datetime.strptime(instance.launch_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def pool_of(request):
+    zone = request.launched_availability_zone or getattr(request.launch_specification, 'placement', None)
+    return (instance_type(request), zone)
+
+
+def read_conf(conf_file, log=logger):
+    """ The checked and compiled configuration (see config.py), exits if it's missing or wrong. """
+    try:
+        return load_conf(conf_file)
+    except IOError:
+        log.error("Configuration file " + conf_file + " not found.")
+        sys.exit(2)
+    except ConfigError, e:
+        for problem in e.problems:
+            log.error("Configuration file %s: %s", conf_file, problem)
+        sys.exit(2)
+
+
 def flush_output():
     sys.stdout.flush()
     sys.stderr.flush()
@@ -543,40 +1406,97 @@ tp is a long-standing process that attaches itself to an availability group on
 AWS. It attempts to buy cheap instances on the Spot Market and add those to the
 availability's group load balancer.
 
-   -g, --group                     Availability group to attach to
+   -g, --group                     Availability group to attach to, may be
+                                   repeated or comma separated (region/group
+                                   selects another region)
+   -s, --supervise                 Manage every group listed in the "groups"
+                                   configuration property
+   -a, --async                     Overlap AWS calls and defer the LB drain
+                                   instead of sleeping through it
+   -n, --dry-run                   Log the plan of every cycle (see plan_file)
+                                   without changing anything on AWS
    -d, --daemonize                 Detach from the terminal
+       --check-config              Check tp.conf, report every problem found
+                                   and exit
    -v, --verbose                   Verbose mode
 """
 
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "g:dv", ["group=", "daemonize", "verbose"])
+        opts, args = getopt.getopt(sys.argv[1:], "g:sandv", ["group=", "supervise", "async", "dry-run",
+                                                                "daemonize", "verbose", "check-config"])
     except getopt.GetoptError, err:
         logger.error(str(err))
         usage()
         sys.exit(2)
 
-    group = None
+    groups = []
+    supervise = False
+    concurrent = False
+    dry_run = False
     do_daemonize = False
     verbose = False
+    check_only = False
 
     for o, a in opts:
         if o in ("-g", "--group"):
-            group = a
+            groups.extend([x for x in a.split(",") if x])
+        elif o in ("-s", "--supervise"):
+            supervise = True
+        elif o in ("-a", "--async"):
+            concurrent = True
+        elif o in ("-n", "--dry-run"):
+            dry_run = True
         elif o in ("-v", "--verbose"):
             verbose = True
         elif o in ("-d", "--daemonize"):
-            daemonize = True
+            do_daemonize = True
+        elif o == "--check-config":
+            check_only = True
         else:
             assert False, "Unhandled option"
 
-    if do_daemonize:
-        daemonize()
-
-    if not group:
+    if check_only:
+        from config import check
+        problems = check("tp.conf")
+        for problem in problems:
+            print "tp.conf: %s" % problem
+        if not problems:
+            print "tp.conf: OK"
+        sys.exit(1 if problems else 0)
+
+    # daemonize() moves to "/"
+    conf_file = os.path.abspath("tp.conf")
+    if supervise:
+        groups.extend(read_conf(conf_file).groups)
+
+    if not groups:
         logger.error("no autoscale group defined")
         usage()
         sys.exit(2)
 
-    tp = TPManager(group, debug=verbose)
-    tp.run()
+    if concurrent and dry_run:
+        logger.error("--async and --dry-run can't be combined")
+        usage()
+        sys.exit(2)
+
+    factory = TPManager
+    if dry_run:
+        from shadow import ShadowTPManager
+        factory = ShadowTPManager
+    elif concurrent:
+        from aio import AsyncTPManager
+        factory = AsyncTPManager
+
+    # detached once the command line and tp.conf are known to be right, the errors would go to /dev/null
+    if do_daemonize:
+        read_conf(conf_file)
+        daemonize()
+
+    if len(groups) == 1 and not supervise and "/" not in groups[0]:
+        tp = factory(groups[0], debug=verbose, conf_file=conf_file)
+        tp.run()
+    else:
+        from supervisor import Supervisor
+        supervisor = Supervisor(groups, factory, conf=read_conf(conf_file), conf_file=conf_file, debug=verbose)
+        supervisor.run()
@@ -0,0 +1,215 @@
+""" What each tick saw, decided and spent its time on, for after the fact.
+
+    With trace_file set every TPManager appends one JSON line per tick to
+    it: the inputs of its decisions (inventory sizes, desired capacity,
+    target, what is left of the cool downs), every decision its phases
+    made (bids, purchases, promotions, holds, detachments, cancellations,
+    terminations) and how long each phase and each API took. The file is
+    rotated once it grows past trace_max_bytes, keeping trace_backups old
+    ones, and shared by every group of a process.
+
+    With profile_file set, SIGUSR2 turns a cProfile of the ticks on and,
+    sent again, off: the profile is then written to profile_file (for
+    pstats or snakeviz) and its top entries are logged, so a slow daemon
+    can be profiled without restarting it.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+import simplejson as json
+from StringIO import StringIO
+
+logger = logging.getLogger("tracing")
+
+_lock = threading.Lock()
+_files = {}
+_profilers = {}
+
+
+class TraceFile(object):
+    """ A JSON lines file rotated at max_bytes, keeping backups old ones as path.1, path.2... """
+
+    def __init__(self, path, max_bytes=10485760, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            if self.max_bytes and self._file.tell() > 0 and self._file.tell() + len(line) > self.max_bytes:
+                self.rotate()
+            self._file.write(line)
+            self._file.flush()
+
+    def rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%s" % (self.path, i)):
+                os.rename("%s.%s" % (self.path, i), "%s.%s" % (self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + ".1")
+        self._file = open(self.path, 'w')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Tracer(object):
+    """ Builds the trace record of a group's ticks, as a Metrics listener.
+
+        Decisions and timings are collected from one record to the next,
+        so deferred calls run between two ticks are part of the next one.
+    """
+
+    def __init__(self, group, out):
+        self.group = group
+        self.out = out
+        self.inputs = None
+        self._lock = threading.Lock()
+        self._decisions = []
+        self._phases = {}
+        self._calls = {}
+
+    def observe(self, inputs):
+        self.inputs = inputs
+
+    def decide(self, phase, action, detail):
+        detail = dict(detail, phase=phase, action=action)
+        with self._lock:
+            self._decisions.append(detail)
+
+    def counter(self, name, value, labels):
+        pass
+
+    def gauge(self, name, value, labels):
+        pass
+
+    def timing(self, name, value, labels):
+        if labels.get("group") != self.group:
+            return
+        with self._lock:
+            if name == "tp_api_seconds":
+                call = self._calls.setdefault("%s.%s" % (labels.get("service"), labels.get("api")), [0, 0.0])
+                call[0] += 1
+                call[1] += value
+            elif name == "tp_phase_seconds":
+                self._phases[labels.get("phase")] = self._phases.get(labels.get("phase"), 0.0) + value
+
+    def record(self, **fields):
+        """ Writes what was collected since the previous record, along with fields. """
+        with self._lock:
+            decisions, self._decisions = self._decisions, []
+            phases, self._phases = self._phases, {}
+            calls, self._calls = self._calls, {}
+        record = dict(fields)
+        record.update({"time": time.time(),
+                       "group": self.group,
+                       "inputs": self.inputs,
+                       "decisions": decisions,
+                       "phases": dict([(k, round(v, 4)) for k, v in phases.items()]),
+                       "calls": dict([(k, [n, round(s, 4)]) for k, (n, s) in calls.items()])})
+        self.inputs = None
+        try:
+            self.out.write(record)
+        except (IOError, OSError), e:
+            logger.warn("could not write the trace of %s: %s", self.group, e)
+
+
+def tracer(conf, group, metrics):
+    """ Builds a Tracer listening to metrics from the trace_* properties, None unless trace_file is set. """
+    path = conf.trace_file
+    if not path:
+        return None
+    with _lock:
+        if path not in _files:
+            _files[path] = TraceFile(path, conf.trace_max_bytes, conf.trace_backups)
+        out = _files[path]
+    recorder = Tracer(group, out)
+    # a restarted manager takes over from the previous one of its group
+    metrics.listeners = [x for x in metrics.listeners if not (isinstance(x, Tracer) and x.group == group)]
+    metrics.listeners.append(recorder)
+    return recorder
+
+
+class Profiler(object):
+    """ cProfile of the ticks of every group, turned on and off by a signal.
+
+        The signal handler only flips wanted, ticks pick it up when they
+        start, so nothing is written from inside the handler.
+    """
+
+    def __init__(self, path, top=25):
+        self.path = path
+        self.top = top
+        self.wanted = False
+        self.active = False
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def install(self, signum=signal.SIGUSR2):
+        try:
+            signal.signal(signum, self.toggle)
+        except ValueError:
+            # only the main thread can install signal handlers
+            logger.warn("could not install the profiling signal handler outside the main thread")
+
+    def toggle(self, signum=None, frame=None):
+        self.wanted = not self.wanted
+
+    def run(self, fn):
+        """ Calls fn, profiled if profiling is on. """
+        self.sync()
+        if not self.active:
+            return fn()
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn)
+        finally:
+            with self._lock:
+                self.profiles.append(profile)
+
+    def sync(self):
+        with self._lock:
+            if self.wanted == self.active:
+                return
+            self.active = self.wanted
+            if self.active:
+                logger.info("Profiling ticks until the next signal")
+                return
+            profiles, self.profiles = self.profiles, []
+        self.dump(profiles)
+
+    def dump(self, profiles):
+        if not profiles:
+            logger.info("Profiling stopped, no tick was profiled")
+            return
+        stream = StringIO()
+        stats = pstats.Stats(*profiles, stream=stream)
+        stats.dump_stats(self.path)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        logger.info("Profile of %s ticks written to %s\n%s", len(profiles), self.path, stream.getvalue())
+
+
+def profiler(conf):
+    """ The process' Profiler from profile_file, None unless it is set. """
+    path = conf.profile_file
+    if not path:
+        return None
+    with _lock:
+        if path not in _profilers:
+            _profilers[path] = Profiler(path)
+            _profilers[path].install()
+        return _profilers[path]